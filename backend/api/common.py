@@ -2,8 +2,9 @@
 import random
 import string
 from uuid import uuid1
+from threading import Lock, local
 from kubernetes.client import Configuration, ApiClient
-from config import KUBERNETES_CLUSTER_TOKEN, KUBERNETES_API_SERVER_URL
+from config import KUBERNETES_CLUSTER_TOKEN, KUBERNETES_API_SERVER_URL, KUBERNETES_API_POOL_MAXSIZE
 
 """
 @apiDefine admin Admin access only
@@ -36,12 +37,72 @@ def random_password(length=32):
     return ''.join(random.choice(password_chars) for _ in range(length))
 
 
+class PooledApiClient(ApiClient):
+    """
+    ApiClient shared by all threads of the process, whose keep-alive connections are pooled by urllib3.
+
+    `kubernetes.stream.stream` replaces `request` of the client it is given while an exec call is made,
+    so the replacement is kept per thread, and calls of other threads meanwhile still go through the pool.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = local()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def request(self):
+        override = getattr(self._local, 'request', None)
+        return override if override is not None else super().request
+
+    @request.setter
+    def request(self, value):
+        self._local.request = value
+
+
+_API_CLIENT = None
+_API_CLIENT_LOCK = Lock()
+
+
 def get_kubernetes_api_client():
-    conf = Configuration()
-    conf.host = KUBERNETES_API_SERVER_URL
-    conf.verify_ssl = False
-    conf.api_key = {"authorization": "Bearer " + KUBERNETES_CLUSTER_TOKEN}
-    return ApiClient(conf)
+    """
+    The Kubernetes ApiClient of this process, created on first use
+    """
+    global _API_CLIENT
+    if _API_CLIENT is None:
+        with _API_CLIENT_LOCK:
+            if _API_CLIENT is None:
+                conf = Configuration()
+                conf.host = KUBERNETES_API_SERVER_URL
+                conf.verify_ssl = False
+                conf.api_key = {"authorization": "Bearer " + KUBERNETES_CLUSTER_TOKEN}
+                conf.connection_pool_maxsize = KUBERNETES_API_POOL_MAXSIZE
+                _API_CLIENT = PooledApiClient(conf)
+    return _API_CLIENT
+
+
+def get_kubernetes_api_pool_stats(api_client=None):
+    """
+    Utilisation of the connection pool of `api_client`, the ApiClient of this process by default
+    """
+    api_client = api_client or get_kubernetes_api_client()
+    stats = {
+        'max_size': api_client.configuration.connection_pool_maxsize,
+        'in_use': 0,
+        'idle': 0,
+        'connections': 0,
+        'requests': 0,
+    }
+    pool_manager = api_client.rest_client.pool_manager
+    for key in pool_manager.pools.keys():
+        pool = pool_manager.pools.get(key)
+        if pool is None or pool.pool is None:
+            continue
+        # the queue starts with `maxsize` placeholders, connections taken out of it are in use
+        stats['in_use'] += pool.pool.maxsize - pool.pool.qsize()
+        stats['idle'] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        stats['connections'] += pool.num_connections
+        stats['requests'] += pool.num_requests
+    return stats
 
 
 class _Response(object):
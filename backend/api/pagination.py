@@ -0,0 +1,77 @@
+"""
+Pagination of list APIs
+"""
+import json
+import base64
+import binascii
+from django.db.models import Q
+from django.core.exceptions import ValidationError
+
+PAGE_SIZE = 25
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor, length):
+    """
+    :raise ValueError: if `cursor` is not a list of `length` values encoded by `encode_cursor`
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, UnicodeError, binascii.Error) as ex:
+        raise ValueError("Invalid cursor") from ex
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def _after(order_by, values):
+    """
+    Filter of the rows after the one with `values` of the `order_by` fields in that order
+    """
+    condition = Q()
+    equal = Q()
+    for field, value in zip(order_by, values):
+        name = field.lstrip('-')
+        lookup = '{}__lt' if field.startswith('-') else '{}__gt'
+        condition |= equal & Q(**{lookup.format(name): value})
+        equal &= Q(**{name: value})
+    return condition
+
+
+def get_page(queryset, params, order_by, page_size=PAGE_SIZE):
+    """
+    Page of `queryset` ordered by the fields `order_by`, the last of which must be unique.
+
+    With a `cursor` param, the page starts right after the row the cursor was taken from, which the database
+    seeks with an index on the order fields instead of skipping all rows before it, and rows are not counted.
+    Otherwise the `page` param (starting from 1) selects the page by offset as before, along with the count.
+    :return: rows of the page and payload of the list, with `next_cursor` continuing after the page, null at the end
+    :raise ValueError: if the `page` or `cursor` param is invalid
+    """
+    queryset = queryset.order_by(*order_by)
+    payload = {}
+    cursor = params.get('cursor', None)
+    if cursor is not None:
+        try:
+            queryset = queryset.filter(_after(order_by, decode_cursor(cursor, len(order_by))))
+        except ValidationError as ex:
+            raise ValueError("Invalid cursor") from ex
+    else:
+        page = int(params.get('page', '1'))
+        count = queryset.count()
+        page_count = (count + page_size - 1) // page_size
+        if page < 1 or page > max(page_count, 1):
+            raise ValueError("Invalid page")
+        payload['count'] = count
+        payload['page_count'] = page_count
+        queryset = queryset[(page - 1) * page_size:]
+    # one more row tells whether there is a next page
+    rows = list(queryset[:page_size + 1])
+    payload['next_cursor'] = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        payload['next_cursor'] = encode_cursor([getattr(rows[-1], field.lstrip('-')) for field in order_by])
+    return rows, payload
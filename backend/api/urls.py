@@ -30,7 +30,8 @@ from .common import OAUTH_LOGIN_URL
 # pylint: disable=C0103
 websocket_urlpatterns = [
     path('terminals/', ws_views.WebSSH),
-    path('user_terminals/', ws_views.UserWebSSH)
+    path('user_terminals/', ws_views.UserWebSSH),
+    path('task_logs/', ws_views.TaskLogTail)
 ]
 
 urlpatterns = [
@@ -60,6 +61,7 @@ urlpatterns = [
     path('oauth/user_info/', user_views.OAuthUserInfoView.as_view()),
     # pod list
     path('pods/', permission_required(monitor_views.PodListHandler.as_view())),
+    path('kubernetes_client/', permission_required(monitor_views.KubernetesClientHandler.as_view())),
     # storage
     path('storage/', storage_views.StorageHandler.as_view()),
     path('storage/upload_file/', storage_views.StorageFileHandler.as_view()),
@@ -15,6 +15,32 @@ REGISTRY_V2_API_ADDRESS = "https://registry.dropthu.online:30443/v2"
 
 DAEMON_WORKERS = 2
 TASK_DISPATCH_WORKERS = 4
+TASK_DISPATCH_BATCH_SIZE = 100
+KUBERNETES_API_WORKERS = 16
+KUBERNETES_API_POOL_MAXSIZE = 32
+TASK_MEMORY_CAPACITY_RATIO = 0.8
+EXECUTOR_SHARDS = 1
+EXECUTOR_LEASE_DURATION = 15  # in seconds
+EXECUTOR_IDLE_WAIT = 5  # in seconds
+STORAGE_POOL_MAX_PODS = 50
+STORAGE_POOL_HEADROOM = 1
+STORAGE_POOL_LEAD_TIME = 30  # in seconds
+STORAGE_POD_PLACEMENT = 'pack'
+TTL_CHECK_JITTER = 0.5
+TASK_LOG_CHUNK_SIZE = 65536  # in bytes
+TASK_LOG_MAX_SIZE = 16777216  # in bytes
+TASK_LOG_COMPRESSION_LEVEL = 6
+TASK_LOG_PAGE_SIZE = 65536  # in bytes
+TASK_LOG_FOLLOW_TIMEOUT = 20  # in seconds
+TASK_LOG_TAIL_SECONDS = 60
+TASK_LOG_LIVE_READ_SIZE = 1048576  # in bytes
+USER_SPACE_EXEC_TIMEOUT = 20  # in seconds
+USER_SPACE_SESSION_IDLE_TIMEOUT = 300  # in seconds
+USER_SPACE_BATCH_SIZE = 100
+USER_SPACE_UPLOAD_CHUNK_SIZE = 1048576  # in bytes
+USER_SPACE_CACHE_SIZE = 67108864  # in characters
+USER_SPACE_CACHE_FILE_SIZE = 1048576  # in characters
+USER_SPACE_CACHE_TTL = 5  # in seconds
 IPC_PORT = 50000
 
 CEPH_STORAGE_CLASS_NAME = "csi-cephfs"
@@ -2,7 +2,7 @@ import logging
 from django.http import JsonResponse
 from django.views import View
 from kubernetes.client import CoreV1Api
-from api.common import RESPONSE, get_kubernetes_api_client
+from api.common import RESPONSE, get_kubernetes_api_client, get_kubernetes_api_pool_stats
 
 LOGGER = logging.getLogger(__name__)
 
@@ -68,3 +68,37 @@ class PodListHandler(View):
             response = RESPONSE.SERVER_ERROR
         finally:
             return JsonResponse(response)
+
+
+class KubernetesClientHandler(View):
+    http_method_names = ['get']
+
+    def get(self, _, **__):
+        """
+        @api {get} /kubernetes_client/ Get Kubernetes API connection pool usage
+        @apiName GetKubernetesClient
+        @apiGroup Monitor
+        @apiVersion 0.1.0
+        @apiPermission admin
+
+        @apiDescription Connections of the process serving the request
+        @apiSuccess {Object} payload Response object
+        @apiSuccess {Number} payload.max_size Max number of keep-alive connections
+        @apiSuccess {Number} payload.in_use Connections serving a request
+        @apiSuccess {Number} payload.idle Open connections waiting for a request
+        @apiSuccess {Number} payload.connections Connections opened so far
+        @apiSuccess {Number} payload.requests Requests made so far
+        @apiUse APIHeader
+        @apiUse Success
+        @apiUse Unauthorized
+        @apiUse PermissionDenied
+        @apiUse ServerError
+        """
+        response = RESPONSE.SUCCESS
+        try:
+            response['payload'] = get_kubernetes_api_pool_stats()
+        except Exception as ex:
+            LOGGER.error(ex)
+            response = RESPONSE.SERVER_ERROR
+        finally:
+            return JsonResponse(response)
@@ -684,7 +684,8 @@ class FileDisplayHandler(UserSpaceHandler):
             return JsonResponse(response)
 
         response = super()._safe_wrapper(request, op_code, pvcname=pvc_name)
-        if json.loads(response.content)['message'] == "Operation is unsuccessful. Failed to allocate pod.":
+        if isinstance(response, JsonResponse) and \
+                json.loads(response.content)['message'] == "Operation is unsuccessful. Failed to allocate pod.":
             response = RESPONSE.RESOURCE_LOCKED
             response['message'] = "It will take some time to get information. Please wait."
             response = JsonResponse(response)
@@ -0,0 +1,64 @@
+"""
+Autoscaling of the webshell storage pod pool of each TaskSettings
+"""
+import math
+import time
+from collections import deque
+from threading import Lock
+from config import STORAGE_POOL_MAX_PODS, STORAGE_POOL_HEADROOM, STORAGE_POOL_LEAD_TIME
+
+HISTORY_WINDOW = 300  # seconds of occupancy history used for predictions
+
+
+class PoolAutoscaler:
+    """
+    Target pool size of every TaskSettings, predicted from its occupancy history.
+
+    Every TTL check samples the occupied slots of the pool. Users that logged in since the previous sample
+    give the allocation rate of the window, which is extrapolated over the time a new pod needs to become
+    usable, so that the pool grows ahead of a wave of logins instead of after it is full. The pool shrinks
+    only below the peak occupancy of the window, so idle pods are reclaimed together once a session is over
+    rather than one by one while users keep coming back.
+    """
+
+    def __init__(self, window=HISTORY_WINDOW, headroom=STORAGE_POOL_HEADROOM, lead_time=STORAGE_POOL_LEAD_TIME,
+                 max_pods=STORAGE_POOL_MAX_PODS):
+        self.window = window
+        self.headroom = max(headroom, 1)  # a new user must always find a free slot
+        self.lead_time = lead_time
+        self.max_pods = max_pods
+        self._history = {}  # settings uuid -> deque of (time, occupied slots)
+        self._lock = Lock()
+
+    def _observe(self, uuid, occupied, now):
+        with self._lock:
+            history = self._history.setdefault(uuid, deque())
+            history.append((now, occupied))
+            while history[0][0] < now - self.window:
+                history.popleft()
+            samples = [sample for _, sample in history]
+            elapsed = now - history[0][0]
+        allocated = sum(max(current - previous, 0) for previous, current in zip(samples, samples[1:]))
+        return allocated, elapsed, max(samples)
+
+    def target(self, uuid, occupied, slots_per_pod, min_pods, interval, now=None):
+        """
+        Number of pods the pool of TaskSettings `uuid` should have
+        :param occupied: slots currently taken by users
+        :param slots_per_pod: `max_sharing_users` of the TaskSettings
+        :param min_pods: `replica` of the TaskSettings
+        :param interval: seconds until the next check
+        """
+        allocated, elapsed, peak = self._observe(uuid, occupied, time.time() if now is None else now)
+        # logins expected before a pod created now is usable and the next check could react
+        horizon = interval + self.lead_time
+        expected = math.ceil(allocated * horizon / max(elapsed, horizon))
+        demand = max(occupied, peak) + max(expected, self.headroom)
+        pods = math.ceil(demand / max(slots_per_pod, 1))
+        if self.max_pods:
+            pods = min(pods, self.max_pods)
+        return max(pods, min_pods)
+
+    def forget(self, uuid):
+        with self._lock:
+            self._history.pop(uuid, None)
@@ -0,0 +1,65 @@
+"""
+Cluster capacity used for task admission
+"""
+import re
+import time
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+CAPACITY_REFRESH_INTERVAL = 30  # seconds between node listings
+
+_QUANTITY = re.compile(r'^([0-9.]+(?:[eE][-+]?[0-9]+)?)(Ki|Mi|Gi|Ti|Pi|Ei|m|k|M|G|T|P|E)?$')
+_SUFFIXES = {
+    None: 1, 'm': 10 ** -3,
+    'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12, 'P': 10 ** 15, 'E': 10 ** 18,
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60,
+}
+
+
+def parse_quantity(quantity):
+    """
+    Kubernetes resource quantity such as `128M` or `1.5Gi` in base units
+    :raise ValueError: if `quantity` is not a valid quantity
+    """
+    match = _QUANTITY.match(str(quantity).strip())
+    if match is None:
+        raise ValueError("Invalid quantity: {}".format(quantity))
+    return int(float(match.group(1)) * _SUFFIXES[match.group(2)])
+
+
+def is_schedulable(node):
+    if node.spec is not None and node.spec.unschedulable:
+        return False
+    for condition in (node.status.conditions or []):
+        if condition.type == 'Ready':
+            return condition.status == 'True'
+    return False
+
+
+class ClusterCapacity:
+    """
+    Total allocatable memory of the schedulable nodes, refreshed at most every `refresh_interval` seconds.
+
+    `memory` stays None until the nodes could be listed once, in which case admission should not be limited.
+    """
+
+    def __init__(self, refresh_interval=CAPACITY_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.memory = None
+        self._refreshed = 0
+
+    def refresh(self, api):
+        if time.time() - self._refreshed < self.refresh_interval:
+            return self.memory
+        self._refreshed = time.time()
+        try:
+            memory = 0
+            for node in api.list_node().items:
+                if is_schedulable(node):
+                    memory += parse_quantity((node.status.allocatable or {}).get('memory', 0))
+            self.memory = memory
+        except Exception as ex:
+            # keep the last known capacity
+            LOGGER.warning("Failed to get cluster capacity: %s", ex)
+        return self.memory
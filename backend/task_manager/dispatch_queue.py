@@ -0,0 +1,74 @@
+"""
+In-memory queue of scheduled tasks
+"""
+import heapq
+
+
+class DispatchQueue:
+    """
+    Scheduled tasks ordered by priority, then by fair share between users, then by submission order.
+
+    Every user owns a heap of their queued tasks, and users compete through a second heap keyed by the
+    priority of their first task and the number of tasks they already have in Kubernetes, so picking
+    the next task costs O(log n) instead of sorting the whole table.
+    The queue is owned by the dispatch thread and is not thread-safe.
+    """
+
+    def __init__(self):
+        self._tasks = {}  # user id -> heap of (-priority, task id, settings id)
+        self._queued = set()  # task ids
+        self.last_id = 0  # largest task id ever pushed
+
+    def __len__(self):
+        return len(self._queued)
+
+    def __contains__(self, task_id):
+        return task_id in self._queued
+
+    def push(self, task_id, user_id, settings_id, priority=0):
+        if task_id in self._queued:
+            return
+        self._queued.add(task_id)
+        self.last_id = max(self.last_id, task_id)
+        heapq.heappush(self._tasks.setdefault(user_id, []), (-priority, task_id, settings_id))
+
+    def pop(self, limit, share=None, slots=None, budget=None, cost=None):
+        """
+        Remove and return the ids of up to `limit` tasks in dispatch order
+        :param share: user id -> number of tasks of that user already in Kubernetes
+        :param slots: settings id -> number of tasks of that TaskSettings that may still be admitted,
+        settings missing from the dict are unlimited. Tasks of exhausted settings stay queued.
+        :param budget: resources left for new tasks, None for unlimited. Tasks that do not fit stay queued
+        while smaller ones behind them are admitted.
+        :param cost: settings id -> resources reserved by every task of that TaskSettings
+        """
+        share = dict(share or {})
+        slots = dict(slots or {})
+        cost = cost or {}
+        users = [(heap[0][0], share.get(user_id, 0), heap[0][1], user_id) for user_id, heap in self._tasks.items()]
+        heapq.heapify(users)
+        result = []
+        blocked = []
+        while users and len(result) < limit:
+            _, user_share, _, user_id = heapq.heappop(users)
+            heap = self._tasks[user_id]
+            entry = heapq.heappop(heap)
+            settings_id = entry[2]
+            task_cost = cost.get(settings_id, 0)
+            if slots.get(settings_id, 1) > 0 and (budget is None or task_cost <= budget):
+                if settings_id in slots:
+                    slots[settings_id] -= 1
+                if budget is not None:
+                    budget -= task_cost
+                self._queued.discard(entry[1])
+                result.append(entry[1])
+                user_share += 1
+            else:
+                blocked.append((user_id, entry))
+            if heap:
+                heapq.heappush(users, (heap[0][0], user_share, heap[0][1], user_id))
+            else:
+                del self._tasks[user_id]
+        for user_id, entry in blocked:
+            heapq.heappush(self._tasks.setdefault(user_id, []), entry)
+        return result
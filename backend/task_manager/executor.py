@@ -1,29 +1,61 @@
 """
 Task executor
 """
+import copy
 import time
+import functools
 import logging
-import json
 from uuid import uuid4
-from threading import Thread
-from concurrent.futures import ThreadPoolExecutor
-import schedule
-from django.db.models import Q
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.db import transaction
+from django.db.models import Q, Count
 import rpyc
 from rpyc.utils.server import ThreadedServer
 from kubernetes import client
 from kubernetes.stream import stream
 from kubernetes.client import CoreV1Api, BatchV1Api, ExtensionsV1beta1Api, AppsV1Api
 from kubernetes.client.rest import ApiException
+from urllib3.exceptions import HTTPError
 from api.common import get_kubernetes_api_client, USERSPACE_NAME, random_password, get_uuid
-from config import DAEMON_WORKERS, KUBERNETES_NAMESPACE, CEPH_STORAGE_CLASS_NAME, \
-    GLOBAL_TASK_TIME_LIMIT, USER_SPACE_POD_TIMEOUT, IPC_PORT, USER_WEBSHELL_DOCKER_IMAGE
+from config import DAEMON_WORKERS, TASK_DISPATCH_WORKERS, TASK_DISPATCH_BATCH_SIZE, TASK_MEMORY_CAPACITY_RATIO, \
+    EXECUTOR_IDLE_WAIT, STORAGE_POD_PLACEMENT, KUBERNETES_API_WORKERS, KUBERNETES_NAMESPACE, \
+    CEPH_STORAGE_CLASS_NAME, USER_SPACE_POD_TIMEOUT, TASK_LOG_MAX_SIZE, IPC_PORT
 import config
 from user_model.models import UserModel
-from .models import TaskSettings, TaskStorage, TaskVNCPod, Task, TASK
+from .models import TaskSettings, TaskStorage, TaskVNCPod, Task, TaskLogChunk, TASK
+from .informer import PodInformer
+from .settings_config import get_settings_config, USER_DIR
+from .dispatch_queue import DispatchQueue
+from .capacity import ClusterCapacity
+from .lease import ExecutorMembership
+from .expiry import ExpiryQueue
+from .autoscaler import PoolAutoscaler
+from .placement import get_placement_strategy
+from .ttl_scheduler import TtlScheduler
+from .slots import take_slot, free_slot, reclaim
+from .task_log import capture_pod_log, build_chunks, save_chunks
 
 LOGGER = logging.getLogger(__name__)
 
+BULK_UPDATE_BATCH_SIZE = 100
+DISPATCH_QUEUE_RESYNC_INTERVAL = 60  # seconds between full scans for scheduled tasks missed by the dispatch queue
+SETTINGS_SYNC_INTERVAL = 10  # seconds between scans for task settings changed by other processes
+EXPIRY_RESYNC_INTERVAL = 60  # seconds between scans for pod expirations missed by the expiry queue
+JOB_MONITOR_RETRY_DELAY = 1  # seconds before tasks whose update failed or had to wait are looked at again
+
+ACTIVE_TASKS = Q(status=TASK.WAITING) | Q(status=TASK.RUNNING) | Q(status=TASK.PENDING)
+
+# executor loops that block while idle until woken up
+JOB_DISPATCH = 'job_dispatch'
+JOB_MONITOR = 'job_monitor'
+STORAGE_MONITOR = 'storage_monitor'
+TTL_SCHEDULER = 'ttl_scheduler'
+
+# kinds of pods in the expiry queue
+USER_SPACE_POD = 'storage'
+VNC_POD = 'vnc'
+
 
 def create_namespace():
     api_instance = CoreV1Api(get_kubernetes_api_client())
@@ -65,26 +97,36 @@ def get_userspace_pvc():
         return False
 
 
+def bulk_save(model, items, fields):
+    """
+    Persist `fields` of all `items` with batched UPDATE statements in a single transaction
+    """
+    if items:
+        with transaction.atomic():
+            model.objects.bulk_update(items, fields, batch_size=BULK_UPDATE_BATCH_SIZE)
+
+
 def get_short_uuid():
     return str(uuid4())[:8]
 
 
-def config_checker(json_config):
+def notify_executor(*loops):
+    """
+    Wake up loops of the task executor running in this process, or of the one serving IPC on this host
+    """
+    executor = TaskExecutor.instance(new=False)
+    if executor is not None:
+        executor.wake_up(*loops)
+        return
     try:
-        pre_check_fail = ('image' not in json_config.keys() or
-                          'persistent_volume' not in json_config.keys() or
-                          'name' not in json_config['persistent_volume'].keys() or
-                          'mount_path' not in json_config['persistent_volume'].keys() or
-                          'working_path' not in json_config.keys() or
-                          'shell' not in json_config.keys() or
-                          'memory_limit' not in json_config.keys() or
-                          'commands' not in json_config.keys() or
-                          'task_script_path' not in json_config.keys() or
-                          'task_initial_file_path' not in json_config.keys() or
-                          not isinstance(json_config['commands'], list))
-        return not pre_check_fail
-    except Exception as _:
-        return False
+        conn = rpyc.connect('localhost', IPC_PORT, config={'sync_request_timeout': 1})
+        try:
+            conn.root.wake_up(*loops)
+        finally:
+            conn.close()
+    except Exception as ex:
+        # executors elsewhere pick up the work after at most EXECUTOR_IDLE_WAIT seconds
+        LOGGER.debug(ex)
 
 
 class Singleton:
@@ -126,6 +168,11 @@ class Singleton:
 
 
 class RpcService(rpyc.Service):
+    def exposed_wake_up(self, *loops):
+        executor = TaskExecutor.instance(new=False)
+        if executor:
+            executor.wake_up(*loops)
+
     def exposed_get_user_space_pod(self, uuid, user_id):
         executor = TaskExecutor.instance(new=False)
         try:
@@ -147,10 +194,42 @@ class TaskExecutor:
     def __init__(self, test=False):
         self.ttl_checker = ThreadPoolExecutor(max_workers=DAEMON_WORKERS,
                                               thread_name_prefix='cloud_scheduler_k8s_worker_ttl')
+        self.job_dispatcher = ThreadPoolExecutor(max_workers=TASK_DISPATCH_WORKERS,
+                                                 thread_name_prefix='cloud_scheduler_k8s_worker_dispatch')
+        # independent API calls of one round are made concurrently over the connections of the shared client
+        self.api_workers = ThreadPoolExecutor(max_workers=KUBERNETES_API_WORKERS,
+                                              thread_name_prefix='cloud_scheduler_k8s_worker_api')
+        self.api_client = get_kubernetes_api_client()
+        self.ttl_scheduler = TtlScheduler(self.ttl_checker.submit, on_change=lambda: self.wake_up(TTL_SCHEDULER))
+        self._userspace_ready = False
+        self.dispatch_queue = DispatchQueue()
+        self._dispatch_queue_synced = 0
+        self.cluster_capacity = ClusterCapacity()
+        self.expiry_queue = ExpiryQueue()
+        self.pool_autoscaler = PoolAutoscaler()
+        self.placement = get_placement_strategy(STORAGE_POD_PLACEMENT)
+        self._expiry_synced = 0
+        self._expiry_generation = None
         self.scheduler_thread = Thread(target=self.dispatch)
         self.job_dispatch_thread = Thread(target=self._job_dispatch)
         self.job_monitor_thread = Thread(target=self._job_monitor)
         self.storage_pod_monitor_thread = Thread(target=self._storage_pod_monitor)
+        # pods of task jobs, indexed by `task-exec` label (task uuid)
+        self.job_informer = PodInformer('task-exec')
+        self.job_informer.add_handler(self._on_job_pod_event)
+        self.job_informer_thread = Thread(target=self._run_informer, kwargs={'informer': self.job_informer})
+        # webshell storage pods, indexed by `task` label (task settings uuid)
+        self.storage_informer = PodInformer('task')
+        self.storage_informer_thread = Thread(target=self._run_informer, kwargs={'informer': self.storage_informer})
+        self._changed_tasks = set()
+        self._changed_tasks_lock = Lock()
+        # leader election and sharding between executor replicas
+        self.membership = ExecutorMembership()
+        self.membership_thread = Thread(target=self.membership.run)
+        self._monitored_generation = None
+        self._scheduled_settings = {}  # settings uuid -> (ttl interval, container config) scheduled with
+        self._wakeups = {loop: Event() for loop in (JOB_DISPATCH, JOB_MONITOR, STORAGE_MONITOR, TTL_SCHEDULER)}
+        self._settings_synced = 0
         self.ready = False
         self.test = test
         self.ipc_server = ThreadedServer(RpcService, port=IPC_PORT)
@@ -169,94 +248,268 @@ class TaskExecutor:
             self.job_monitor_thread.start()
         if not self.storage_pod_monitor_thread.isAlive():
             self.storage_pod_monitor_thread.start()
+        if not self.job_informer_thread.isAlive():
+            self.job_informer_thread.start()
+        if not self.storage_informer_thread.isAlive():
+            self.storage_informer_thread.start()
+        if not self.membership_thread.isAlive():
+            self.membership_thread.start()
         if not self.ipc_thread.isAlive():
             self.ipc_thread.start()
 
-    def _run_job(self, fn, **kwargs):
-        self.ttl_checker.submit(fn, **kwargs)
+    def wake_up(self, *loops):
+        """
+        Wake up idle loops so that new work is picked up right away
+        """
+        for loop in loops:
+            self._wakeups[loop].set()
+
+    def _wait(self, loop, timeout):
+        # work signaled after this point is seen by the next round, as the flag is cleared before it starts
+        event = self._wakeups[loop]
+        event.wait(timeout)
+        event.clear()
+
+    def _fan_out(self, fn, items):
+        """
+        Call `fn` on all `items` concurrently and return the results in the order of `items`
+        """
+        futures = [self.api_workers.submit(fn, item) for item in items]
+        return [future.result() for future in futures]
+
+    def _run_informer(self, informer):
+        informer.run(CoreV1Api(get_kubernetes_api_client()), self.test)
+
+    def _mark_task_changed(self, uuid):
+        with self._changed_tasks_lock:
+            self._changed_tasks.add(uuid)
+        self.wake_up(JOB_MONITOR)
+
+    def _retry_tasks(self, uuids):
+        """
+        Look at tasks again in a later round of the job monitor, without waking it up, so that it waits for
+        JOB_MONITOR_RETRY_DELAY instead of retrying right away
+        """
+        with self._changed_tasks_lock:
+            self._changed_tasks.update(uuids)
+
+    def _on_job_pod_event(self, _event_type, pod):
+        uuid = (pod.metadata.labels or {}).get('task-exec', None)
+        if uuid:
+            self._mark_task_changed(uuid)
+
+    def _pop_changed_tasks(self):
+        with self._changed_tasks_lock:
+            changed = self._changed_tasks
+            self._changed_tasks = set()
+        return changed
 
     def _storage_pod_monitor(self):
-        api = CoreV1Api(get_kubernetes_api_client())
-        app_api = AppsV1Api(get_kubernetes_api_client())
+        api = CoreV1Api(self.api_client)
+        app_api = AppsV1Api(self.api_client)
+
+        def _release(item):
+            item.pod_name = ''
+            item.expire_time = 0
+            if isinstance(item, TaskVNCPod):
+                item.url_path = ''
+
+        def _sync_expiry():
+            # pick up pods allocated by other processes and shards taken over from other replicas
+            for model, kind in ((TaskStorage, USER_SPACE_POD), (TaskVNCPod, VNC_POD)):
+                for pk, expire_time, uuid in model.objects.filter(expire_time__gt=0) \
+                        .values_list('id', 'expire_time', 'settings__uuid'):
+                    if self.membership.owns(uuid):
+                        self.expiry_queue.push(expire_time, (kind, pk))
+            self._expiry_synced = time.time()
+            self._expiry_generation = self.membership.generation
+
+        def _due(kind, item, now):
+            """
+            Whether `item` popped from the expiry queue is to be released now, re-queue it otherwise
+            """
+            if not self.membership.owns(item.settings.uuid):
+                return False
+            if item.expire_time > now:
+                # extended since it was queued
+                self.expiry_queue.push(item.expire_time, (kind, item.id))
+                return False
+            return True
+
+        def _release_storage(item):
+            """
+            Remove the user of `item` from its pod, returns whether the slot is released
+            """
+            try:
+                username = '{}_{}'.format(item.user.username, item.settings_id)
+                pod = api.read_namespaced_pod(name=item.pod_name, namespace=KUBERNETES_NAMESPACE)
+                if pod is not None and pod.status is not None and pod.status.phase == 'Running':
+                    response = stream(api.connect_get_namespaced_pod_exec,
+                                      item.pod_name,
+                                      KUBERNETES_NAMESPACE,
+                                      command=
+                                      ['/bin/bash', '-c',
+                                       'unlink /home/{username};userdel {username}'.format(
+                                           username=username)],
+                                      stderr=True, stdin=False,
+                                      stdout=True, tty=False)
+                    LOGGER.debug(response)
+                    released = free_slot(api, pod)
+                    if released is not None:
+                        self.storage_informer.update(released)
+                return True
+            except ApiException as ex:
+                if ex.status == 404:
+                    return True
+                LOGGER.warning(ex)
+            except Exception as ex:
+                LOGGER.error(ex)
+            # retry next second
+            self.expiry_queue.push(round(time.time()) + 1, (USER_SPACE_POD, item.id))
+            return False
+
+        def _release_vnc(item):
+            try:
+                app_api.delete_namespaced_deployment(name=item.pod_name, namespace=KUBERNETES_NAMESPACE)
+                return True
+            except ApiException as ex:
+                if ex.status == 404:
+                    return True
+                LOGGER.exception(ex)
+            except Exception as ex:
+                LOGGER.error(ex)
+            self.expiry_queue.push(round(time.time()) + 1, (VNC_POD, item.id))
+            return False
 
         def _actual_work():
-            idle = True
+            released_storage = []
+            released_vnc = []
             try:
-                for item in TaskStorage.objects.filter(expire_time__gt=0).order_by('expire_time'):
-                    try:
-                        if item.expire_time <= round(time.time()):
-                            # release idled pod
-                            idle = False
-                            username = '{}_{}'.format(item.user.username, item.settings.id)
-                            pod = api.read_namespaced_pod(name=item.pod_name, namespace=KUBERNETES_NAMESPACE)
-                            if pod is not None and pod.status is not None and pod.status.phase == 'Running':
-                                response = stream(api.connect_get_namespaced_pod_exec,
-                                                  item.pod_name,
-                                                  KUBERNETES_NAMESPACE,
-                                                  command=
-                                                  ['/bin/bash', '-c',
-                                                   'unlink /home/{username};userdel {username}'.format(
-                                                       username=username)],
-                                                  stderr=True, stdin=False,
-                                                  stdout=True, tty=False)
-                                LOGGER.debug(response)
-                                pod.metadata.labels['occupied'] = str(max(int(pod.metadata.labels['occupied']) - 1, 0))
-                                api.patch_namespaced_pod(pod.metadata.name, KUBERNETES_NAMESPACE, pod)
-                            item.pod_name = ''
-                            item.expire_time = 0
-                            item.save(force_update=True)
-                    except ApiException as ex:
-                        if ex.status == 404:
-                            item.pod_name = ''
-                            item.expire_time = 0
-                            item.save(force_update=True)
-                        else:
-                            LOGGER.warning(ex)
-                for item in TaskVNCPod.objects.filter(expire_time__gt=0).order_by('expire_time'):
-                    try:
-                        if item.expire_time <= round(time.time()):
-                            idle = False
-                            if item.pod_name:
-                                app_api.delete_namespaced_deployment(name=item.pod_name, namespace=KUBERNETES_NAMESPACE)
-                                item.pod_name = ''
-                                item.expire_time = 0
-                                item.url_path = ''
-                                item.save(force_update=True)
-                    except ApiException as ex:
-                        if ex.status != 404:
-                            LOGGER.exception(ex)
-                        else:
-                            item.pod_name = ''
-                            item.expire_time = 0
-                            item.url_path = ''
-                            item.save(force_update=True)
+                self.membership.heartbeat()
+                if time.time() - self._expiry_synced >= EXPIRY_RESYNC_INTERVAL or \
+                        self._expiry_generation != self.membership.generation:
+                    _sync_expiry()
+                now = round(time.time())
+                due = self.expiry_queue.pop_due(now)
+                storage_ids = [pk for kind, pk in due if kind == USER_SPACE_POD]
+                vnc_ids = [pk for kind, pk in due if kind == VNC_POD]
+                storage = TaskStorage.objects.filter(id__in=storage_ids, expire_time__gt=0) \
+                    .select_related('user', 'settings') if storage_ids else []
+                storage = [item for item in storage if _due(USER_SPACE_POD, item, now)]
+                vnc_pods = TaskVNCPod.objects.filter(id__in=vnc_ids, expire_time__gt=0) \
+                    .select_related('settings') if vnc_ids else []
+                vnc_pods = [item for item in vnc_pods if _due(VNC_POD, item, now) and item.pod_name]
+                # release idled pods
+                for item, released in zip(storage, self._fan_out(_release_storage, storage)):
+                    if released:
+                        _release(item)
+                        released_storage.append(item)
+                for item, released in zip(vnc_pods, self._fan_out(_release_vnc, vnc_pods)):
+                    if released:
+                        _release(item)
+                        released_vnc.append(item)
             except Exception as ex:
                 LOGGER.warning(ex)
-            if idle:
-                time.sleep(1)
+            try:
+                bulk_save(TaskStorage, released_storage, ['pod_name', 'expire_time'])
+                bulk_save(TaskVNCPod, released_vnc, ['pod_name', 'expire_time', 'url_path'])
+            except Exception as ex:
+                LOGGER.error(ex)
+            next_expire = self.expiry_queue.next_expire()
+            if next_expire is None:
+                return EXECUTOR_IDLE_WAIT
+            # sleep until the next pod expires
+            return min(max(next_expire - time.time(), 0), EXECUTOR_IDLE_WAIT)
 
         while True:
-            _actual_work()
+            timeout = _actual_work()
             if self.test:
                 break
+            if timeout:
+                self._wait(STORAGE_MONITOR, timeout)
 
     def _job_monitor(self):
-        api = CoreV1Api(get_kubernetes_api_client())
-        job_api = BatchV1Api(get_kubernetes_api_client())
+        api = CoreV1Api(self.api_client)
+        job_api = BatchV1Api(self.api_client)
+
+        def _delete_job(uuid, grace_period_seconds):
+            job_api.delete_namespaced_job(name="task-exec-{}".format(uuid),
+                                          namespace=KUBERNETES_NAMESPACE,
+                                          body=client.V1DeleteOptions(
+                                              propagation_policy='Foreground',
+                                              grace_period_seconds=grace_period_seconds
+                                          ))
+
+        def _read_log(entry):
+            """
+            Compressed log chunks of the task of a finished job pod, None if they could not be read
+            """
+            item, pod = entry[0], entry[1]
+            try:
+                return build_chunks(item, capture_pod_log(api, pod.metadata.name))
+            except (ApiException, HTTPError) as ex:
+                LOGGER.warning(ex)
+                return None
+
+        def _delete_deleting(item):
+            """
+            Delete the job of a task being deleted, returns whether the task may be removed
+            """
+            try:
+                _delete_job(item.uuid, 5)
+                LOGGER.info("The kubernetes job of Task: %s deleted successfully", item.uuid)
+                return True
+            except ApiException as ex:
+                if ex.status == 404:
+                    return True
+                LOGGER.warning("Kubernetes ApiException %d: %s", ex.status, ex.reason)
+            except Exception as ex:
+                LOGGER.error(ex)
+            return False
+
+        def _delete_finished(uuid):
+            try:
+                _delete_job(uuid, 3)
+            except ApiException as ex:
+                if ex.status != 404:
+                    LOGGER.warning("Kubernetes ApiException %d: %s", ex.status, ex.reason)
 
         def _actual_work():
+            """
+            One round of the monitor
+            :return: whether nothing changed, and uuids of the tasks to look at again after a delay
+            """
             idle = True
+            retry = []
+            updated = []
+            logged = []  # finished tasks, whose logs are written as well
+            finished = []
+            deleted = []
+            finishing = []  # (task, pod, new status, exit code) of tasks whose logs are still to be read
+            chunks = []
             try:
-                for item in Task.objects.filter(Q(status=TASK.WAITING) | Q(status=TASK.RUNNING) |
-                                                Q(status=TASK.PENDING)).order_by("create_time"):
-                    common_name = "task-exec-{}".format(item.uuid)
+                changed = None
+                queryset = Task.objects.filter(ACTIVE_TASKS).defer('logs')
+                self.membership.heartbeat()
+                if self.job_informer.synced:
+                    # only look at tasks whose pods produced watch events since last round
+                    changed = self._pop_changed_tasks()
+                    if self._monitored_generation != self.membership.generation:
+                        # shards moved to this replica, look at all of their tasks once
+                        self._monitored_generation = self.membership.generation
+                    else:
+                        queryset = queryset.filter(uuid__in=changed)
+                for item in queryset.order_by("create_time"):
+                    if changed is not None:
+                        changed.discard(item.uuid)
+                    if not self.membership.owns(item.uuid):
+                        continue
                     try:
-                        response = api.list_namespaced_pod(namespace=KUBERNETES_NAMESPACE,
-                                                           label_selector="task-exec={}".format(item.uuid))
-                        if response.items:
-                            status = response.items[0].status.phase
+                        pods = self.job_informer.list(api, item.uuid)
+                        if pods:
+                            status = pods[0].status.phase
                             new_status = item.status
-                            deleting = response.items[0].metadata.deletion_timestamp
+                            deleting = pods[0].metadata.deletion_timestamp
                             if status == 'Running':
                                 new_status = TASK.RUNNING
                             elif status == 'Succeeded':
@@ -268,66 +521,89 @@ class TaskExecutor:
                             if new_status != item.status:
                                 if status in ('Succeeded', 'Failed'):
                                     exit_code = None
-                                    detailed_status = response.items[0].status.container_statuses
+                                    detailed_status = pods[0].status.container_statuses
                                     if detailed_status and detailed_status[0].state.terminated:
                                         exit_code = detailed_status[0].state.terminated.exit_code
                                         LOGGER.debug(exit_code)
-                                    response = api.read_namespaced_pod_log(name=response.items[0].metadata.name,
-                                                                           namespace=KUBERNETES_NAMESPACE)
-                                    if response:
-                                        item.logs = response
-                                    item.logs_get = True
-                                    if exit_code:
-                                        item.exit_code = exit_code
-                                    if exit_code == 124:  # SIGTERM by TLE
-                                        item.logs += "\nTime limit exceeded when executing job."
-                                        new_status = TASK.TLE
-                                    elif exit_code == 137:  # SIGKILL by MLE
-                                        item.logs += "\nMemory limit exceeded when executing job."
-                                        new_status = TASK.MLE
-                                    job_api.delete_namespaced_job(name=common_name,
-                                                                  namespace=KUBERNETES_NAMESPACE,
-                                                                  body=client.V1DeleteOptions(
-                                                                      propagation_policy='Foreground',
-                                                                      grace_period_seconds=3
-                                                                  ))
-                                item.status = new_status
-                                idle = False
-                                item.save(force_update=True)
+                                    finishing.append((item, pods[0], new_status, exit_code))
+                                else:
+                                    item.status = new_status
+                                    idle = False
+                                    updated.append(item)
                         # else wait for a period because it takes time for corresponding pod to be initialized
                     except ApiException as ex:
                         LOGGER.warning(ex)
-                for item in Task.objects.filter(status=TASK.DELETING):
-                    common_name = "task-exec-{}".format(item.uuid)
-                    try:
-                        _ = job_api.delete_namespaced_job(name=common_name,
-                                                          namespace=KUBERNETES_NAMESPACE,
-                                                          body=client.V1DeleteOptions(
-                                                              propagation_policy='Foreground',
-                                                              grace_period_seconds=5
-                                                          ))
-                        LOGGER.info("The kubernetes job of Task: %s deleted successfully", item.uuid)
-                        item.delete()
-                    except ApiException as ex:
-                        if ex.status == 404:
-                            item.delete()
-                        else:
-                            LOGGER.warning("Kubernetes ApiException %d: %s", ex.status, ex.reason)
-                    except Exception as ex:
-                        LOGGER.error(ex)
+                logs = self._fan_out(_read_log, finishing)
+                for (item, _, new_status, exit_code), response in zip(finishing, logs):
+                    if response is None:
+                        retry.append(item.uuid)
+                        continue
+                    chunks += response
+                    # the pod output is in the chunks, `logs` only gets messages appended to it
+                    item.logs = ''
+                    if item.log_size >= TASK_LOG_MAX_SIZE:
+                        item.logs += "\nLog truncated to {} bytes.".format(TASK_LOG_MAX_SIZE)
+                    item.logs_get = True
+                    if exit_code:
+                        item.exit_code = exit_code
+                    if exit_code == 124:  # SIGTERM by TLE
+                        item.logs += "\nTime limit exceeded when executing job."
+                        new_status = TASK.TLE
+                    elif exit_code == 137:  # SIGKILL by MLE
+                        item.logs += "\nMemory limit exceeded when executing job."
+                        new_status = TASK.MLE
+                    finished.append(item.uuid)
+                    item.status = new_status
+                    idle = False
+                    logged.append(item)
+                if changed:
+                    # pod events may arrive before the dispatcher marks the task as WAITING, keep them for later
+                    retry += Task.objects.filter(uuid__in=changed, status=TASK.SCHEDULED).values_list('uuid',
+                                                                                                      flat=True)
+                deleting = [item for item in Task.objects.filter(status=TASK.DELETING).only('id', 'uuid')
+                            if self.membership.owns(item.uuid)]
+                for item, removable in zip(deleting, self._fan_out(_delete_deleting, deleting)):
+                    if removable:
+                        deleted.append(item.id)
 
             except Exception as ex:
                 LOGGER.error(ex)
-            if idle:
-                time.sleep(1)
+            try:
+                with transaction.atomic():
+                    # chunks of an earlier attempt whose update failed are replaced
+                    TaskLogChunk.objects.filter(task__in=[row.task for row in chunks]).delete()
+                    save_chunks(chunks)
+                    bulk_save(Task, updated, ['status'])
+                    bulk_save(Task, logged, ['status', 'logs', 'logs_get', 'log_size', 'exit_code'])
+                    if deleted:
+                        Task.objects.filter(id__in=deleted).delete()
+            except Exception as ex:
+                LOGGER.error(ex)
+                # statuses are derived from pods which still exist, try again later
+                retry += [item.uuid for item in updated + logged]
+                finished = []
+            # remove finished jobs only once their results are persisted
+            try:
+                self._fan_out(_delete_finished, finished)
+            except Exception as ex:
+                LOGGER.error(ex)
+            if finished or deleted:
+                # capacity and concurrency slots were freed for queued tasks
+                self.wake_up(JOB_DISPATCH)
+            self._retry_tasks(retry)
+            return idle, retry
 
         while True:
-            _actual_work()
+            idle, retry = _actual_work()
             if self.test:
                 break
+            if retry:
+                self._wait(JOB_MONITOR, JOB_MONITOR_RETRY_DELAY)
+            elif idle:
+                # pod changes wake us up through watch events, poll only until the informer is synced
+                self._wait(JOB_MONITOR, EXECUTOR_IDLE_WAIT if self.job_informer.synced else 1)
 
-    @staticmethod
-    def get_user_vnc_pod(uuid, user):
+    def get_user_vnc_pod(self, uuid, user):
         extension_api = ExtensionsV1beta1Api(get_kubernetes_api_client())
         app_api = AppsV1Api(get_kubernetes_api_client())
         core_api = CoreV1Api(get_kubernetes_api_client())
@@ -362,15 +638,9 @@ class TaskExecutor:
             selector = "task-{}-user-{}-vnc".format(setting.uuid, user.id)
             if not has_deployment:
                 # create a new deployment
-                conf = json.loads(setting.container_config)
-                user_dir = "user_{}_task_{}".format(user.id, setting.id)
+                settings_config = get_settings_config(setting)
                 dep_name = "task-vnc-{}-{}".format(setting.uuid, get_short_uuid())
-                shared_pvc_name = "shared-{}".format(setting.uuid)
-                shared_mount = client.V1VolumeMount(mount_path=conf['persistent_volume']['mount_path'],
-                                                    name=shared_pvc_name, read_only=True)
-                user_storage_name = "user-{}".format(setting.uuid)
-                user_mount = client.V1VolumeMount(mount_path='/cloud_scheduler_userspace', name=user_storage_name,
-                                                  sub_path=user_dir)
+                user_mount = settings_config.user_mount(user.id, '/cloud_scheduler_userspace')
                 username = '{}_{}'.format(user.username, setting.id)
 
                 commands = ['set +e',
@@ -379,8 +649,7 @@ class TaskExecutor:
                             'usermod -d /headless {}'.format(username),
                             "su -s /bin/bash -c '/dockerstartup/vnc_startup.sh -w' {}".format(username)]
                 if created:
-                    cp_command = 'cp -r {}/* /headless/Desktop/user_space'.format(
-                        conf['persistent_volume']['mount_path'] + '/' + conf['task_initial_file_path'])
+                    cp_command = 'cp -r {}/* /headless/Desktop/user_space'.format(settings_config.initial_file_path)
                     chown = 'chown -R {user}:{user} /headless/Desktop/user_space/*'.format(user=username)
                     commands.insert(4, cp_command)
                     commands.insert(5, chown)
@@ -392,18 +661,11 @@ class TaskExecutor:
                     env=[env_vnc_pw],
                     command=['/bin/bash'],
                     args=['-c', ';'.join(commands)],
-                    volume_mounts=[shared_mount, user_mount]
+                    volume_mounts=[settings_config.shared_mount, user_mount]
                 )
-                persistent_volume_claim = client.V1PersistentVolumeClaimVolumeSource(claim_name=
-                                                                                     conf['persistent_volume']['name'])
-                user_volume_claim = client.V1PersistentVolumeClaimVolumeSource(claim_name=USERSPACE_NAME)
-                shared_volume = client.V1Volume(name=shared_pvc_name,
-                                                persistent_volume_claim=persistent_volume_claim)
-                user_volume = client.V1Volume(name=user_storage_name,
-                                              persistent_volume_claim=user_volume_claim)
                 template = client.V1PodTemplateSpec(
                     metadata=client.V1ObjectMeta(labels={'app': selector}),
-                    spec=client.V1PodSpec(containers=[container], volumes=[shared_volume, user_volume])
+                    spec=client.V1PodSpec(containers=[container], volumes=settings_config.volumes)
                 )
                 spec = client.V1DeploymentSpec(
                     replicas=1,
@@ -495,11 +757,12 @@ class TaskExecutor:
         finally:
             if user_vnc:
                 user_vnc.save(force_update=True)
+                if user_vnc.expire_time:
+                    self.expiry_queue.push(user_vnc.expire_time, (VNC_POD, user_vnc.id))
             return result
 
-    @staticmethod
-    def get_user_space_pod(uuid, user, recreate=False, purge=False):
-        def _recreate_space(_pod_use, _conf, _username):
+    def get_user_space_pod(self, uuid, user, recreate=False, purge=False):
+        def _recreate_space(_pod_use, _settings_config, _username):
             extra_command = 'rm -rf /home/{}/*;'.format(_username) if purge else ''
             resp = stream(api.connect_get_namespaced_pod_exec,
                           _pod_use,
@@ -510,9 +773,7 @@ class TaskExecutor:
                            '{extra_command}'
                            'cp -r {mount_path}/* /home/{user};'
                            'chown -R {user}:{user} /home/{user}/*'.format(
-                               mount_path=
-                               _conf['persistent_volume']['mount_path'] + '/' +
-                               _conf['task_initial_file_path'],
+                               mount_path=_settings_config.initial_file_path,
                                user=_username, extra_command=extra_command)],
                           stderr=True, stdin=False,
                           stdout=True, tty=False)
@@ -532,35 +793,36 @@ class TaskExecutor:
             if user_storage.pod_name:
                 # try get this pod
                 try:
-                    pod = api.read_namespaced_pod(name=user_storage.pod_name, namespace=KUBERNETES_NAMESPACE)
-                    deleting = pod.metadata.deletion_timestamp
+                    pod = self.storage_informer.read(api, user_storage.pod_name)
                     # do not get users to terminating pods
-                    if pod.status.phase == 'Running' and not deleting:
+                    if pod is not None and pod.status.phase == 'Running' and not pod.metadata.deletion_timestamp:
                         result = pod
                         user_storage.expire_time = round(time.time() + USER_SPACE_POD_TIMEOUT)
                         user_storage.save(force_update=True)
-                except ApiException as ex:
-                    if ex.status != 404:
-                        raise Exception("Unhandled ApiException")
-            conf = json.loads(setting.container_config)
+                except ApiException:
+                    raise Exception("Unhandled ApiException")
+            settings_config = get_settings_config(setting)
             if result is None:
                 # if not available, try to allocate a new one
-                response = api.list_namespaced_pod(namespace=KUBERNETES_NAMESPACE,
-                                                   label_selector="task={}".format(uuid))
                 available = None
                 # crunch available pods
-                for pod in response.items:
-                    num_in_use = int(pod.metadata.labels['occupied'])
-                    deleting = pod.metadata.deletion_timestamp
-                    if pod.status.phase == 'Running' and num_in_use < setting.max_sharing_users and not deleting:
-                        available = pod
+                pool = [pod for pod in self.storage_informer.list(api, uuid)
+                        if pod.status.phase == 'Running' and not pod.metadata.deletion_timestamp]
+                candidates = [pod for pod in pool if int(pod.metadata.labels['occupied']) < setting.max_sharing_users]
+                # reserve a slot of the preferred pod, or of the next one if others took the free slots meanwhile
+                for pod in self.placement(candidates, pool):
+                    try:
+                        available = take_slot(api, pod, setting.max_sharing_users)
+                    except ApiException as ex:
+                        LOGGER.warning(ex)
+                    if available is not None:
+                        self.storage_informer.update(available)
                         break
                 # allocate
                 if available:
                     pod_name = available.metadata.name
-                    available.metadata.labels['occupied'] = str(int(available.metadata.labels['occupied']) + 1)
                     try:
-                        user_dir = "/cloud_scheduler_userspace/user_{}_task_{}".format(user.id, setting.id)
+                        user_dir = "{}user_{}_task_{}".format(USER_DIR, user.id, setting.id)
                         LOGGER.debug("Create username %s", username)
                         commands = ['/bin/bash', '-c',
                                     'set +e;'
@@ -585,205 +847,232 @@ class TaskExecutor:
                                           stdout=True, tty=False)
                         LOGGER.debug(response)
                         if created:
-                            _recreate_space(pod_name, conf, username)
+                            _recreate_space(pod_name, settings_config, username)
                         elif recreate:
-                            _recreate_space(pod_name, conf, username)
-                        api.patch_namespaced_pod(pod_name, KUBERNETES_NAMESPACE, available)
+                            _recreate_space(pod_name, settings_config, username)
                         result = available
                         user_storage.pod_name = available.metadata.name
                         user_storage.expire_time = round(time.time() + USER_SPACE_POD_TIMEOUT)
                         user_storage.save(force_update=True)
+                        self.expiry_queue.push(user_storage.expire_time, (USER_SPACE_POD, user_storage.id))
                     except ApiException as ex:
                         LOGGER.warning(ex)
+                        # give the slot back
+                        released = free_slot(api, available)
+                        if released is not None:
+                            self.storage_informer.update(released)
             elif recreate:
-                _recreate_space(result.metadata.name, conf, username)
+                _recreate_space(result.metadata.name, settings_config, username)
         except Exception as ex:
             LOGGER.warning(ex)
             LOGGER.exception(ex)
         finally:
             return result
 
+    def _ensure_userspace(self):
+        """
+        Create the namespace and user space PVC on first use, later calls are answered from memory
+        """
+        if not self._userspace_ready:
+            create_namespace()
+            create_userspace_pvc()
+            self._userspace_ready = get_userspace_pvc()
+        return self._userspace_ready
+
+    def _memory_budget(self, api):
+        """
+        Memory that task jobs may reserve in total, None if unlimited
+        """
+        if TASK_MEMORY_CAPACITY_RATIO <= 0:
+            return None
+        memory = self.cluster_capacity.refresh(api)
+        if memory is None:
+            return None
+        return int(memory * TASK_MEMORY_CAPACITY_RATIO)
+
+    def _pop_scheduled_tasks(self, api):
+        """
+        Feed newly scheduled tasks into the dispatch queue and take the next batch to submit
+        """
+        since = self.dispatch_queue.last_id
+        if time.time() - self._dispatch_queue_synced >= DISPATCH_QUEUE_RESYNC_INTERVAL:
+            # ids are not committed in order, rescan once in a while to pick up late commits
+            since = 0
+            self._dispatch_queue_synced = time.time()
+        for row in Task.objects.filter(status=TASK.SCHEDULED, id__gt=since) \
+                .values_list('id', 'user_id', 'settings_id', 'priority'):
+            self.dispatch_queue.push(*row)
+        if not self.dispatch_queue:
+            return []
+        share = {}
+        running = {}
+        for user_id, settings_id, count in Task.objects.filter(ACTIVE_TASKS).values_list('user_id', 'settings_id') \
+                .annotate(count=Count('id')).order_by():
+            share[user_id] = share.get(user_id, 0) + count
+            running[settings_id] = running.get(settings_id, 0) + count
+        total_memory = self._memory_budget(api)
+        budget = total_memory
+        slots = {}
+        cost = {}
+        for settings in TaskSettings.objects.only('id', 'uuid', 'container_config', 'time_limit', 'max_running_tasks'):
+            if settings.max_running_tasks:
+                slots[settings.id] = max(settings.max_running_tasks - running.get(settings.id, 0), 0)
+            if total_memory is not None:
+                try:
+                    # a task larger than the whole budget still runs once the cluster is free of other tasks
+                    cost[settings.id] = min(get_settings_config(settings).memory, total_memory)
+                except ValueError:
+                    cost[settings.id] = 0
+                budget -= cost[settings.id] * running.get(settings.id, 0)
+        if budget is not None:
+            budget = max(budget, 0)
+        ids = self.dispatch_queue.pop(TASK_DISPATCH_BATCH_SIZE, share, slots, budget, cost)
+        # tasks deleted while queued are dropped here
+        order = {task_id: index for index, task_id in enumerate(ids)}
+        tasks = Task.objects.filter(id__in=ids, status=TASK.SCHEDULED).select_related('settings', 'user') \
+            .defer('logs')
+        return sorted(tasks, key=lambda item: order[item.id])
+
     def _job_dispatch(self):
-        api = BatchV1Api(get_kubernetes_api_client())
+        api = BatchV1Api(self.api_client)
+        core_api = CoreV1Api(self.api_client)
+
+        def _create_job(job):
+            try:
+                api.create_namespaced_job(namespace=KUBERNETES_NAMESPACE, body=job)
+            except ApiException as ex:
+                # job created in a previous round whose status update got lost
+                if ex.status != 409:
+                    raise
 
         def _actual_work():
+            if not self.membership.is_leader():
+                # admission needs a global view of the queue, only the leader dispatches
+                return True
             idle = True
+            updated = []
+            logged = []  # failed tasks with a message in their logs
             try:
-                for item in Task.objects.filter(status=TASK.SCHEDULED).order_by("create_time"):
+                scheduled = self._pop_scheduled_tasks(core_api)
+                if scheduled:
                     idle = False
-                    conf = json.loads(item.settings.container_config)
-                    common_name = "task-exec-{}".format(item.uuid)
-                    shared_storage_name = "shared-{}".format(item.uuid)
-                    user_storage_name = "user-{}".format(item.uuid)
-                    user_dir = "/cloud_scheduler_userspace/"
-                    create_namespace()
-                    create_userspace_pvc()
-                    if not get_userspace_pvc():
+                if scheduled and not self._ensure_userspace():
+                    for item in scheduled:
                         item.status = TASK.FAILED
                         item.logs_get = True
                         item.logs = "Failed to get user space storage"
-                        item.save(force_update=True)
-                    else:
-                        try:
-                            if not config_checker(conf):
-                                raise ValueError("Invalid config for TaskSettings: {}".format(item.settings.uuid))
-                            # kubernetes part
-                            shell = conf['shell']
-                            commands = []
-                            mem_limit = conf['memory_limit']
-                            time_limit = item.settings.time_limit
-                            working_dir = conf['working_path']
-                            image = conf['image']
-                            shared_pvc = conf['persistent_volume']['name']
-                            shared_mount_path = conf['persistent_volume']['mount_path']
-                            script_path = conf['task_script_path']
-
-                            commands.append('mkdir -p {}'.format(working_dir))
-                            commands.append('cp -r {}/* {}'.format(user_dir, working_dir))
-                            # snapshot
-                            commands.append('cp -r {}/* {}'.format(shared_mount_path + '/' + script_path,
-                                                                   working_dir))
-                            # overwrite
-                            commands.append('chmod -R +x {}'.format(working_dir))
-                            commands.append('cd {}'.format(working_dir))
-                            commands.append('timeout --signal TERM {timeout} {shell} -c \'{commands}\''.format(
-                                timeout=time_limit, shell=shell, commands=';'.join(conf['commands'])))
-
-                            shared_mount = client.V1VolumeMount(mount_path=shared_mount_path, name=shared_storage_name,
-                                                                read_only=True)
-                            user_mount = client.V1VolumeMount(mount_path='/cloud_scheduler_userspace/',
-                                                              name=user_storage_name,
-                                                              sub_path="user_{}_task_{}".format(item.user_id,
-                                                                                                item.settings_id),
-                                                              read_only=True)
-                            env_username = client.V1EnvVar(name="CLOUD_SCHEDULER_USER", value=item.user.username)
-                            env_user_uuid = client.V1EnvVar(name="CLOUD_SCHEDULER_USER_UUID", value=item.user.uuid)
-                            container_settings = {
-                                'name': 'task-container',
-                                'image': image,
-                                'volume_mounts': [shared_mount, user_mount],
-                                'command': [shell],
-                                'args': ['-c', ';'.join(commands)],
-                                'env': [env_username, env_user_uuid]
-                            }
-                            if mem_limit:
-                                container_settings['resources'] = client.V1ResourceRequirements(
-                                    limits={'memory': mem_limit})
-                            container = client.V1Container(**container_settings)
-                            persistent_volume_claim = client.V1PersistentVolumeClaimVolumeSource(claim_name=shared_pvc)
-                            user_volume_claim = client.V1PersistentVolumeClaimVolumeSource(claim_name=USERSPACE_NAME)
-                            volume = client.V1Volume(name=shared_storage_name,
-                                                     persistent_volume_claim=persistent_volume_claim)
-                            user_volume = client.V1Volume(name=user_storage_name,
-                                                          persistent_volume_claim=user_volume_claim)
-                            template = client.V1PodTemplateSpec(
-                                metadata=client.V1ObjectMeta(labels={"task-exec": item.uuid}),
-                                spec=client.V1PodSpec(restart_policy="Never",
-                                                      containers=[container],
-                                                      volumes=[volume, user_volume]))
-                            spec = client.V1JobSpec(template=template, backoff_limit=0,
-                                                    active_deadline_seconds=GLOBAL_TASK_TIME_LIMIT)
-                            job = client.V1Job(api_version="batch/v1", kind="Job",
-                                               metadata=client.V1ObjectMeta(name=common_name),
-                                               spec=spec)
-                            _ = api.create_namespaced_job(
-                                namespace=KUBERNETES_NAMESPACE,
-                                body=job
-                            )
-                            item.status = TASK.WAITING
-                            item.save(force_update=True)
-                        except ApiException as ex:
-                            LOGGER.warning("Kubernetes ApiException %d: %s", ex.status, ex.reason)
-                        except ValueError as ex:
-                            LOGGER.warning(ex)
-                            item.status = TASK.FAILED
-                            item.save(force_update=True)
-                        except Exception as ex:
-                            LOGGER.error(ex)
-                            item.status = TASK.FAILED
-                            item.save(force_update=True)
+                        logged.append(item)
+                    scheduled = []
+                futures = {}
+                for item in scheduled:
+                    try:
+                        job = get_settings_config(item.settings).build_job(item)
+                        futures[self.job_dispatcher.submit(_create_job, job)] = item
+                    except ValueError as ex:
+                        LOGGER.warning(ex)
+                        item.status = TASK.FAILED
+                        updated.append(item)
+                    except Exception as ex:
+                        LOGGER.error(ex)
+                        item.status = TASK.FAILED
+                        updated.append(item)
+                for future in as_completed(futures):
+                    item = futures[future]
+                    try:
+                        future.result()
+                        item.status = TASK.WAITING
+                        updated.append(item)
+                    except ApiException as ex:
+                        # keep it scheduled and retry next round
+                        LOGGER.warning("Kubernetes ApiException %d: %s", ex.status, ex.reason)
+                        self.dispatch_queue.push(item.id, item.user_id, item.settings_id, item.priority)
+                    except Exception as ex:
+                        LOGGER.error(ex)
+                        item.status = TASK.FAILED
+                        updated.append(item)
             except Exception as ex:
                 LOGGER.error(ex)
-            if idle:
-                time.sleep(1)
+            try:
+                bulk_save(Task, updated, ['status'])
+                bulk_save(Task, logged, ['status', 'logs', 'logs_get'])
+            except Exception as ex:
+                LOGGER.error(ex)
+            return idle
 
         while True:
-            _actual_work()
+            idle = _actual_work()
             if self.test:
                 break
+            if idle:
+                self._wait(JOB_DISPATCH, EXECUTOR_IDLE_WAIT)
 
-    @staticmethod
-    def _ttl_check(uuid):
-        api = CoreV1Api(get_kubernetes_api_client())
+    def _ttl_check(self, uuid):
+        api = CoreV1Api(self.api_client)
+
+        def create_container(_):
+            pod_name = "task-storage-{}-{}".format(item.uuid, get_short_uuid())
+            pod = settings_config.build_storage_pod(pod_name, uuid)
+            try:
+                self.storage_informer.update(api.create_namespaced_pod(namespace=KUBERNETES_NAMESPACE, body=pod))
+            except ApiException as ex:
+                LOGGER.warning(ex)
 
         def expand_container(num):
-            for _ in range(0, num):
-                pod_name = "task-storage-{}-{}".format(item.uuid, get_short_uuid())
-                shared_pvc_name = "shared-{}".format(item.uuid)
-                shared_pvc = client.V1VolumeMount(mount_path=conf['persistent_volume']['mount_path'],
-                                                  name=shared_pvc_name, read_only=True)
-                user_storage_name = "user-{}".format(item.uuid)
-                user_mount = client.V1VolumeMount(mount_path='/cloud_scheduler_userspace/', name=user_storage_name)
-                container_settings = {
-                    'name': 'task-storage-container',
-                    'image': USER_WEBSHELL_DOCKER_IMAGE,
-                    'volume_mounts': [shared_pvc, user_mount],
-                }
-                container = client.V1Container(**container_settings)
-                pvc = client.V1PersistentVolumeClaimVolumeSource(claim_name=conf['persistent_volume']['name'])
-                user_volume_claim = client.V1PersistentVolumeClaimVolumeSource(claim_name=USERSPACE_NAME)
-                volume = client.V1Volume(name=shared_pvc_name, persistent_volume_claim=pvc)
-                user_volume = client.V1Volume(name=user_storage_name,
-                                              persistent_volume_claim=user_volume_claim)
-                metadata = client.V1ObjectMeta(name=pod_name, labels={'task': uuid, 'occupied': '0'})
-                spec = client.V1PodSpec(containers=[container], restart_policy='Always', volumes=[volume, user_volume])
-                pod = client.V1Pod(api_version='v1', kind='Pod', metadata=metadata, spec=spec)
-                try:
-                    api.create_namespaced_pod(namespace=KUBERNETES_NAMESPACE, body=pod)
-                except ApiException as ex:
-                    LOGGER.warning(ex)
+            self._fan_out(create_container, range(num))
 
         def delete_single_container(_pod):
             try:
                 LOGGER.debug("Deleting pod %s", _pod.metadata.name)
                 api.delete_namespaced_pod(_pod.metadata.name, KUBERNETES_NAMESPACE)
-                _pod.metadata = client.V1ObjectMeta(name=_pod.metadata.name, labels={'task': uuid + '_deleted',
-                                                                                     'occupied': '0'})
-                api.patch_namespaced_pod(_pod.metadata.name, KUBERNETES_NAMESPACE, _pod)
+                deleted = copy.deepcopy(_pod)
+                deleted.metadata = client.V1ObjectMeta(name=_pod.metadata.name, labels={'task': uuid + '_deleted',
+                                                                                        'occupied': '0'})
+                api.patch_namespaced_pod(_pod.metadata.name, KUBERNETES_NAMESPACE, deleted)
+                self.storage_informer.update(deleted)
             except ApiException as _ex:
                 if _ex.status != 404:
                     LOGGER.warning(_ex)
 
-        def delete_all_containers(_resp):
-            for _item in _resp.items:
-                LOGGER.debug("Attempting to delete pod %s", _item.metadata.name)
-                delete_single_container(_item)
+        def delete_all_containers(_pods):
+            LOGGER.debug("Attempting to delete pods %s", [_item.metadata.name for _item in _pods])
+            self._fan_out(delete_single_container, _pods)
+
+        def delete_idle_container(_pod):
+            # claimed first, a user may have taken a slot of it since it was seen idle in the cache
+            try:
+                claimed = reclaim(api, _pod, uuid + '_deleted')
+                if claimed is None:
+                    return
+                self.storage_informer.update(claimed)
+                LOGGER.debug("Deleting pod %s", _pod.metadata.name)
+                api.delete_namespaced_pod(_pod.metadata.name, KUBERNETES_NAMESPACE)
+            except ApiException as _ex:
+                if _ex.status != 404:
+                    LOGGER.warning(_ex)
 
-        response = None
-        create_namespace()
-        create_userspace_pvc()
-        if not get_userspace_pvc():
+        if not self.membership.owns(uuid):
+            return
+        pods = []
+        if not self._ensure_userspace():
             LOGGER.error("Failed to obtain user space persistent volume.")
             return
         try:
-            response = api.list_namespaced_pod(namespace=KUBERNETES_NAMESPACE, label_selector="task={}".format(uuid))
+            pods = self.storage_informer.list(api, uuid)
             item = TaskSettings.objects.get(uuid=uuid)
-            conf = json.loads(item.container_config)
+            settings_config = get_settings_config(item)
             idle_list = []
-            usable_count = 0
+            occupied = 0
             base_count = 0
             has_error = False
-            for pod in response.items:
+            for pod in pods:
                 num_in_use = int(pod.metadata.labels['occupied'])
                 deleting = pod.metadata.deletion_timestamp
                 if pod.status.phase == 'Running' and not deleting:
                     base_count += 1
-                    if num_in_use < item.max_sharing_users:
-                        usable_count += 1
-                        if num_in_use == 0:
-                            idle_list.append(pod)
+                    occupied += num_in_use
+                    if num_in_use == 0:
+                        idle_list.append(pod)
                 elif pod.status.phase == 'Pending':
-                    usable_count += 1
                     base_count += 1
                 elif pod.status.phase == 'Succeeded' or pod.status.phase == 'Failed' or pod.status.phase == 'Unknown':
                     has_error = True
@@ -791,46 +1080,70 @@ class TaskExecutor:
 
             if has_error:
                 # if has error, stop checking this task
-                delete_all_containers(response)
+                delete_all_containers(pods)
                 LOGGER.error("Task %s is not runnable, please check settings", uuid)
-                schedule.clear(uuid)
+                self.ttl_scheduler.remove(uuid)
                 return
-            # initial bootstrap
-            if base_count <= item.replica:
-                expand_container(item.replica - base_count)
-            # expand if usable too few
-            if usable_count < 1:
-                expand_container(base_count)
-            # shrink if too many idles
-            if base_count > item.replica and len(idle_list) > base_count // 2:
-                delete_single_container(idle_list[0])
-            LOGGER.debug("TTL CHECK with %s, usable: %d, total: %d, idle: %d",
-                         uuid, usable_count, base_count, len(idle_list))
+            target = self.pool_autoscaler.target(uuid, occupied, item.max_sharing_users, item.replica,
+                                                 item.ttl_interval)
+            if target > base_count:
+                expand_container(target - base_count)
+            elif target < base_count:
+                # only pods nobody uses are reclaimed, pending ones become usable soon
+                self._fan_out(delete_idle_container, idle_list[:base_count - target])
+            LOGGER.debug("TTL CHECK with %s, occupied: %d, total: %d, idle: %d, target: %d",
+                         uuid, occupied, base_count, len(idle_list), target)
 
         except TaskSettings.DoesNotExist:
             # delete all related pods
-            delete_all_containers(response)
-            schedule.clear(uuid)
+            delete_all_containers(pods)
+            self.pool_autoscaler.forget(uuid)
+            self.ttl_scheduler.remove(uuid)
+        except ValueError as ex:
+            LOGGER.warning(ex)
         except ApiException as ex:
             LOGGER.warning(ex)
 
     def schedule_task_settings(self, item):
+        self._scheduled_settings[item.uuid] = (item.ttl_interval, item.container_config)
         try:
-            if config_checker(json.loads(item.container_config)):
-                schedule.clear(item.uuid)
-                schedule.every(item.ttl_interval).seconds.do(self._run_job,
-                                                             fn=self._ttl_check, uuid=item.uuid).tag(item.uuid)
-            else:
-                LOGGER.warning("Task %s has invalid settings, ignored...", item.uuid)
+            get_settings_config(item)
+            self.ttl_scheduler.add(item.uuid, item.ttl_interval, functools.partial(self._ttl_check, item.uuid))
         except ValueError:
-            LOGGER.warning("Task %s has settings that is not JSON, ignored...", item.uuid)
+            LOGGER.warning("Task %s has invalid settings, ignored...", item.uuid)
+
+    def _sync_task_settings(self):
+        """
+        Schedule task settings created or changed through other processes, e.g. API servers not running an executor
+        """
+        existing = set()
+        for item in TaskSettings.objects.only('uuid', 'ttl_interval', 'container_config', 'time_limit'):
+            existing.add(item.uuid)
+            if self._scheduled_settings.get(item.uuid, None) != (item.ttl_interval, item.container_config):
+                self.schedule_task_settings(item)
+        # TTL checks of deleted settings clean up their pods and unschedule themselves
+        for uuid in set(self._scheduled_settings) - existing:
+            del self._scheduled_settings[uuid]
+        self._settings_synced = time.time()
+
+    def _log_ttl_stats(self):
+        stats = self.ttl_scheduler.stats()
+        LOGGER.info("TTL checks: %d scheduled, %d running, %d overdue, %d runs, %d coalesced, max lag %.1f seconds",
+                    stats['scheduled'], stats['running'], stats['overdue'], stats['runs'], stats['coalesced'],
+                    stats['max_lag'])
 
     def dispatch(self):
-        for item in TaskSettings.objects.all():
-            self.schedule_task_settings(item)
+        self._sync_task_settings()
         self.ready = True
         while True:
-            schedule.run_pending()
-            time.sleep(0.01)
+            if time.time() - self._settings_synced >= SETTINGS_SYNC_INTERVAL:
+                self._sync_task_settings()
+                self._log_ttl_stats()
+            self.ttl_scheduler.run_pending()
             if self.test:
                 break
+            timeout = SETTINGS_SYNC_INTERVAL - (time.time() - self._settings_synced)
+            next_due = self.ttl_scheduler.next_due()
+            if next_due is not None:
+                timeout = min(timeout, next_due - time.time())
+            self._wait(TTL_SCHEDULER, max(timeout, 0))
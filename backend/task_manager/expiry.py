@@ -0,0 +1,64 @@
+"""
+In-memory queue of user space and VNC pod expirations
+"""
+import heapq
+from threading import Lock
+
+
+class ExpiryQueue:
+    """
+    Min-heap of (expire time, key) so that the storage monitor only looks at pods that are due.
+
+    Entries are hints: the database stays the source of truth, and keys popped by `pop_due` must be checked
+    against it. Extending an expiration therefore needs no push, as the monitor re-queues a popped key whose
+    expire time moved forward, while earlier or new expirations must be pushed to be seen in time.
+    Every key has at most one live entry, superseded entries are skipped lazily when they reach the top.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._scheduled = {}  # key -> expire time of its live entry
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def __contains__(self, key):
+        return key in self._scheduled
+
+    def push(self, expire_time, key):
+        """
+        Schedule `key` at `expire_time`, unless it is already scheduled no later than that
+        """
+        with self._lock:
+            scheduled = self._scheduled.get(key, None)
+            if scheduled is not None and scheduled <= expire_time:
+                return
+            self._scheduled[key] = expire_time
+            heapq.heappush(self._heap, (expire_time, key))
+
+    def _discard_stale(self):
+        while self._heap and self._scheduled.get(self._heap[0][1], None) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now):
+        """
+        Remove and return the keys scheduled at or before `now`
+        """
+        result = []
+        with self._lock:
+            self._discard_stale()
+            while self._heap and self._heap[0][0] <= now:
+                _, key = heapq.heappop(self._heap)
+                del self._scheduled[key]
+                result.append(key)
+                self._discard_stale()
+        return result
+
+    def next_expire(self):
+        """
+        Earliest scheduled expire time, None if the queue is empty
+        """
+        with self._lock:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
@@ -0,0 +1,169 @@
+"""
+Watch-backed pod cache
+"""
+import time
+import logging
+from threading import Lock
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+from config import KUBERNETES_NAMESPACE
+
+LOGGER = logging.getLogger(__name__)
+
+WATCH_TIMEOUT = 300  # seconds before a watch is re-established from the last resource version
+
+
+class PodInformer:
+    """
+    Local cache of the pods carrying a given label, indexed by the value of that label.
+
+    The cache is filled by a single list call and then kept up to date with a watch resumed from the last
+    seen `resourceVersion`, so readers only hit the API server again when the watch expires (410 Gone).
+    Until the first list succeeds, `list` falls back to querying the API server directly.
+    """
+
+    def __init__(self, label, namespace=KUBERNETES_NAMESPACE):
+        self.label = label
+        self.namespace = namespace
+        self.synced = False
+        self.resource_version = None
+        self._lock = Lock()
+        self._pods = {}  # pod name -> pod
+        self._index = {}  # label value -> {pod name: pod}
+        self._handlers = []
+
+    def add_handler(self, handler):
+        """
+        Register `handler(event_type, pod)`, called after every change applied to the cache
+        """
+        self._handlers.append(handler)
+
+    def _key(self, pod):
+        labels = pod.metadata.labels or {}
+        return labels.get(self.label, None)
+
+    def _remove(self, name):
+        old = self._pods.pop(name, None)
+        if old is not None:
+            key = self._key(old)
+            bucket = self._index.get(key, {})
+            bucket.pop(name, None)
+            if not bucket:
+                self._index.pop(key, None)
+        return old
+
+    def _notify(self, event_type, pod):
+        for handler in self._handlers:
+            try:
+                handler(event_type, pod)
+            except Exception as ex:
+                LOGGER.error(ex)
+
+    def apply(self, event_type, pod):
+        """
+        Apply a single watch event (`ADDED`, `MODIFIED` or `DELETED`) to the cache
+        """
+        name = pod.metadata.name
+        with self._lock:
+            self._remove(name)
+            if event_type != 'DELETED':
+                self._pods[name] = pod
+                self._index.setdefault(self._key(pod), {})[name] = pod
+        self._notify(event_type, pod)
+
+    def update(self, pod):
+        """
+        Write back an object returned by our own create/patch calls before its watch event arrives
+        """
+        if pod is not None and getattr(pod, 'metadata', None) is not None:
+            self.apply('MODIFIED', pod)
+
+    def replace(self, pods, resource_version):
+        """
+        Replace the whole cache with the result of a list call
+        """
+        names = {pod.metadata.name for pod in pods}
+        with self._lock:
+            removed = [pod for name, pod in self._pods.items() if name not in names]
+            self._pods = {}
+            self._index = {}
+            for pod in pods:
+                self._pods[pod.metadata.name] = pod
+                self._index.setdefault(self._key(pod), {})[pod.metadata.name] = pod
+        self.resource_version = resource_version
+        self.synced = True
+        for pod in removed:
+            self._notify('DELETED', pod)
+        for pod in pods:
+            self._notify('MODIFIED', pod)
+
+    def get(self, value):
+        """
+        Cached pods whose label equals `value`
+        """
+        with self._lock:
+            return list(self._index.get(value, {}).values())
+
+    def list(self, api, value):
+        """
+        Pods whose label equals `value`, served from cache once synced and from the API server otherwise
+        """
+        if self.synced:
+            return self.get(value)
+        response = api.list_namespaced_pod(namespace=self.namespace,
+                                           label_selector="{}={}".format(self.label, value))
+        return response.items
+
+    def read(self, api, name):
+        """
+        Pod named `name`, or None if it does not exist
+        """
+        if self.synced:
+            with self._lock:
+                return self._pods.get(name, None)
+        try:
+            return api.read_namespaced_pod(name=name, namespace=self.namespace)
+        except ApiException as ex:
+            if ex.status != 404:
+                raise
+            return None
+
+    def resync(self, api):
+        response = api.list_namespaced_pod(namespace=self.namespace, label_selector=self.label)
+        self.replace(response.items, response.metadata.resource_version)
+        LOGGER.debug("Informer for label %s synced with %d pods", self.label, len(response.items))
+
+    def watch(self, api, timeout_seconds=WATCH_TIMEOUT):
+        """
+        Stream changes since the last seen resource version.
+        :return: False if the resource version expired and a relist is required
+        """
+        pod_watch = watch.Watch()
+        try:
+            for event in pod_watch.stream(api.list_namespaced_pod, namespace=self.namespace,
+                                          label_selector=self.label, resource_version=self.resource_version,
+                                          timeout_seconds=timeout_seconds):
+                if event['type'] == 'ERROR':
+                    LOGGER.info("Watch on label %s expired: %s", self.label, event['raw_object'])
+                    return False
+                self.apply(event['type'], event['object'])
+                self.resource_version = event['object'].metadata.resource_version
+        except ApiException as ex:
+            if ex.status == 410:
+                return False
+            raise
+        return True
+
+    def run(self, api, test=False):
+        while True:
+            try:
+                if not self.synced:
+                    self.resync(api)
+                if not self.watch(api):
+                    self.synced = False
+            except Exception as ex:
+                # keep serving the cache and resume from the last resource version
+                LOGGER.warning(ex)
+                time.sleep(1)
+            if test:
+                break
@@ -0,0 +1,158 @@
+"""
+Leader election and sharding between TaskExecutor replicas
+"""
+import os
+import math
+import time
+import zlib
+import socket
+import logging
+from uuid import uuid4
+from threading import Lock
+from django.db import transaction
+from django.db.models import Q
+from django.db.utils import IntegrityError
+from config import EXECUTOR_SHARDS, EXECUTOR_LEASE_DURATION
+from .models import ExecutorLease
+
+LOGGER = logging.getLogger(__name__)
+
+LEADER_LEASE = 'leader'
+MEMBER_LEASE_PREFIX = 'member-'
+
+
+def shard_of(key, shards=EXECUTOR_SHARDS):
+    """
+    Shard of `key`, stable across processes unlike `hash`
+    """
+    return zlib.crc32(str(key).encode()) % shards
+
+
+def shard_lease(shard):
+    return 'shard-{}'.format(shard)
+
+
+class ExecutorMembership:
+    """
+    Leases held by this replica, stored as rows of ExecutorLease.
+
+    A lease is taken or renewed with a single conditional UPDATE, so at most one replica holds it at a time.
+    One replica holds the leader lease and runs the loops that need a global view (task admission), while
+    shards of tasks and task settings are spread over all live replicas. Leases of a dead replica expire
+    after `duration` seconds and are picked up by the others on their next renewal.
+    """
+
+    def __init__(self, shards=EXECUTOR_SHARDS, duration=EXECUTOR_LEASE_DURATION, identity=None):
+        self.shard_count = shards
+        self.duration = duration
+        self.renew_interval = duration / 3
+        self.identity = identity or '{}-{}'.format(socket.gethostname(), os.getpid())
+        # announces this replica to the others even while it holds no other lease
+        self.member_lease = MEMBER_LEASE_PREFIX + uuid4().hex[:16]
+        self.shards = frozenset()
+        self.generation = 0  # bumped whenever the set of owned shards changes
+        self._leader = False
+        self._expire_time = 0
+        self._renewed = 0
+        self._lock = Lock()
+
+    def _acquire(self, name, now):
+        expire_time = now + self.duration
+        if ExecutorLease.objects.filter(Q(holder=self.identity) | Q(expire_time__lt=now), name=name) \
+                .update(holder=self.identity, expire_time=expire_time):
+            return True
+        try:
+            with transaction.atomic():
+                ExecutorLease.objects.create(name=name, holder=self.identity, expire_time=expire_time)
+            return True
+        except IntegrityError:
+            return False
+
+    def _release(self, name):
+        ExecutorLease.objects.filter(name=name, holder=self.identity).update(expire_time=0)
+
+    def renew(self):
+        """
+        Renew held leases, pick up expired ones and hand over shards above the fair share of this replica
+        """
+        with self._lock:
+            now = time.time()
+            self._acquire(self.member_lease, now)
+            # forget replicas gone for a while
+            ExecutorLease.objects.filter(name__startswith=MEMBER_LEASE_PREFIX,
+                                         expire_time__lt=now - self.duration).delete()
+            leases = {lease.name: lease for lease in ExecutorLease.objects.all()}
+            leader = self._acquire(LEADER_LEASE, now)
+            if leader and not self._leader:
+                LOGGER.info("Executor %s became the leader", self.identity)
+            live = {lease.holder for lease in leases.values() if lease.expire_time >= now}
+            live.add(self.identity)
+            target = math.ceil(self.shard_count / len(live))
+            owned = set()
+            # keep our own shards first so that ownership stays stable
+            for shard in range(self.shard_count):
+                lease = leases.get(shard_lease(shard), None)
+                if lease is not None and lease.holder == self.identity:
+                    if len(owned) < target and self._acquire(shard_lease(shard), now):
+                        owned.add(shard)
+                    else:
+                        self._release(shard_lease(shard))
+            for shard in range(self.shard_count):
+                if len(owned) >= target:
+                    break
+                lease = leases.get(shard_lease(shard), None)
+                if shard not in owned and (lease is None or lease.expire_time < now) and \
+                        self._acquire(shard_lease(shard), now):
+                    owned.add(shard)
+            if owned != self.shards:
+                LOGGER.info("Executor %s owns shards %s", self.identity, sorted(owned))
+                self.shards = frozenset(owned)
+                self.generation += 1
+            self._leader = leader
+            # stop acting on our leases a bit before others may take them over
+            self._expire_time = now + self.duration - self.renew_interval
+            self._renewed = now
+
+    def heartbeat(self):
+        """
+        Renew the leases if the last renewal is older than `renew_interval`
+        """
+        if time.time() - self._renewed >= self.renew_interval:
+            try:
+                self.renew()
+            except Exception as ex:
+                LOGGER.error(ex)
+                self._renewed = time.time()
+
+    def _valid(self):
+        # leases we failed to renew are considered lost once they expire
+        return time.time() < self._expire_time
+
+    def is_leader(self):
+        self.heartbeat()
+        return self._leader and self._valid()
+
+    def owns(self, key):
+        """
+        Whether the task or task settings identified by uuid `key` is handled by this replica
+        """
+        self.heartbeat()
+        return self._valid() and shard_of(key, self.shard_count) in self.shards
+
+    def release(self):
+        with self._lock:
+            for name in [self.member_lease, LEADER_LEASE] + [shard_lease(shard) for shard in self.shards]:
+                self._release(name)
+            self._leader = False
+            self.shards = frozenset()
+            self.generation += 1
+
+    def run(self, test=False):
+        while True:
+            try:
+                self.renew()
+            except Exception as ex:
+                LOGGER.error(ex)
+            if test:
+                break
+            time.sleep(self.renew_interval)
@@ -0,0 +1,22 @@
+"""
+Run the task executor outside of the development server
+"""
+import os
+import time
+from django.core.management.base import BaseCommand
+from task_manager.executor import TaskExecutor
+
+
+class Command(BaseCommand):
+    help = "Start a task executor replica and keep it running"
+
+    def handle(self, *args, **options):
+        executor = TaskExecutor.instance()
+        executor.start()
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            # hand over leases right away instead of waiting for them to expire
+            executor.membership.release()
+            os._exit(0)
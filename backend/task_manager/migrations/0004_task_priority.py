@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0003_task_exit_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='priority',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tasksettings',
+            name='max_running_tasks',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
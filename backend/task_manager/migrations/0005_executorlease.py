@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0004_task_priority'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExecutorLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=50, unique=True)),
+                ('holder', models.CharField(max_length=255)),
+                ('expire_time', models.FloatField(default=0)),
+            ],
+        ),
+    ]
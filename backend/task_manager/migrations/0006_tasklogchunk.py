@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0005_executorlease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='log_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='TaskLogChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('offset', models.BigIntegerField()),
+                ('end', models.BigIntegerField()),
+                ('data', models.BinaryField()),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='log_chunks', to='task_manager.Task')),
+            ],
+            options={
+                'unique_together': {('task', 'offset')},
+            },
+        ),
+    ]
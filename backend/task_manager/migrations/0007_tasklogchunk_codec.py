@@ -0,0 +1,50 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:02
+
+import zlib
+from django.db import migrations, models
+
+CHUNK_SIZE = 65536
+
+
+def compress_logs(apps, _):
+    """
+    Move logs stored as text in Task.logs into compressed chunks
+    """
+    Task = apps.get_model('task_manager', 'Task')
+    TaskLogChunk = apps.get_model('task_manager', 'TaskLogChunk')
+    for task in Task.objects.filter(log_size=0).exclude(logs='').iterator():
+        data = task.logs.encode()
+        rows = []
+        for offset in range(0, len(data), CHUNK_SIZE):
+            chunk = data[offset:offset + CHUNK_SIZE]
+            rows.append(TaskLogChunk(task=task, offset=offset, end=offset + len(chunk), codec='zlib',
+                                     data=zlib.compress(chunk)))
+        TaskLogChunk.objects.bulk_create(rows)
+        Task.objects.filter(id=task.id).update(logs='', log_size=len(data))
+
+
+def decompress_logs(apps, _):
+    Task = apps.get_model('task_manager', 'Task')
+    TaskLogChunk = apps.get_model('task_manager', 'TaskLogChunk')
+    for task in Task.objects.exclude(log_size=0).iterator():
+        data = b''.join(zlib.decompress(bytes(chunk)) if codec == 'zlib' else bytes(chunk)
+                        for codec, chunk in TaskLogChunk.objects.filter(task=task).order_by('offset')
+                        .values_list('codec', 'data'))
+        Task.objects.filter(id=task.id).update(logs=data.decode(errors='replace') + task.logs, log_size=0)
+        TaskLogChunk.objects.filter(task=task).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0006_tasklogchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tasklogchunk',
+            name='codec',
+            field=models.CharField(default='', max_length=10),
+        ),
+        migrations.RunPython(compress_logs, decompress_logs),
+    ]
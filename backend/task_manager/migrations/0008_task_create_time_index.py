@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0007_tasklogchunk_codec'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='task',
+            name='create_time',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -28,6 +28,8 @@ class TaskSettings(models.Model):
     replica = models.PositiveIntegerField(default=1)
     ttl_interval = models.PositiveIntegerField(default=2)
     max_sharing_users = models.PositiveIntegerField(default=1)
+    # max number of tasks running at the same time, 0 means unlimited
+    max_running_tasks = models.PositiveIntegerField(default=0)
     # meta data
     create_time = models.DateTimeField(auto_now_add=True, db_index=True)
 
@@ -38,10 +40,34 @@ class Task(models.Model):
     user = models.ForeignKey(user_models.UserModel, on_delete=models.PROTECT)
     settings = models.ForeignKey(TaskSettings, on_delete=models.PROTECT)
     status = models.PositiveSmallIntegerField(default=TASK.SCHEDULED)
-    create_time = models.DateTimeField(auto_now_add=True)
+    create_time = models.DateTimeField(auto_now_add=True, db_index=True)
     logs = models.TextField()
     logs_get = models.BooleanField(default=False)
     exit_code = models.IntegerField(default=0)
+    # tasks with higher priority are dispatched first
+    priority = models.IntegerField(default=0)
+    # bytes of pod output stored in TaskLogChunk, `logs` holds messages of the scheduler appended after them
+    log_size = models.BigIntegerField(default=0)
+
+
+class TaskLogChunk(models.Model):
+    """Piece of the output of a task pod, bytes [offset, end) of it"""
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='log_chunks')
+    offset = models.BigIntegerField()
+    end = models.BigIntegerField()
+    # compression of `data`, empty if it is stored as is
+    codec = models.CharField(max_length=10, default='')
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = ('task', 'offset')
+
+
+class ExecutorLease(models.Model):
+    """Lease held by a TaskExecutor replica, either the leader lease or the lease of a shard"""
+    name = models.CharField(max_length=50, unique=True, db_index=True)
+    holder = models.CharField(max_length=255)
+    expire_time = models.FloatField(default=0)
 
 
 class TaskStorage(models.Model):
@@ -0,0 +1,56 @@
+"""
+Placement of users onto shared webshell storage pods
+"""
+
+
+def occupied(pod):
+    return int(pod.metadata.labels['occupied'])
+
+
+def node_of(pod):
+    return pod.spec.node_name if pod.spec is not None else None
+
+
+def pack(candidates, _pool):
+    """
+    Most occupied pod first, so that users are packed densely and the remaining pods drain to be reclaimed
+    """
+    return sorted(candidates, key=lambda pod: (-occupied(pod), pod.metadata.name))
+
+
+def spread(candidates, _pool):
+    """
+    Least occupied pod first, so that users share pods with as few others as possible
+    """
+    return sorted(candidates, key=lambda pod: (occupied(pod), pod.metadata.name))
+
+
+def node_pack(candidates, pool):
+    """
+    Pods on the node with most users of the pool first, then most occupied pod first, so that whole nodes drain
+    """
+    load = {}
+    for pod in pool:
+        load[node_of(pod)] = load.get(node_of(pod), 0) + occupied(pod)
+    return sorted(candidates, key=lambda pod: (-load[node_of(pod)], -occupied(pod), pod.metadata.name))
+
+
+PLACEMENT_STRATEGIES = {
+    'pack': pack,
+    'spread': spread,
+    'node_pack': node_pack,
+}
+
+
+def get_placement_strategy(strategy):
+    """
+    Placement strategy registered as `strategy`, or `strategy` itself if it is a callable.
+    A strategy is called with the pods that have a free slot and all pods of the pool, and returns the former
+    ordered by preference.
+    :raise ValueError: if no strategy is registered as `strategy`
+    """
+    if callable(strategy):
+        return strategy
+    if strategy not in PLACEMENT_STRATEGIES:
+        raise ValueError("Unknown placement strategy: {}".format(strategy))
+    return PLACEMENT_STRATEGIES[strategy]
@@ -0,0 +1,151 @@
+"""
+Parsed and validated container config of TaskSettings
+"""
+import json
+from threading import Lock
+from kubernetes import client
+from api.common import USERSPACE_NAME
+from config import GLOBAL_TASK_TIME_LIMIT, USER_WEBSHELL_DOCKER_IMAGE
+from .capacity import parse_quantity
+
+USER_DIR = '/cloud_scheduler_userspace/'
+
+
+def config_checker(json_config):
+    try:
+        pre_check_fail = ('image' not in json_config.keys() or
+                          'persistent_volume' not in json_config.keys() or
+                          'name' not in json_config['persistent_volume'].keys() or
+                          'mount_path' not in json_config['persistent_volume'].keys() or
+                          'working_path' not in json_config.keys() or
+                          'shell' not in json_config.keys() or
+                          'memory_limit' not in json_config.keys() or
+                          'commands' not in json_config.keys() or
+                          'task_script_path' not in json_config.keys() or
+                          'task_initial_file_path' not in json_config.keys() or
+                          not isinstance(json_config['commands'], list))
+        return not pre_check_fail
+    except Exception as _:
+        return False
+
+
+class SettingsConfig:
+    """
+    Container config of one TaskSettings together with the Kubernetes objects derived from it.
+
+    Instances are shared between threads, so the prebuilt objects must never be modified in place.
+    """
+
+    def __init__(self, settings):
+        conf = json.loads(settings.container_config)
+        if not config_checker(conf):
+            raise ValueError("Invalid config for TaskSettings: {}".format(settings.uuid))
+        self.source = (settings.container_config, settings.time_limit)
+        self.settings_id = settings.id
+        self.conf = conf
+        self.shell = conf['shell']
+        self.image = conf['image']
+        self.mem_limit = conf['memory_limit']
+        # memory reserved by every task job in bytes
+        self.memory = parse_quantity(self.mem_limit) if self.mem_limit else 0
+        self.mount_path = conf['persistent_volume']['mount_path']
+        self.initial_file_path = self.mount_path + '/' + conf['task_initial_file_path']
+        working_dir = conf['working_path']
+        commands = ['mkdir -p {}'.format(working_dir),
+                    'cp -r {}/* {}'.format(USER_DIR, working_dir),
+                    # snapshot
+                    'cp -r {}/* {}'.format(self.mount_path + '/' + conf['task_script_path'], working_dir),
+                    # overwrite
+                    'chmod -R +x {}'.format(working_dir),
+                    'cd {}'.format(working_dir),
+                    'timeout --signal TERM {timeout} {shell} -c \'{commands}\''.format(
+                        timeout=settings.time_limit, shell=self.shell, commands=';'.join(conf['commands']))]
+        self.job_args = ['-c', ';'.join(commands)]
+        self.job_resources = None
+        if self.mem_limit:
+            self.job_resources = client.V1ResourceRequirements(limits={'memory': self.mem_limit})
+        self.shared_storage_name = "shared-{}".format(settings.uuid)
+        self.user_storage_name = "user-{}".format(settings.uuid)
+        self.shared_mount = client.V1VolumeMount(mount_path=self.mount_path, name=self.shared_storage_name,
+                                                 read_only=True)
+        persistent_volume_claim = client.V1PersistentVolumeClaimVolumeSource(
+            claim_name=conf['persistent_volume']['name'])
+        user_volume_claim = client.V1PersistentVolumeClaimVolumeSource(claim_name=USERSPACE_NAME)
+        self.volumes = [client.V1Volume(name=self.shared_storage_name, persistent_volume_claim=persistent_volume_claim),
+                        client.V1Volume(name=self.user_storage_name, persistent_volume_claim=user_volume_claim)]
+        self.storage_container = client.V1Container(
+            name='task-storage-container',
+            image=USER_WEBSHELL_DOCKER_IMAGE,
+            volume_mounts=[self.shared_mount,
+                           client.V1VolumeMount(mount_path=USER_DIR, name=self.user_storage_name)])
+
+    def user_mount(self, user_id, mount_path, read_only=None):
+        """
+        Mount of the directory of `user_id` in the user space volume
+        """
+        return client.V1VolumeMount(mount_path=mount_path,
+                                    name=self.user_storage_name,
+                                    sub_path="user_{}_task_{}".format(user_id, self.settings_id),
+                                    read_only=read_only)
+
+    def build_job(self, item):
+        """
+        Job manifest for task `item`
+        """
+        env_username = client.V1EnvVar(name="CLOUD_SCHEDULER_USER", value=item.user.username)
+        env_user_uuid = client.V1EnvVar(name="CLOUD_SCHEDULER_USER_UUID", value=item.user.uuid)
+        container = client.V1Container(name='task-container',
+                                       image=self.image,
+                                       volume_mounts=[self.shared_mount,
+                                                      self.user_mount(item.user_id, USER_DIR, read_only=True)],
+                                       command=[self.shell],
+                                       args=self.job_args,
+                                       env=[env_username, env_user_uuid],
+                                       resources=self.job_resources)
+        template = client.V1PodTemplateSpec(
+            metadata=client.V1ObjectMeta(labels={"task-exec": item.uuid}),
+            spec=client.V1PodSpec(restart_policy="Never",
+                                  containers=[container],
+                                  volumes=self.volumes))
+        spec = client.V1JobSpec(template=template, backoff_limit=0, active_deadline_seconds=GLOBAL_TASK_TIME_LIMIT)
+        return client.V1Job(api_version="batch/v1", kind="Job",
+                            metadata=client.V1ObjectMeta(name="task-exec-{}".format(item.uuid)),
+                            spec=spec)
+
+    def build_storage_pod(self, pod_name, uuid):
+        """
+        Webshell storage pod manifest for TaskSettings `uuid`
+        """
+        metadata = client.V1ObjectMeta(name=pod_name, labels={'task': uuid, 'occupied': '0'})
+        spec = client.V1PodSpec(containers=[self.storage_container], restart_policy='Always', volumes=self.volumes)
+        return client.V1Pod(api_version='v1', kind='Pod', metadata=metadata, spec=spec)
+
+
+_CACHE = {}  # settings uuid -> (source, SettingsConfig or ValueError)
+_CACHE_LOCK = Lock()
+
+
+def get_settings_config(settings):
+    """
+    Cached SettingsConfig of `settings`, rebuilt whenever the config it was parsed from changes
+    :raise ValueError: if the container config is not JSON or fails `config_checker`
+    """
+    source = (settings.container_config, settings.time_limit)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(settings.uuid, None)
+    if cached is None or cached[0] != source:
+        try:
+            result = SettingsConfig(settings)
+        except ValueError as ex:
+            result = ex
+        cached = (source, result)
+        with _CACHE_LOCK:
+            _CACHE[settings.uuid] = cached
+    if isinstance(cached[1], ValueError):
+        raise cached[1]
+    return cached[1]
+
+
+def invalidate_settings_config(uuid):
+    with _CACHE_LOCK:
+        _CACHE.pop(uuid, None)
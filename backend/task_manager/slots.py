@@ -0,0 +1,68 @@
+"""
+User slots of shared webshell storage pods, counted by their `occupied` label
+"""
+import logging
+from kubernetes.client.rest import ApiException
+from config import KUBERNETES_NAMESPACE
+
+LOGGER = logging.getLogger(__name__)
+
+PATCH_ATTEMPTS = 5  # conditional patches of one pod before giving up on it
+
+
+def _patch_occupied(api, pod, delta, limit=None):
+    """
+    Change the `occupied` label of `pod` by `delta`.
+    The patch carries the resourceVersion the count was read from, so the API server rejects it if anybody
+    changed the pod in between, in which case the pod is read again and the patch retried.
+    :return: the patched pod, None if the label would exceed `limit`, the pod is going away or was reclaimed from
+    its task, or kept changing
+    :raise ApiException: on errors other than conflicts, e.g. 404 if the pod is gone
+    """
+    task = pod.metadata.labels.get('task', None)
+    for attempt in range(PATCH_ATTEMPTS):
+        if attempt:
+            pod = api.read_namespaced_pod(name=pod.metadata.name, namespace=KUBERNETES_NAMESPACE)
+        if pod.metadata.deletion_timestamp or pod.metadata.labels.get('task', None) != task:
+            return None
+        occupied = max(int(pod.metadata.labels['occupied']) + delta, 0)
+        if limit is not None and occupied > limit:
+            return None
+        body = {'metadata': {'labels': {'occupied': str(occupied)},
+                             'resourceVersion': pod.metadata.resource_version}}
+        try:
+            return api.patch_namespaced_pod(pod.metadata.name, KUBERNETES_NAMESPACE, body)
+        except ApiException as ex:
+            if ex.status != 409:
+                raise
+            LOGGER.debug("Conflict on slots of pod %s", pod.metadata.name)
+    return None
+
+
+def take_slot(api, pod, limit):
+    """
+    Reserve a slot of `pod` for a user if it has less than `limit` users
+    """
+    return _patch_occupied(api, pod, 1, limit)
+
+
+def free_slot(api, pod):
+    return _patch_occupied(api, pod, -1)
+
+
+def reclaim(api, pod, task):
+    """
+    Move the idle `pod` out of its task by relabeling it as `task`, before deleting it.
+    The patch carries the resourceVersion the pod was seen idle at, so either it or a concurrent `take_slot` fails.
+    :return: the patched pod, None if anybody changed the pod in between
+    :raise ApiException: on errors other than conflicts, e.g. 404 if the pod is gone
+    """
+    body = {'metadata': {'labels': {'task': task, 'occupied': '0'},
+                         'resourceVersion': pod.metadata.resource_version}}
+    try:
+        return api.patch_namespaced_pod(pod.metadata.name, KUBERNETES_NAMESPACE, body)
+    except ApiException as ex:
+        if ex.status != 409:
+            raise
+        LOGGER.debug("Pod %s changed before being reclaimed", pod.metadata.name)
+    return None
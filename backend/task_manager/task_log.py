@@ -0,0 +1,361 @@
+"""
+Task logs, stored in size-capped chunks and read by byte ranges
+"""
+import math
+import time
+import zlib
+import codecs
+import logging
+from collections import deque
+from threading import Thread, Lock
+from kubernetes.client import CoreV1Api
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import HTTPError
+from api.common import get_kubernetes_api_client
+from config import KUBERNETES_NAMESPACE, TASK_LOG_CHUNK_SIZE, TASK_LOG_MAX_SIZE, TASK_LOG_COMPRESSION_LEVEL, \
+    TASK_LOG_PAGE_SIZE, TASK_LOG_FOLLOW_TIMEOUT, TASK_LOG_TAIL_SECONDS, TASK_LOG_LIVE_READ_SIZE
+from .models import TaskLogChunk
+
+LOGGER = logging.getLogger(__name__)
+
+INSERT_BATCH_BYTES = 2 << 20  # keeps INSERT statements of chunks well below max_allowed_packet of MySQL
+TAIL_RESUME_ATTEMPTS = 3  # reconnections of a log tail in a row without output before giving up
+
+# decompression functions by codec of stored chunks
+DECODERS = {
+    '': bytes,
+    'zlib': zlib.decompress,
+}
+
+
+def _stream_pod_log(api, name, **kwargs):
+    """
+    Pieces of the log of pod `name` as the API server sends them, so that it is never loaded whole
+    """
+    response = api.read_namespaced_pod_log(name=name, namespace=KUBERNETES_NAMESPACE, _preload_content=False,
+                                           **kwargs)
+    drained = False
+    try:
+        yield from response.stream(TASK_LOG_CHUNK_SIZE)
+        drained = True
+    finally:
+        if not drained:
+            # the rest of the body is not wanted, the connection cannot be reused
+            response.close()
+        response.release_conn()
+
+
+def split_chunks(pieces, size=TASK_LOG_CHUNK_SIZE):
+    """
+    Regroup byte `pieces` into chunks of `size` bytes, the last one may be shorter
+    """
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def capture_pod_log(api, name):
+    """
+    Log of the finished pod `name` in chunks, at most TASK_LOG_MAX_SIZE bytes of it
+    """
+    return list(split_chunks(_stream_pod_log(api, name, limit_bytes=TASK_LOG_MAX_SIZE)))
+
+
+def encode_chunk(data, level=TASK_LOG_COMPRESSION_LEVEL):
+    """
+    Compress `data` with zlib at `level`, kept as is if it does not get smaller
+    :return: codec and stored bytes
+    """
+    if level:
+        compressed = zlib.compress(data, level)
+        if len(compressed) < len(data):
+            return 'zlib', compressed
+    return '', data
+
+
+def decode_chunk(codec, data):
+    return DECODERS[codec](data)
+
+
+def build_chunks(task, chunks):
+    """
+    Rows storing `chunks` compressed as the pod output of `task`, whose `log_size` is updated
+    """
+    rows = []
+    offset = 0
+    for data in chunks:
+        codec, stored = encode_chunk(data)
+        rows.append(TaskLogChunk(task=task, offset=offset, end=offset + len(data), codec=codec, data=stored))
+        offset += len(data)
+    task.log_size = offset
+    return rows
+
+
+def save_chunks(rows):
+    """
+    Insert chunk `rows` in batches of at most INSERT_BATCH_BYTES of stored data, or a single chunk
+    """
+    batch = []
+    size = 0
+    for row in rows:
+        if batch and size + len(row.data) > INSERT_BATCH_BYTES:
+            TaskLogChunk.objects.bulk_create(batch)
+            batch = []
+            size = 0
+        batch.append(row)
+        size += len(row.data)
+    if batch:
+        TaskLogChunk.objects.bulk_create(batch)
+
+
+def log_size(task):
+    """
+    Size in bytes of the stored log of `task`
+    """
+    return task.log_size + len(task.logs.encode())
+
+
+def read_stored_log(task, offset, limit):
+    """
+    Bytes [offset, offset + limit) of the stored log of `task`, its pod output followed by the messages in `logs`.
+    Only the chunks overlapping the range are loaded and decompressed.
+    """
+    end = offset + limit
+    data = bytearray()
+    if offset < task.log_size:
+        chunks = TaskLogChunk.objects.filter(task=task, end__gt=offset, offset__lt=end).order_by('offset')
+        for chunk_offset, codec, chunk in chunks.values_list('offset', 'codec', 'data'):
+            data += decode_chunk(codec, bytes(chunk))[max(offset - chunk_offset, 0):end - chunk_offset]
+    if end > task.log_size:
+        data += task.logs.encode()[max(offset - task.log_size, 0):end - task.log_size]
+    return bytes(data)
+
+
+def _read_pod_range(api, name, offset, limit, follow):
+    data = bytearray()
+    position = 0
+    kwargs = {'limit_bytes': offset + limit}
+    if follow:
+        kwargs.update(follow=True, _request_timeout=TASK_LOG_FOLLOW_TIMEOUT)
+    try:
+        for piece in _stream_pod_log(api, name, **kwargs):
+            data += piece[max(offset - position, 0):offset + limit - position]
+            position += len(piece)
+            if len(data) >= limit or (follow and data):
+                break
+    except HTTPError:
+        # nothing was written before the timeout
+        if not follow:
+            raise
+    return bytes(data)
+
+
+def read_pod_log(api, name, offset, limit, follow=False):
+    """
+    Bytes [offset, offset + limit) of the log of the running pod `name`.
+    The log is streamed from its beginning up to the end of the range, so ranges end at TASK_LOG_LIVE_READ_SIZE
+    at most, which bounds what a request downloads. If there are no bytes at `offset` yet and `follow` is set,
+    wait at most TASK_LOG_FOLLOW_TIMEOUT seconds for the pod to write some.
+    :raise ValueError: if `offset` is not before TASK_LOG_LIVE_READ_SIZE
+    """
+    if offset >= TASK_LOG_LIVE_READ_SIZE:
+        raise ValueError("Log range of a running task beyond {} bytes".format(TASK_LOG_LIVE_READ_SIZE))
+    limit = min(limit, TASK_LOG_LIVE_READ_SIZE - offset)
+    data = _read_pod_range(api, name, offset, limit, False)
+    if not data and follow:
+        data = _read_pod_range(api, name, offset, limit, True)
+    return data
+
+
+def decode_log(data, offset):
+    """
+    Decode bytes of a log read from `offset`, leaving out UTF-8 characters cut by the ends of the range,
+    so that reading on from the returned end never splits a character.
+    :return: text, offset of its first byte and offset right after its last byte
+    """
+    start = 0
+    while start < min(len(data), 3) and data[start] & 0xC0 == 0x80:  # continuation bytes
+        start += 1
+    end = len(data)
+    for back in range(1, min(4, end - start) + 1):
+        byte = data[end - back]
+        if byte & 0xC0 != 0x80:
+            if byte >= 0xC0 and back < (2 if byte < 0xE0 else 3 if byte < 0xF0 else 4) and end - back > start:
+                end -= back
+            break
+    return data[start:end].decode(errors='replace'), offset + start, offset + end
+
+
+class LogTail:
+    """
+    Single follow stream of the log of a running pod, whose output is sent to every viewer of the task.
+
+    The stream starts TASK_LOG_TAIL_SECONDS in the past. The most recent TASK_LOG_PAGE_SIZE characters are kept,
+    so that viewers joining later see them at once without another request to the API server. If the
+    connection drops, the stream is resumed from the time of its last output, which may repeat a few lines.
+    """
+
+    def __init__(self, hub, uuid, pod_name):
+        self.hub = hub
+        self.uuid = uuid
+        self.pod_name = pod_name
+        self.subscribers = set()
+        self.stopped = False
+        self.finished = False
+        self.last_output = time.time() - TASK_LOG_TAIL_SECONDS
+        self._recent = deque()
+        self._recent_size = 0
+        self._response = None
+        # keeps the output in order for every viewer, held while calling them
+        self.deliver_lock = Lock()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.stopped = True
+        response = self._response
+        if response is not None:
+            try:
+                # unblocks the read of the stream thread
+                response.close()
+            except Exception as ex:
+                LOGGER.debug(ex)
+
+    def _publish(self, text):
+        if not text:
+            return
+        with self.deliver_lock:
+            with self.hub.lock:
+                self._recent.append(text)
+                self._recent_size += len(text)
+                while self._recent_size - len(self._recent[0]) >= TASK_LOG_PAGE_SIZE:
+                    self._recent_size -= len(self._recent.popleft())
+                subscribers = list(self.subscribers)
+            for callback in subscribers:
+                callback(text)
+
+    def _follow(self, decoder, since_seconds):
+        """
+        Read the stream until it ends
+        """
+        response = self.hub.api.read_namespaced_pod_log(name=self.pod_name, namespace=KUBERNETES_NAMESPACE,
+                                                        follow=True, since_seconds=since_seconds,
+                                                        _preload_content=False)
+        self._response = response
+        try:
+            if self.stopped:
+                return
+            for piece in response.stream(TASK_LOG_CHUNK_SIZE):
+                self.last_output = time.time()
+                self._publish(decoder.decode(piece))
+        finally:
+            response.release_conn()
+
+    def _run(self):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        attempts = 0
+        since_seconds = TASK_LOG_TAIL_SECONDS
+        while not self.stopped and attempts < TAIL_RESUME_ATTEMPTS:
+            last_output = self.last_output
+            try:
+                self._follow(decoder, since_seconds)
+                # the container terminated
+                break
+            except HTTPError as ex:
+                if self.stopped:
+                    break
+                attempts = attempts + 1 if self.last_output == last_output else 1
+                LOGGER.debug("Log tail of %s interrupted: %s", self.uuid, ex)
+                time.sleep(1)
+                since_seconds = max(math.ceil(time.time() - self.last_output), 1)
+            except ApiException as ex:
+                LOGGER.warning("Kubernetes ApiException %d: %s", ex.status, ex.reason)
+                break
+            except Exception as ex:
+                if not self.stopped:
+                    LOGGER.error(ex)
+                break
+        self._publish(decoder.decode(b'', final=True))
+        with self.deliver_lock:
+            for callback in self.hub.finish(self):
+                callback(None)
+
+    def recent(self):
+        return ''.join(self._recent)
+
+
+class LogTailHub:
+    """
+    Log tails of running tasks by task uuid, started by their first viewer and stopped when the last one leaves
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self._tails = {}
+        self._api = None
+
+    @property
+    def api(self):
+        if self._api is None:
+            self._api = CoreV1Api(get_kubernetes_api_client())
+        return self._api
+
+    def subscribe(self, uuid, pod_name, callback):
+        """
+        Call `callback` with the output of the task `uuid` running in pod `pod_name`, starting with its recent
+        output, and with None once the log ended
+        """
+        while True:
+            with self.lock:
+                tail = self._tails.get(uuid, None)
+                start = tail is None
+                if start:
+                    tail = LogTail(self, uuid, pod_name)
+                    self._tails[uuid] = tail
+            with tail.deliver_lock:
+                with self.lock:
+                    if tail.finished:
+                        # ended meanwhile, start over with a new tail
+                        continue
+                    tail.subscribers.add(callback)
+                    recent = tail.recent()
+                if recent:
+                    callback(recent)
+            if start:
+                tail.start()
+            return
+
+    def unsubscribe(self, uuid, callback):
+        with self.lock:
+            tail = self._tails.get(uuid, None)
+            if tail is None:
+                return
+            tail.subscribers.discard(callback)
+            if tail.subscribers:
+                return
+            del self._tails[uuid]
+        tail.stop()
+
+    def finish(self, tail):
+        """
+        Forget the ended `tail`, returns its subscribers
+        """
+        with self.lock:
+            tail.finished = True
+            if self._tails.get(tail.uuid, None) is tail:
+                del self._tails[tail.uuid]
+            subscribers = list(tail.subscribers)
+            tail.subscribers.clear()
+        return subscribers
+
+    def viewers(self, uuid):
+        with self.lock:
+            tail = self._tails.get(uuid, None)
+            return len(tail.subscribers) if tail is not None else 0
@@ -0,0 +1,162 @@
+"""
+Periodic TTL checks of task settings
+"""
+import time
+import heapq
+import random
+import logging
+from threading import Lock
+from config import TTL_CHECK_JITTER
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _Entry:
+    def __init__(self, interval, fn):
+        self.interval = interval
+        self.fn = fn
+        self.running = False
+        self.overdue = False  # came due again while running
+        self.lag = 0
+        self.sequence = 0  # of its item in the heap
+
+
+class TtlScheduler:
+    """
+    Runs a function of every key each `interval` seconds through `submit`, e.g. of a bounded thread pool.
+
+    Due times are kept in a min-heap, so waiting for the next check costs O(log n) whatever the number of keys.
+    At most one run of a key is in flight: if it comes due again meanwhile, all missed runs are coalesced
+    into a single one started as soon as the running one finishes, so slow checks never pile up in the pool.
+    First runs are spread over the interval by `jitter` so that checks of settings created together do not
+    keep hitting the API server at the same time.
+    """
+
+    def __init__(self, submit, on_change=None, jitter=TTL_CHECK_JITTER):
+        self._submit = submit
+        self._on_change = on_change  # called when the next due time may have moved earlier
+        self.jitter = jitter
+        self._entries = {}
+        self._heap = []  # (due time, sequence, key, entry)
+        self._sequence = 0
+        self._lock = Lock()
+        self.runs = 0
+        self.coalesced = 0
+        self.max_lag = 0
+
+    def _push(self, key, entry, due):
+        # every entry has at most one item in the heap, a run coming due while running is not re-queued
+        self._sequence += 1
+        entry.sequence = self._sequence
+        heapq.heappush(self._heap, (due, self._sequence, key, entry))
+
+    def add(self, key, interval, fn):
+        """
+        Run `fn` every `interval` seconds, replacing the function previously added as `key`.
+        A key added again keeps its state, so a run in flight is still the only one, and its due time unless the
+        interval changed.
+        """
+        interval = max(interval, 1)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                entry = _Entry(interval, fn)
+                self._entries[key] = entry
+            else:
+                entry.fn = fn
+                if entry.interval == interval:
+                    return
+                entry.interval = interval
+            # an item pushed before is left behind as stale
+            self._push(key, entry, time.time() + interval * (1 - self.jitter * random.random()))
+        if self._on_change:
+            self._on_change()
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def interval(self, key):
+        """
+        Interval of `key`, None if it is not scheduled
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            return entry.interval if entry is not None else None
+
+    def _current(self, key, entry):
+        return self._entries.get(key, None) is entry
+
+    def _discard_stale(self):
+        # left behind by removed keys or changed intervals
+        while self._heap and not (self._current(self._heap[0][2], self._heap[0][3])
+                                  and self._heap[0][3].sequence == self._heap[0][1]):
+            heapq.heappop(self._heap)
+
+    def next_due(self):
+        """
+        Earliest due time, None if nothing is scheduled
+        """
+        with self._lock:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def run_pending(self):
+        now = time.time()
+        started = []
+        with self._lock:
+            self._discard_stale()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, key, entry = heapq.heappop(self._heap)
+                if entry.running:
+                    entry.overdue = True
+                    self.coalesced += 1
+                else:
+                    entry.running = True
+                    started.append((key, entry, due))
+                    # missed periods are skipped rather than run back to back
+                    self._push(key, entry, max(due + entry.interval, now))
+                self._discard_stale()
+        for key, entry, due in started:
+            try:
+                self._submit(self._run, key, entry, due)
+            except Exception as ex:
+                LOGGER.error(ex)
+                entry.running = False
+
+    def _run(self, key, entry, due):
+        entry.lag = time.time() - due
+        self.max_lag = max(self.max_lag, entry.lag)
+        if entry.lag > entry.interval:
+            LOGGER.warning("TTL check of %s started %.1f seconds late", key, entry.lag)
+        try:
+            entry.fn()
+        except Exception as ex:
+            LOGGER.error(ex)
+        finally:
+            rerun = False
+            with self._lock:
+                self.runs += 1
+                entry.running = False
+                if entry.overdue and self._current(key, entry):
+                    entry.overdue = False
+                    rerun = True
+                    self._push(key, entry, time.time())
+            if rerun and self._on_change:
+                self._on_change()
+
+    def stats(self):
+        """
+        Number of scheduled, running and overdue checks, runs and coalesced runs so far, and lag of the last run of
+        each key in seconds between its due time and its start
+        """
+        with self._lock:
+            return {
+                'scheduled': len(self._entries),
+                'running': sum(1 for entry in self._entries.values() if entry.running),
+                'overdue': sum(1 for entry in self._entries.values() if entry.overdue),
+                'runs': self.runs,
+                'coalesced': self.coalesced,
+                'max_lag': self.max_lag,
+                'lag': {key: entry.lag for key, entry in self._entries.items()},
+            }
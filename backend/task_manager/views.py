@@ -5,17 +5,22 @@ from django.http import JsonResponse
 from django.views import View
 from django.db.utils import IntegrityError
 from django.db.models import ProtectedError
-from django.core.paginator import Paginator
 from kubernetes.client import CoreV1Api
 from kubernetes.client.rest import ApiException
+from urllib3.exceptions import HTTPError
 from api.common import RESPONSE, get_uuid
+from api.pagination import get_page
 from user_model.models import UserType
-from config import KUBERNETES_NAMESPACE
+from config import KUBERNETES_NAMESPACE, TASK_LOG_PAGE_SIZE
 from .models import TaskSettings, Task, TASK
-from .executor import TaskExecutor, get_kubernetes_api_client
+from .executor import TaskExecutor, get_kubernetes_api_client, notify_executor, JOB_DISPATCH, JOB_MONITOR
+from .settings_config import invalidate_settings_config
+from .task_log import read_stored_log, read_pod_log, decode_log, log_size
 
 LOGGER = logging.getLogger(__name__)
 
+TASK_SETTINGS_ORDER_FIELDS = ('id', 'name', 'create_time')
+
 
 class TaskSettingsListHandler(View):
     http_method_names = ['get', 'post']
@@ -31,9 +36,12 @@ class TaskSettingsListHandler(View):
         @apiParam {Number} [order_by] Specifies list order criteria, available options:
         create_time, name. Use '-' sign to indicate reverse order.
         @apiParam {String} [page] Specifies the page number (starting from 1, per page 25 elements)
+        @apiParam {String} [cursor] Returns the 25 elements after the previous page, given its `next_cursor`.
+        Faster than `page` on large lists, `count` and `page_count` are not returned
         @apiSuccess {Object} payload Response object
         @apiSuccess {Number} payload.page_count Page count
         @apiSuccess {Number} payload.count Total element count
+        @apiSuccess {String} payload.next_cursor Cursor of the next page, null on the last page
         @apiSuccess {Object[]} payload.entry List of TaskSettings Object
         @apiSuccess {String} payload.entry.uuid Task uuid
         @apiSuccess {String} payload.entry.name Task name
@@ -43,6 +51,7 @@ class TaskSettingsListHandler(View):
         @apiSuccess {Number} [payload.entry.replica] Replicas of containers (admin only)
         @apiSuccess {Number} [payload.entry.ttl_interval] Health check interval (admin only)
         @apiSuccess {Number} [payload.max_sharing_users] Max number of shared users (admin only)
+        @apiSuccess {Number} [payload.entry.max_running_tasks] Max number of running tasks, 0 for unlimited (admin only)
         @apiSuccess {String} payload.entry.create_time Create time of task settings
         @apiUse APIHeader
         @apiUse Success
@@ -56,16 +65,18 @@ class TaskSettingsListHandler(View):
             if user is None:
                 raise Exception("Internal exception raised when trying to get `User` object.")
             params = request.GET
-            payload = {}
             order_by = params.get('order_by', 'id').split(',')
-            page = params.get('page', '1')
-            page = int(page)
-            all_pages = Paginator(TaskSettings.objects.filter().order_by(*order_by), 25)
-            curr_page = all_pages.page(page)
-            payload['count'] = all_pages.count
-            payload['page_count'] = all_pages.num_pages if all_pages.count > 0 else 0
+            if any(field.lstrip('-') not in TASK_SETTINGS_ORDER_FIELDS for field in order_by):
+                raise ValueError("Invalid order")
+            if not {'id', '-id'} & set(order_by):
+                # the last order field must be unique for cursors
+                order_by.append('id')
+            queryset = TaskSettings.objects.all()
+            if user.user_type == UserType.USER:
+                queryset = queryset.only('uuid', 'name', 'description', 'create_time', 'time_limit')
+            rows, payload = get_page(queryset, params, order_by)
             payload['entry'] = []
-            for item in curr_page.object_list:
+            for item in rows:
                 entry = {'uuid': item.uuid, 'name': item.name,
                          'description': item.description, 'create_time': item.create_time,
                          'time_limit': item.time_limit}
@@ -74,6 +85,7 @@ class TaskSettingsListHandler(View):
                     entry['replica'] = item.replica
                     entry['ttl_interval'] = item.ttl_interval
                     entry['max_sharing_users'] = item.max_sharing_users
+                    entry['max_running_tasks'] = item.max_running_tasks
                 payload['entry'].append(entry)
             response['payload'] = payload
         except ValueError:
@@ -111,7 +123,8 @@ class TaskSettingsListHandler(View):
             "time_limit": 900,
             "replica": 2,
             "ttl_interval": 5,
-            "max_sharing_users": 1
+            "max_sharing_users": 1,
+            "max_running_tasks": 10
         }
         @apiParam {String} name Task name
         @apiParam {String} description Task description
@@ -120,6 +133,7 @@ class TaskSettingsListHandler(View):
         @apiParam {Number} replica Replicas of containers
         @apiParam {Number} ttl_interval Health check interval
         @apiParam {Number} max_sharing_users Max number of shared users
+        @apiParam {Number} [max_running_tasks] Max number of running tasks, 0 for unlimited
         @apiSuccess {Object} payload Success payload is empty
         @apiUse APIHeader
         @apiUse Success
@@ -148,7 +162,8 @@ class TaskSettingsListHandler(View):
                           not isinstance(query['container_config'], dict) or \
                           not isinstance(query['time_limit'], int) or \
                           not isinstance(query['replica'], int) or not isinstance(query['ttl_interval'], int) or \
-                          not isinstance(query['max_sharing_users'], int)
+                          not isinstance(query['max_sharing_users'], int) or \
+                          not isinstance(query.get('max_running_tasks', 0), int)
                 if invalid:
                     response = RESPONSE.INVALID_REQUEST
                 else:
@@ -157,7 +172,8 @@ class TaskSettingsListHandler(View):
                                                        container_config=json.dumps(query['container_config']),
                                                        time_limit=query['time_limit'], replica=query['replica'],
                                                        ttl_interval=max(query['ttl_interval'], 1),
-                                                       max_sharing_users=query['max_sharing_users'])
+                                                       max_sharing_users=query['max_sharing_users'],
+                                                       max_running_tasks=max(query.get('max_running_tasks', 0), 0))
                     response = RESPONSE.SUCCESS
                     executor.schedule_task_settings(item)
         except ValueError:
@@ -192,6 +208,7 @@ class TaskSettingsItemHandler(View):
         @apiSuccess {Number} payload.replica Replicas of containers
         @apiSuccess {Number} payload.ttl_interval Health check interval
         @apiSuccess {Number} payload.max_sharing_users Max number of shared users
+        @apiSuccess {Number} payload.max_running_tasks Max number of running tasks, 0 for unlimited
         @apiSuccess {String} payload.create_time Create time of task setting
         @apiUse APIHeader
         @apiUse Success
@@ -210,7 +227,8 @@ class TaskSettingsItemHandler(View):
             response['payload'] = {'uuid': item.uuid, 'name': item.name, 'description': item.description,
                                    'container_config': json.loads(item.container_config), 'time_limit': item.time_limit,
                                    'replica': item.replica, 'ttl_interval': item.ttl_interval,
-                                   'max_sharing_users': item.max_sharing_users, 'create_time': item.create_time}
+                                   'max_sharing_users': item.max_sharing_users,
+                                   'max_running_tasks': item.max_running_tasks, 'create_time': item.create_time}
         except TaskSettings.DoesNotExist:
             response = RESPONSE.OPERATION_FAILED
             response['message'] += " {}".format("Object does not exist.")
@@ -239,6 +257,7 @@ class TaskSettingsItemHandler(View):
         @apiParam {Number} [replica] Replicas of containers
         @apiParam {Number} [ttl_interval] Health check interval
         @apiParam {Number} [max_sharing_users] Max number of shared users
+        @apiParam {Number} [max_running_tasks] Max number of running tasks, 0 for unlimited
         @apiSuccess {Object} payload Success payload is empty
         @apiUse APIHeader
         @apiUse Success
@@ -274,7 +293,10 @@ class TaskSettingsItemHandler(View):
                 need_reschedule = True
             if 'max_sharing_users' in query.keys():
                 item.max_sharing_users = int(query['max_sharing_users'])
+            if 'max_running_tasks' in query.keys():
+                item.max_running_tasks = max(int(query['max_running_tasks']), 0)
             item.save(force_update=True)
+            invalidate_settings_config(item.uuid)
             if need_reschedule:
                 executor.schedule_task_settings(item)
         except ValueError:
@@ -312,6 +334,7 @@ class TaskSettingsItemHandler(View):
             uuid = kwargs.get('uuid', None)
             assert uuid is not None
             TaskSettings.objects.get(uuid=uuid).delete()
+            invalidate_settings_config(uuid)
             response = RESPONSE.SUCCESS
         except TaskSettings.DoesNotExist:
             response = RESPONSE.OPERATION_FAILED
@@ -338,9 +361,12 @@ class ConcreteTaskListHandler(View):
         @apiPermission user
 
         @apiParam {Number} [page] Specifies the page number (starting from 1, per page 25 elements)
+        @apiParam {String} [cursor] Returns the 25 elements after the previous page, given its `next_cursor`.
+        Faster than `page` on large lists, `count` and `page_count` are not returned
         @apiSuccess {Object} payload Response object
         @apiSuccess {Number} payload.page_count Page count
         @apiSuccess {Number} payload.count Total element count
+        @apiSuccess {String} payload.next_cursor Cursor of the next page, null on the last page
         @apiSuccess {Object[]} payload.entry List of TaskSettings Object
         @apiSuccess {String} payload.entry.uuid Task uuid
         @apiSuccess {Number} payload.entry.status Task status code, defined as [SCHEDULED = 0, RUNNING = 1,
@@ -349,6 +375,7 @@ class ConcreteTaskListHandler(View):
         @apiSuccess {Object} payload.entry.settings Corresponding task setting
         @apiSuccess {String} payload.entry.settings.name Name of the task setting
         @apiSuccess {String} payload.entry.settings.uuid UUID of the task setting
+        @apiSuccess {Number} payload.entry.priority Task priority
         @apiSuccess {String} payload.entry.create_time Create time
         @apiUse APIHeader
         @apiUse Success
@@ -361,20 +388,19 @@ class ConcreteTaskListHandler(View):
             user = kwargs.get('__user', None)
             if user is None:
                 raise Exception("Internal exception raised when trying to get `User` object.")
-            page = request.GET.get('page', '1')
-            page = int(page)
             filter_dict = {}
             if user.user_type == UserType.USER:
                 filter_dict['user'] = user
-            all_pages = Paginator(Task.objects.filter(**filter_dict).order_by("-create_time", "status"), 25)
-            curr_page = all_pages.page(page)
-            payload = {'count': all_pages.count, 'page_count': all_pages.num_pages if all_pages.count > 0 else 0,
-                       'entry': []}
-            for item in curr_page.object_list:
+            queryset = Task.objects.filter(**filter_dict).select_related('settings', 'user') \
+                .only('uuid', 'status', 'priority', 'create_time', 'settings__name', 'settings__uuid', 'user__username')
+            rows, payload = get_page(queryset, request.GET, ('-create_time', 'status', '-id'))
+            payload['entry'] = []
+            for item in rows:
                 payload['entry'].append({'settings': {'name': item.settings.name, 'uuid': item.settings.uuid},
                                          'status': item.status,
                                          'uuid': item.uuid,
                                          'user': item.user.username,
+                                         'priority': item.priority,
                                          'create_time': item.create_time})
             response['payload'] = payload
         except ValueError:
@@ -395,6 +421,7 @@ class ConcreteTaskListHandler(View):
         @apiPermission user
 
         @apiParam {String} settings_uuid UUID of TaskSetting
+        @apiParam {Number} [priority] Tasks with higher priority are dispatched first, default 0 (admin only)
         @apiSuccess {Object} payload Response object
         @apiSuccess {String} payload.uuid Task uuid
         @apiSuccess {Number} payload.status Task status code, defined as [SCHEDULED = 0, RUNNING = 1,
@@ -403,12 +430,14 @@ class ConcreteTaskListHandler(View):
         @apiSuccess {Object} payload.settings Corresponding task setting
         @apiSuccess {String} payload.settings.name Name of the task setting
         @apiSuccess {String} payload.settings.uuid UUID of the task setting
+        @apiSuccess {Number} payload.priority Task priority
         @apiSuccess {String} payload.create_time Create time
         @apiUse APIHeader
         @apiUse Success
         @apiUse ServerError
         @apiUse InvalidRequest
         @apiUse Unauthorized
+        @apiUse PermissionDenied
         """
         response = None
         try:
@@ -417,16 +446,21 @@ class ConcreteTaskListHandler(View):
                 raise Exception("Internal exception raised when trying to get `User` object.")
             else:
                 query = json.loads(request.body)
-                if 'settings_uuid' not in query.keys():
+                priority = query.get('priority', 0)
+                if 'settings_uuid' not in query.keys() or not isinstance(priority, int):
                     response = RESPONSE.INVALID_REQUEST
+                elif priority and user.user_type == UserType.USER:
+                    response = RESPONSE.PERMISSION_DENIED
                 else:
                     settings = TaskSettings.objects.get(uuid=query['settings_uuid'])
-                    item = Task.objects.create(user=user, settings=settings, uuid=str(get_uuid()))
+                    item = Task.objects.create(user=user, settings=settings, uuid=str(get_uuid()), priority=priority)
+                    notify_executor(JOB_DISPATCH)
                     response = RESPONSE.SUCCESS
                     response['payload'] = {'settings': {'name': item.settings.name, 'uuid': item.settings.uuid},
                                            'status': item.status,
                                            'uuid': item.uuid,
                                            'user': item.user.username,
+                                           'priority': item.priority,
                                            'create_time': item.create_time}
         except TaskSettings.DoesNotExist:
             response = RESPONSE.OPERATION_FAILED
@@ -461,15 +495,20 @@ class ConcreteTaskHandler(View):
                 item = Task.objects.get(uuid=uuid, user=user)
             return item
 
-    def get(self, _, **kwargs):
+    def get(self, request, **kwargs):
         """
         @api {get} /task/<uuid>/ Get detailed task info
         @apiName GetTaskInfoDetail
         @apiGroup Task
         @apiVersion 0.1.0
         @apiPermission user
+        @apiDescription While the task is running, only the first TASK_LOG_LIVE_READ_SIZE bytes of its log can be
+        read by range, later output is sent over WebSocket
 
         @apiParam {String} uuid UUID of the task
+        @apiParam {Number} [offset] Byte offset in the log to return it from, default 0
+        @apiParam {Number} [limit] Max number of log bytes to return, default and at most 65536
+        @apiParam {Number} [follow] If 1 and the task is running, wait a while for output at `offset` to be written
         @apiSuccess {Object} payload Response object
         @apiSuccess {String} payload.uuid Task uuid
         @apiSuccess {Number} payload.status Task status code, defined as [SCHEDULED = 0, RUNNING = 1,
@@ -478,8 +517,13 @@ class ConcreteTaskHandler(View):
         @apiSuccess {Object} payload.settings Corresponding task setting
         @apiSuccess {String} payload.settings.name Name of the task setting
         @apiSuccess {String} payload.settings.uuid UUID of the task setting
+        @apiSuccess {Number} payload.priority Task priority
         @apiSuccess {Number} payload.exit_code Exit code of the task
-        @apiSuccess {String} payload.log Logs of the task
+        @apiSuccess {String} payload.log Logs of the task, the UTF-8 characters in the requested byte range
+        @apiSuccess {Number} payload.log_offset Byte offset of the first character of `log`
+        @apiSuccess {Number} payload.log_next_offset Byte offset right after `log`, to continue reading from
+        @apiSuccess {Number} payload.log_size Size of the stored log in bytes, null while the task is running
+        @apiSuccess {Boolean} payload.log_complete Whether the log is final and was read to its end
         @apiSuccess {String} payload.create_time Create time
         @apiUse APIHeader
         @apiUse Success
@@ -491,31 +535,47 @@ class ConcreteTaskHandler(View):
         response = RESPONSE.SUCCESS
         api = CoreV1Api(get_kubernetes_api_client())
         try:
+            offset = int(request.GET.get('offset', '0'))
+            limit = min(int(request.GET.get('limit', TASK_LOG_PAGE_SIZE)), TASK_LOG_PAGE_SIZE)
+            follow = request.GET.get('follow', '0') == '1'
+            if offset < 0 or limit <= 0:
+                raise ValueError("Invalid log range")
             item = self._get_task(kwargs)
             if item is None:
                 response = RESPONSE.INVALID_REQUEST
             else:
+                size = None
                 # logs are not crunched to WebServer when pods are running, so query from k8s directly in this case
-                log = item.logs
                 if item.status == TASK.RUNNING:
+                    data = b''
                     try:
                         resp = api.list_namespaced_pod(namespace=KUBERNETES_NAMESPACE,
-                                                       label_selector="app={}".format(item.uuid))
+                                                       label_selector="task-exec={}".format(item.uuid))
                         if resp.items:
-                            log = api.read_namespaced_pod_log(name=resp.items[0].metadata.name,
-                                                              namespace=KUBERNETES_NAMESPACE)
-                    except ApiException:
-                        log = 'Failed to get logs from running pod.'
+                            data = read_pod_log(api, resp.items[0].metadata.name, offset, limit, follow)
+                        log, log_offset, next_offset = decode_log(data, offset)
+                    except (ApiException, HTTPError):
+                        log, log_offset, next_offset = 'Failed to get logs from running pod.', offset, offset
+                else:
+                    size = log_size(item)
+                    log, log_offset, next_offset = decode_log(read_stored_log(item, offset, limit), offset)
                 response['payload'] = {'settings': {'name': item.settings.name, 'uuid': item.settings.uuid},
                                        'status': item.status,
                                        'uuid': item.uuid,
                                        'user': item.user.username,
                                        'log': log,
+                                       'log_offset': log_offset,
+                                       'log_next_offset': next_offset,
+                                       'log_size': size,
+                                       'log_complete': size is not None and item.logs_get and next_offset >= size,
+                                       'priority': item.priority,
                                        'exit_code': item.exit_code,
                                        'create_time': item.create_time}
         except Task.DoesNotExist:
             response = RESPONSE.OPERATION_FAILED
             response['message'] += " Object does not exist."
+        except ValueError:
+            response = RESPONSE.INVALID_REQUEST
         except Exception as ex:
             LOGGER.error(ex)
             response = RESPONSE.SERVER_ERROR
@@ -547,6 +607,7 @@ class ConcreteTaskHandler(View):
             else:
                 item.status = TASK.DELETING  # schedule canceling by changing status
                 item.save(force_update=True)
+                notify_executor(JOB_MONITOR)
         except Task.DoesNotExist:
             response = RESPONSE.OPERATION_FAILED
             response['message'] += " Object does not exist."
@@ -1,6 +1,10 @@
+import re
 import json
+import time
+import queue
 import random
 import bcrypt
+from websocket import WebSocketTimeoutException
 from django.test import Client, TestCase
 from kubernetes.stream import ws_client
 from kubernetes.client.rest import ApiException
@@ -116,6 +120,58 @@ class MockAppsV1Api:
         print(name, namespace)
 
 
+class MockPodLogResponse:
+    def __init__(self, data, limit_bytes=None, **_):
+        self.data = data[:limit_bytes]
+        self.released = False
+
+    def stream(self, amt):
+        for i in range(0, len(self.data), amt):
+            yield self.data[i:i + amt]
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        self.released = True
+
+
+class MockFollowLogApi:
+    """
+    Log streams of running pods, written by putting bytes into `pieces`, ended by putting None
+    """
+
+    def __init__(self, *_):
+        self.pieces = queue.Queue()
+        self.calls = []
+
+    def list_namespaced_pod(self, namespace, label_selector):
+        return ReturnItemsList([DotDict({'metadata': DotDict({'namespace': namespace, 'name': label_selector})})])
+
+    def read_namespaced_pod_log(self, name, namespace, **kwargs):
+        self.calls.append((name, namespace, kwargs))
+        api = self
+
+        class Response:
+            @staticmethod
+            def stream(_amt):
+                while True:
+                    piece = api.pieces.get()
+                    if piece is None:
+                        return
+                    yield piece
+
+            @staticmethod
+            def close():
+                api.pieces.put(None)
+
+            @staticmethod
+            def release_conn():
+                pass
+
+        return Response()
+
+
 class MockCoreV1Api:
     service_map = {}
 
@@ -151,8 +207,9 @@ class MockCoreV1Api:
         return ReturnItemsList(item_list)
 
     @staticmethod
-    def read_namespaced_pod_log(name, namespace, **_):
-        return 'Hello world log from pod {} in ns {}'.format(name, namespace)
+    def read_namespaced_pod_log(name, namespace, _preload_content=True, **kwargs):
+        log = 'Hello world log from pod {} in ns {}'.format(name, namespace)
+        return log if _preload_content else MockPodLogResponse(log.encode(), **kwargs)
 
     @staticmethod
     def delete_namespaced_pod(**_):
@@ -367,6 +424,61 @@ class MockWSClient:
         pass
 
 
+class MockShellSocket:
+    """
+    Websocket of a shell session, receiving the stdout of `shell` in frames of at most `frame_size` bytes
+    """
+    frame_size = 65536
+
+    def __init__(self, shell):
+        self.shell = shell
+        self.connected = True
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        self.connected = False
+
+    def recv_data_frame(self, _control_frame):
+        data = self.shell.take_stdout(self.frame_size)
+        if not data:
+            time.sleep(self.timeout)
+            raise WebSocketTimeoutException("timed out")
+        return ws_client.ABNF.OPCODE_BINARY, DotDict({'data': bytes([ws_client.STDOUT_CHANNEL]) + data})
+
+
+class MockShellClient(MockWSClient):
+    """
+    Exec stream of a shell session, answering every command list written to it with `output` and exit `status`
+    """
+    output = ''
+    status = 0
+
+    def __init__(self, **_):
+        super().__init__()
+        self.scripts = []
+        self._stdout = b''
+        self.sock = MockShellSocket(self)
+
+    def write_stdin(self, data, **_):
+        if not self.open:
+            raise Exception("Connection is already closed.")
+        match = re.match(r"\(\n(.*)\n\) </dev/null\nprintf '%s %d\\n' (\w+) \$\?\n$", data, re.DOTALL)
+        self.scripts.append(match.group(1))
+        output, status = self.answer(match.group(1))
+        self._stdout += '{}{} {}\n'.format(output, match.group(2), status).encode()
+
+    def answer(self, _script):
+        return self.output, self.status
+
+    def take_stdout(self, size):
+        stdout = self._stdout[:size]
+        self._stdout = self._stdout[size:]
+        return stdout
+
+
 class MockDXFBase:
     def __init__(self, *_, **__):
         pass
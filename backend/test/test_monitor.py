@@ -1,8 +1,11 @@
 from uuid import uuid1
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import json
 import mock
+from kubernetes.client import Configuration, CoreV1Api
 from task_manager.models import TaskSettings
-from api.common import RESPONSE
+from api.common import RESPONSE, PooledApiClient, get_kubernetes_api_client, get_kubernetes_api_pool_stats
 import monitor.views
 from .common import login_test_user, TestCaseWithBasicUser, MockCoreV1Api, mock_get_k8s_client
 
@@ -41,3 +44,61 @@ class TestTaskSettings(TestCaseWithBasicUser):
         self.assertEqual(response['status'], 200)
         self.assertEqual(response['payload']['count'], 51)
         self.assertEqual(response['payload']['page_count'], 3)
+
+
+class MockApiServer(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        body = json.dumps({'kind': 'NamespaceList', 'apiVersion': 'v1', 'metadata': {}, 'items': []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+class TestKubernetesClient(TestCaseWithBasicUser):
+    def test_shared_client(self):
+        self.assertIs(get_kubernetes_api_client(), get_kubernetes_api_client())
+        token = login_test_user('admin')
+        response = self.client.get('/kubernetes_client/', HTTP_X_ACCESS_TOKEN=token, HTTP_X_ACCESS_USERNAME='admin')
+        response = json.loads(response.content)
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(set(response['payload'].keys()), {'max_size', 'in_use', 'idle', 'connections', 'requests'})
+
+    def test_pool_stats(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), MockApiServer)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            conf = Configuration()
+            conf.host = 'http://127.0.0.1:{}'.format(server.server_port)
+            conf.connection_pool_maxsize = 4
+            api_client = PooledApiClient(conf)
+            api = CoreV1Api(api_client)
+            for _ in range(3):
+                api.list_namespace()
+            stats = get_kubernetes_api_pool_stats(api_client)
+            self.assertEqual(stats, {'max_size': 4, 'in_use': 0, 'idle': 1, 'connections': 1, 'requests': 3})
+            api_client.rest_client.pool_manager.clear()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_stream_override_is_per_thread(self):
+        api_client = PooledApiClient(Configuration())
+        default = api_client.request
+
+        def _exec():
+            # what kubernetes.stream.stream does around an exec call
+            api_client.request = lambda *_, **__: 'websocket'
+            self.assertEqual(api_client.request(), 'websocket')
+
+        thread = Thread(target=_exec)
+        thread.start()
+        thread.join()
+        self.assertEqual(api_client.request, default)
@@ -1,12 +1,27 @@
+import copy
 import random
 import json
 import time
+from threading import Thread, Barrier
 import mock
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from kubernetes import client
 from kubernetes.client.rest import ApiException
 import task_manager.executor as executor
 from task_manager.executor import Singleton, TaskExecutor, Task, TASK, RpcService
 from task_manager.models import TaskSettings, TaskVNCPod, TaskStorage
+import task_manager.settings_config as settings_config
+from task_manager.settings_config import config_checker
+from task_manager.dispatch_queue import DispatchQueue
+from task_manager.capacity import ClusterCapacity, parse_quantity
+from task_manager.lease import ExecutorMembership, shard_of
+from task_manager.expiry import ExpiryQueue
+from task_manager.autoscaler import PoolAutoscaler
+from task_manager.placement import get_placement_strategy
+from task_manager.ttl_scheduler import TtlScheduler
+from task_manager.slots import take_slot, reclaim
+from user_model.models import UserModel, UserType
 from .common import TestCaseWithBasicUser, MockCoreV1Api, MockThread, ReturnItemsList, DotDict, MockBatchV1Api, \
     MockExtensionsV1beta1Api, MockAppsV1Api
 
@@ -125,7 +140,18 @@ class MockCoreV1ApiForTTL(MockCoreV1Api):
             print("Remaining: {}".format(len(item_list)))
 
     def patch_namespaced_pod(self, name, namespace, body):
-        print(self, name, namespace, body.metadata.name)
+        print(self, name, namespace)
+        if not isinstance(body, dict):
+            return body
+        for item_list in MockCoreV1ApiForTTL.pod_map.values():
+            for item in item_list:
+                if item.metadata.name == name:
+                    if body['metadata']['resourceVersion'] != item.metadata.resource_version:
+                        raise ApiException(status=409)
+                    item.metadata.labels.update(body['metadata']['labels'])
+                    item.metadata.resource_version = str(int(item.metadata.resource_version or 0) + 1)
+                    return copy.deepcopy(item)
+        raise ApiException(status=404)
 
 
 def get_container_config():
@@ -162,14 +188,36 @@ class MockThreadedServer:
 class TestTaskExecutor(TestCaseWithBasicUser):
     def test_config_checker(self):
         config_correct = get_container_config()
-        self.assertEqual(executor.config_checker(config_correct), True)
+        self.assertEqual(config_checker(config_correct), True)
         config_correct['commands'] = ''
-        self.assertEqual(executor.config_checker(config_correct), False)
+        self.assertEqual(config_checker(config_correct), False)
         config_correct['commands'] = []
-        self.assertEqual(executor.config_checker(config_correct), True)
+        self.assertEqual(config_checker(config_correct), True)
         config_correct.pop('persistent_volume')
-        self.assertEqual(executor.config_checker(config_correct), False)
-        self.assertEqual(executor.config_checker([]), False)
+        self.assertEqual(config_checker(config_correct), False)
+        self.assertEqual(config_checker([]), False)
+
+    def test_settings_config_cache(self):
+        item = TaskSettings.objects.create(name='cached', uuid='cached_uuid', description='',
+                                           container_config=json.dumps(get_container_config()),
+                                           replica=1, max_sharing_users=1, time_limit=10)
+        settings_config.invalidate_settings_config(item.uuid)
+        cached = settings_config.get_settings_config(item)
+        self.assertIs(settings_config.get_settings_config(TaskSettings.objects.get(uuid=item.uuid)), cached)
+        pod = cached.build_storage_pod('pod', item.uuid)
+        self.assertIs(pod.spec.volumes, cached.volumes)
+        self.assertEqual(pod.spec.containers[0].volume_mounts[1].mount_path, settings_config.USER_DIR)
+        # stale entries are rebuilt even without explicit invalidation
+        item.time_limit = 20
+        changed = settings_config.get_settings_config(item)
+        self.assertIsNot(changed, cached)
+        self.assertIn('timeout --signal TERM 20', changed.job_args[1])
+        settings_config.invalidate_settings_config(item.uuid)
+        self.assertIsNot(settings_config.get_settings_config(item), changed)
+        item.container_config = 'bad_json'
+        self.assertRaises(ValueError, settings_config.get_settings_config, item)
+        self.assertRaises(ValueError, settings_config.get_settings_config, item)
+        settings_config.invalidate_settings_config(item.uuid)
 
     def test_helpers_function(self):
         executor.create_namespace()
@@ -248,6 +296,30 @@ class TestTaskExecutor(TestCaseWithBasicUser):
 
         task.get_user_space_pod('my_uuid', self.admin)
 
+    def test_sync_task_settings(self):
+        TaskSettings.objects.create(name='task', uuid='sync_uuid', description='',
+                                    container_config=json.dumps(get_container_config()),
+                                    replica=1, max_sharing_users=1, time_limit=0, ttl_interval=5)
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        with mock.patch.object(task, 'schedule_task_settings', wraps=task.schedule_task_settings) as scheduled:
+            task.dispatch()
+            self.assertEqual(scheduled.call_count, 1)
+            task._sync_task_settings()
+            self.assertEqual(scheduled.call_count, 1)
+            # changed by another process
+            TaskSettings.objects.filter(uuid='sync_uuid').update(ttl_interval=10)
+            task._sync_task_settings()
+            self.assertEqual(scheduled.call_count, 2)
+        self.assertEqual(task.ttl_scheduler.interval('sync_uuid'), 10)
+        with mock.patch.object(executor, 'SETTINGS_SYNC_INTERVAL', 0), \
+                self.assertLogs('task_manager.executor', level='INFO') as logs:
+            task.dispatch()
+        self.assertIn('TTL checks: 1 scheduled', '\n'.join(logs.output))
+        TaskSettings.objects.filter(uuid='sync_uuid').delete()
+        task._sync_task_settings()
+        self.assertNotIn('sync_uuid', task._scheduled_settings)
+
     def test_get_user_vnc_pod(self):
         TaskSettings.objects.create(name='task_okay', uuid='my_uuid_okay', description='',
                                     container_config=json.dumps(get_container_config()),
@@ -283,6 +355,7 @@ class TestTtlCheck(TestCaseWithBasicUser):
         corr = TaskSettings.objects.create(name='task', uuid='my_uuid', description='',
                                            container_config=json.dumps(get_container_config()),
                                            replica=2, max_sharing_users=2, time_limit=0)
+        TaskExecutor._instance = None
         task = TaskExecutor.instance(new=True, test=True)
         task._ttl_check('does-not-exist')  # affect nothing
         task._ttl_check(corr.uuid)
@@ -303,16 +376,731 @@ class TestTtlCheck(TestCaseWithBasicUser):
         item_1 = MockCoreV1ApiForTTL.pod_map['task=my_uuid'][1]
         item_0.metadata.labels['occupied'] = str(2)
         item_1.metadata.labels['occupied'] = str(1)
+        # users are coming, should expand ahead of them
         task._ttl_check(corr.uuid)
-        self.assertEqual(len(MockCoreV1ApiForTTL.pod_map['task=my_uuid']), 2)
+        self.assertEqual(len(MockCoreV1ApiForTTL.pod_map['task=my_uuid']), 3)
+        MockCoreV1ApiForTTL.pod_map['task=my_uuid'][2].status.phase = 'Running'
         item_1.metadata.labels['occupied'] = str(2)
 
         # all occupied, should expand
         task._ttl_check(corr.uuid)
         self.assertEqual(len(MockCoreV1ApiForTTL.pod_map['task=my_uuid']), 4)
 
-        # should recycle
+        # keep the pods while the peak is recent
         item_1.metadata.labels['occupied'] = str(0)
         MockCoreV1ApiForTTL.pod_map['task=my_uuid'][2].status.phase = 'Running'
         task._ttl_check(corr.uuid)
-        self.assertEqual(len(MockCoreV1ApiForTTL.pod_map['task=my_uuid']), 3)
+        self.assertEqual(len(MockCoreV1ApiForTTL.pod_map['task=my_uuid']), 4)
+        # users took the idle pods before they were claimed
+        with mock.patch('task_manager.autoscaler.time.time', return_value=time.time() + 1000), \
+                mock.patch.object(executor, 'reclaim', return_value=None):
+            task._ttl_check(corr.uuid)
+        self.assertEqual(len(MockCoreV1ApiForTTL.pod_map['task=my_uuid']), 4)
+        # should recycle
+        with mock.patch('task_manager.autoscaler.time.time', return_value=time.time() + 1000):
+            task._ttl_check(corr.uuid)
+        self.assertEqual(len(MockCoreV1ApiForTTL.pod_map['task=my_uuid']), 2)
+
+    def test_reclaim_races_take_slot(self):
+        pod = make_pod('race', {'task': 'race_uuid', 'occupied': '0'})
+        MockCoreV1ApiForTTL.pod_map['task=race_uuid'] = [pod]
+        api = MockCoreV1ApiForTTL(None)
+        # a user takes a slot after the pod was seen idle
+        seen = copy.deepcopy(pod)
+        self.assertIsNotNone(take_slot(api, pod, 2))
+        self.assertIsNone(reclaim(api, seen, 'race_uuid_deleted'))
+        self.assertEqual(pod.metadata.labels, {'task': 'race_uuid', 'occupied': '1'})
+        # the pod is reclaimed after a user saw it
+        seen = copy.deepcopy(pod)
+        self.assertIsNotNone(reclaim(api, pod, 'race_uuid_deleted'))
+        self.assertIsNone(take_slot(api, seen, 2))
+        self.assertEqual(pod.metadata.labels, {'task': 'race_uuid_deleted', 'occupied': '0'})
+        del MockCoreV1ApiForTTL.pod_map['task=race_uuid']
+
+
+def make_pod(name, labels, phase='Running', exit_code=None, resource_version='1'):
+    container_statuses = None
+    if exit_code is not None:
+        container_statuses = [
+            client.V1ContainerStatus(state=client.V1ContainerState(
+                terminated=client.V1ContainerStateTerminated(exit_code=exit_code)),
+                image='aaa', image_id='aaa', name='name', container_id='id', ready=False, restart_count=0)]
+    return client.V1Pod(metadata=client.V1ObjectMeta(name=name, labels=labels, resource_version=resource_version),
+                        status=client.V1PodStatus(phase=phase, container_statuses=container_statuses))
+
+
+def make_node(memory, unschedulable=None, ready='True'):
+    return client.V1Node(spec=client.V1NodeSpec(unschedulable=unschedulable),
+                         status=client.V1NodeStatus(allocatable={'memory': memory},
+                                                    conditions=[client.V1NodeCondition(type='Ready', status=ready)]))
+
+
+class MockWatch:
+    events = []
+
+    def stream(self, *_, **__):
+        for event in MockWatch.events:
+            yield event
+
+
+class TestPodInformer(TestCaseWithBasicUser):
+    def test_index(self):
+        informer = executor.PodInformer('task')
+        events = []
+        informer.add_handler(lambda event_type, pod: events.append((event_type, pod.metadata.name)))
+        informer.replace([make_pod('a', {'task': 'x'}), make_pod('b', {'task': 'y'})], '10')
+        self.assertTrue(informer.synced)
+        self.assertEqual(informer.resource_version, '10')
+        self.assertEqual([pod.metadata.name for pod in informer.get('x')], ['a'])
+        # relabel moves the pod to another bucket
+        informer.apply('MODIFIED', make_pod('a', {'task': 'x_deleted'}))
+        self.assertEqual(informer.get('x'), [])
+        self.assertEqual(len(informer.get('x_deleted')), 1)
+        informer.apply('DELETED', make_pod('b', {'task': 'y'}))
+        self.assertEqual(informer.get('y'), [])
+        # a relist drops pods that vanished meanwhile
+        informer.replace([], '11')
+        self.assertEqual(informer.get('x_deleted'), [])
+        self.assertIn(('DELETED', 'a'), events)
+
+    def test_list_falls_back_until_synced(self):
+        informer = executor.PodInformer('task')
+        api = MockCoreV1ApiForTTL(None)
+        MockCoreV1ApiForTTL.pod_map['task=x'] = [make_pod('a', {'task': 'x'})]
+        self.assertEqual(len(informer.list(api, 'x')), 1)
+        informer.replace([], '1')
+        self.assertEqual(informer.list(api, 'x'), [])
+        MockCoreV1ApiForTTL.pod_map.pop('task=x')
+
+    def test_watch(self):
+        informer = executor.PodInformer('task')
+        informer.replace([], '1')
+        MockWatch.events = [{'type': 'ADDED', 'object': make_pod('a', {'task': 'x'}, resource_version='5')},
+                            {'type': 'ERROR', 'raw_object': {'code': 410}}]
+        with mock.patch('task_manager.informer.watch.Watch', MockWatch):
+            self.assertFalse(informer.watch(MockCoreV1ApiForTTL(None)))
+            self.assertEqual(informer.resource_version, '5')
+            self.assertEqual(len(informer.get('x')), 1)
+            MockWatch.events = [{'type': 'DELETED', 'object': make_pod('a', {'task': 'x'}, resource_version='6')}]
+            self.assertTrue(informer.watch(MockCoreV1ApiForTTL(None)))
+            self.assertEqual(informer.get('x'), [])
+
+
+@mock.patch.object(executor, 'Thread', MockThread)
+@mock.patch.object(executor, 'CoreV1Api', MockCoreV1ApiForTTL)
+@mock.patch.object(executor, 'BatchV1Api', MockBatchV1Api)
+@mock.patch.object(executor, 'ThreadedServer', MockThreadedServer)
+@mock.patch.object(MockCoreV1ApiForTTL, 'list_namespaced_pod', None)  # pods must come from the informer
+class TestJobMonitorInformer(TestCaseWithBasicUser):
+    def test_job_monitor_events(self):
+        settings = TaskSettings.objects.create(name='task', uuid='my_uuid', description='',
+                                               container_config=json.dumps(get_container_config()),
+                                               replica=1, max_sharing_users=1, time_limit=0)
+        for uuid in ('t_ok', 't_tle', 't_mle', 't_late'):
+            Task.objects.create(settings=settings, user=self.admin, uuid=uuid, status=TASK.WAITING, logs='')
+        Task.objects.filter(uuid='t_late').update(status=TASK.SCHEDULED)
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        task.job_informer.replace([], '1')
+        task.job_informer.apply('ADDED', make_pod('p_ok', {'task-exec': 't_ok'}, phase='Pending'))
+        task.job_informer.apply('ADDED', make_pod('p_late', {'task-exec': 't_late'}, phase='Pending'))
+        task._job_monitor()
+        self.assertEqual(Task.objects.get(uuid='t_ok').status, TASK.PENDING)
+        self.assertEqual(Task.objects.get(uuid='t_tle').status, TASK.WAITING)
+        # the dispatcher has not caught up yet, the event is kept
+        self.assertIn('t_late', task._changed_tasks)
+        storage_informer = task.storage_informer
+        self.assertEqual(task._pop_changed_tasks(), {'t_late'})
+        self.assertEqual(task._changed_tasks, set())
+        self.assertIs(task.storage_informer, storage_informer)
+        task.job_informer.apply('MODIFIED', make_pod('p_ok', {'task-exec': 't_ok'}, phase='Succeeded',
+                                                     exit_code=0))
+        task.job_informer.apply('MODIFIED', make_pod('p_tle', {'task-exec': 't_tle'}, phase='Failed',
+                                                     exit_code=124))
+        task.job_informer.apply('MODIFIED', make_pod('p_mle', {'task-exec': 't_mle'}, phase='Failed',
+                                                     exit_code=137))
+        task._job_monitor()
+        item = Task.objects.get(uuid='t_ok')
+        self.assertEqual(item.status, TASK.SUCCEEDED)
+        self.assertTrue(item.logs_get)
+        log = 'Hello world log from pod p_ok in ns {}'.format(executor.KUBERNETES_NAMESPACE).encode()
+        self.assertEqual(item.log_size, len(log))
+        self.assertEqual(b''.join(bytes(data) for data in item.log_chunks.order_by('offset').values_list('data',
+                                                                                                       flat=True)),
+                         log)
+        self.assertTrue(Task.objects.get(uuid='t_tle').logs.endswith("Time limit exceeded when executing job."))
+        self.assertEqual(Task.objects.get(uuid='t_tle').status, TASK.TLE)
+        self.assertEqual(Task.objects.get(uuid='t_mle').status, TASK.MLE)
+        self.assertEqual(Task.objects.get(uuid='t_mle').exit_code, 137)
+
+    def test_job_monitor_retries_later(self):
+        settings = TaskSettings.objects.create(name='task', uuid='my_uuid', description='',
+                                               container_config=json.dumps(get_container_config()),
+                                               replica=1, max_sharing_users=1, time_limit=0)
+        Task.objects.create(settings=settings, user=self.admin, uuid='t_ok', status=TASK.RUNNING, logs='')
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        task.job_informer.replace([], '1')
+        task.job_informer.apply('MODIFIED', make_pod('p_ok', {'task-exec': 't_ok'}, phase='Succeeded', exit_code=0))
+        task.test = False
+        # as if the round had been woken up by the event of the pod
+        task._wakeups[executor.JOB_MONITOR].clear()
+        waits = []
+
+        def wait(loop, timeout):
+            waits.append((loop, timeout, task._wakeups[loop].is_set()))
+            raise InterruptedError
+
+        # the API server fails to send the log
+        with mock.patch.object(executor, 'capture_pod_log', side_effect=ApiException(status=500)), \
+                mock.patch.object(task, '_wait', wait), self.assertRaises(InterruptedError):
+            task._job_monitor()
+        # the next round waits for the delay instead of starting right away
+        self.assertEqual(waits, [(executor.JOB_MONITOR, executor.JOB_MONITOR_RETRY_DELAY, False)])
+        self.assertEqual(task._changed_tasks, {'t_ok'})
+        self.assertEqual(Task.objects.get(uuid='t_ok').status, TASK.RUNNING)
+        task.test = True
+        task._job_monitor()
+        self.assertEqual(Task.objects.get(uuid='t_ok').status, TASK.SUCCEEDED)
+
+    def test_job_monitor_batches_updates(self):
+        settings = TaskSettings.objects.create(name='task', uuid='my_uuid', description='',
+                                               container_config=json.dumps(get_container_config()),
+                                               replica=1, max_sharing_users=1, time_limit=0)
+        Task.objects.bulk_create([Task(settings=settings, user=self.admin, uuid='t_{}'.format(i),
+                                       status=TASK.RUNNING, logs='') for i in range(200)])
+        Task.objects.bulk_create([Task(settings=settings, user=self.admin, uuid='d_{}'.format(i),
+                                       status=TASK.DELETING, logs='') for i in range(50)])
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        task.job_informer.replace([], '1')
+        for i in range(200):
+            task.job_informer.apply('MODIFIED', make_pod('p_{}'.format(i), {'task-exec': 't_{}'.format(i)},
+                                                         phase='Succeeded', exit_code=0))
+        task.membership.renew()
+        with CaptureQueriesContext(connection) as queries:
+            task._job_monitor()
+        # one select per task list plus a couple of batched writes, independent of the number of tasks
+        self.assertLess(len(queries), 15)
+        self.assertEqual(Task.objects.filter(status=TASK.SUCCEEDED).count(), 200)
+        self.assertEqual(Task.objects.filter(status=TASK.DELETING).count(), 0)
+
+    def test_job_monitor_deletes_concurrently(self):
+        settings = TaskSettings.objects.create(name='task', uuid='my_uuid', description='',
+                                               container_config=json.dumps(get_container_config()),
+                                               replica=1, max_sharing_users=1, time_limit=0)
+        for i in range(4):
+            Task.objects.create(settings=settings, user=self.admin, uuid='t_{}'.format(i), logs='',
+                                status=TASK.DELETING)
+        # passes only once all deletions are in flight at the same time
+        barrier = Barrier(4, timeout=5)
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        task.membership.renew()
+        with mock.patch.object(MockBatchV1Api, 'delete_namespaced_job', staticmethod(lambda **_: barrier.wait())):
+            task._job_monitor()
+        self.assertFalse(barrier.broken)
+        self.assertEqual(Task.objects.count(), 0)
+
+    def test_storage_pod_monitor_batches_updates(self):
+        settings = TaskSettings.objects.create(name='task', uuid='my_uuid', description='',
+                                               container_config=json.dumps(get_container_config()),
+                                               replica=1, max_sharing_users=1, time_limit=0)
+        users = [UserModel.objects.create(uuid='u_{}'.format(i), username='u_{}'.format(i), password='',
+                                          email='u@example.com', user_type=UserType.USER, salt='')
+                 for i in range(30)]
+        TaskStorage.objects.bulk_create([TaskStorage(settings=settings, user=user, pod_name='gone',
+                                                     expire_time=round(time.time()) - 100) for user in users])
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        task.membership.renew()
+        with CaptureQueriesContext(connection) as queries:
+            task._storage_pod_monitor()
+        self.assertLess(len(queries), 10)
+        self.assertEqual(TaskStorage.objects.filter(expire_time=0, pod_name='').count(), 30)
+
+
+@mock.patch.object(executor, 'stream', mock_stream)
+@mock.patch.object(executor, 'CoreV1Api', MockCoreV1ApiForTTL)
+@mock.patch.object(MockCoreV1ApiForTTL, 'list_namespaced_pod', None)  # pods must come from the informer
+class TestStorageInformer(TestCaseWithBasicUser):
+    def test_cached_allocation(self):
+        corr = TaskSettings.objects.create(name='task', uuid='my_uuid', description='',
+                                           container_config=json.dumps(get_container_config()),
+                                           replica=2, max_sharing_users=1, time_limit=0)
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        task.storage_informer.replace([], '1')
+        task._ttl_check(corr.uuid)
+        # freshly created pods are visible before their watch events arrive
+        pods = task.storage_informer.get(corr.uuid)
+        self.assertEqual(len(pods), 2)
+        task._ttl_check(corr.uuid)
+        self.assertEqual(len(task.storage_informer.get(corr.uuid)), 2)
+        running = [make_pod(pod.metadata.name, {'task': corr.uuid, 'occupied': '0'}) for pod in pods]
+        MockCoreV1ApiForTTL.pod_map['task=my_uuid'] = running
+        for pod in running:
+            task.storage_informer.apply('MODIFIED', copy.deepcopy(pod))
+        ret = task.get_user_space_pod(corr.uuid, self.admin)
+        self.assertEqual(ret.metadata.labels['occupied'], '1')
+        cached = task.storage_informer.read(None, ret.metadata.name)
+        self.assertEqual(cached.metadata.labels['occupied'], '1')
+        # the second user must land on the other pod
+        ret_user = task.get_user_space_pod(corr.uuid, self.user)
+        self.assertNotEqual(ret.metadata.name, ret_user.metadata.name)
+        # already assigned pod is looked up locally
+        self.assertEqual(task.get_user_space_pod(corr.uuid, self.admin).metadata.name, ret.metadata.name)
+
+    def test_packed_allocation(self):
+        corr = TaskSettings.objects.create(name='task', uuid='my_uuid', description='',
+                                           container_config=json.dumps(get_container_config()),
+                                           replica=3, max_sharing_users=3, time_limit=0)
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        pods = [make_pod('a', {'task': corr.uuid, 'occupied': '0'}),
+                make_pod('b', {'task': corr.uuid, 'occupied': '2'}),
+                make_pod('c', {'task': corr.uuid, 'occupied': '3'})]
+        task.storage_informer.replace(copy.deepcopy(pods), '1')
+        with mock.patch.dict(MockCoreV1ApiForTTL.pod_map, {'task=my_uuid': pods}):
+            # the fullest pod with a free slot
+            self.assertEqual(task.get_user_space_pod(corr.uuid, self.admin).metadata.name, 'b')
+            self.assertEqual(pods[1].metadata.labels['occupied'], '3')
+            # another replica took the last slot of `a` after our cache saw it
+            pods[0].metadata.labels['occupied'] = '3'
+            pods[0].metadata.resource_version = '2'
+            self.assertIsNone(task.get_user_space_pod(corr.uuid, self.user))
+            self.assertEqual(pods[0].metadata.labels['occupied'], '3')
+            pods[0].metadata.labels['occupied'] = '2'
+            pods[0].metadata.resource_version = '3'
+            self.assertEqual(task.get_user_space_pod(corr.uuid, self.user).metadata.name, 'a')
+            self.assertEqual(pods[0].metadata.labels['occupied'], '3')
+
+
+class CountingBatchV1Api(MockBatchV1Api):
+    jobs = []
+
+    @staticmethod
+    def create_namespaced_job(**kwargs):
+        if kwargs['body'].metadata.name == 'task-exec-t_conflict':
+            raise ApiException(status=409)
+        if kwargs['body'].metadata.name == 'task-exec-t_error':
+            raise ApiException(status=500)
+        CountingBatchV1Api.jobs.append(kwargs['body'])
+
+
+@mock.patch.object(executor, 'Thread', MockThread)
+@mock.patch.object(executor, 'CoreV1Api', MockCoreV1ApiForTTL)
+@mock.patch.object(executor, 'BatchV1Api', CountingBatchV1Api)
+@mock.patch.object(executor, 'ThreadedServer', MockThreadedServer)
+class TestJobDispatch(TestCaseWithBasicUser):
+    def test_parallel_dispatch(self):
+        settings_a = TaskSettings.objects.create(name='a', uuid='uuid_a', description='',
+                                                 container_config=json.dumps(get_container_config()),
+                                                 replica=1, max_sharing_users=1, time_limit=10)
+        settings_b = TaskSettings.objects.create(name='b', uuid='uuid_b', description='',
+                                                 container_config=json.dumps(get_container_config()),
+                                                 replica=1, max_sharing_users=1, time_limit=20)
+        settings_bad = TaskSettings.objects.create(name='bad', uuid='uuid_bad', description='',
+                                                   container_config='bad_json',
+                                                   replica=1, max_sharing_users=1, time_limit=20)
+        for i in range(100):
+            Task.objects.create(settings=settings_a if i % 2 else settings_b, user=self.admin,
+                                uuid='t_{}'.format(i), logs='')
+        Task.objects.create(settings=settings_bad, user=self.admin, uuid='t_bad', logs='')
+        Task.objects.create(settings=settings_a, user=self.admin, uuid='t_conflict', logs='')
+        Task.objects.create(settings=settings_a, user=self.admin, uuid='t_error', logs='')
+        CountingBatchV1Api.jobs = []
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        for uuid in ('uuid_a', 'uuid_b', 'uuid_bad'):
+            settings_config.invalidate_settings_config(uuid)
+        with mock.patch.object(settings_config, 'SettingsConfig', wraps=settings_config.SettingsConfig) as template, \
+                mock.patch.object(executor, 'create_namespace', wraps=executor.create_namespace) as namespace:
+            task._job_dispatch()
+            # the failed submission is retried without re-checking the namespace or re-parsing configs
+            task._job_dispatch()
+            self.assertEqual(template.call_count, 3)
+            self.assertEqual(namespace.call_count, 1)
+        self.assertEqual(len(CountingBatchV1Api.jobs), 100)
+        self.assertEqual(Task.objects.filter(status=TASK.WAITING).count(), 101)
+        self.assertEqual(Task.objects.get(uuid='t_bad').status, TASK.FAILED)
+        self.assertEqual(Task.objects.get(uuid='t_error').status, TASK.SCHEDULED)
+        job = [job for job in CountingBatchV1Api.jobs if job.metadata.name == 'task-exec-t_1'][0]
+        container = job.spec.template.spec.containers[0]
+        self.assertEqual(job.spec.template.metadata.labels, {'task-exec': 't_1'})
+        self.assertIn('timeout --signal TERM 10', container.args[1])
+        self.assertEqual(container.volume_mounts[1].sub_path, 'user_{}_task_{}'.format(self.admin.id, settings_a.id))
+
+    def test_fair_share_dispatch(self):
+        settings_a = TaskSettings.objects.create(name='a', uuid='uuid_a', description='',
+                                                 container_config=json.dumps(get_container_config()),
+                                                 replica=1, max_sharing_users=1, time_limit=10)
+        settings_capped = TaskSettings.objects.create(name='c', uuid='uuid_c', description='',
+                                                      container_config=json.dumps(get_container_config()),
+                                                      replica=1, max_sharing_users=1, time_limit=10,
+                                                      max_running_tasks=2)
+        Task.objects.bulk_create([Task(settings=settings_a, user=self.admin, uuid='admin_{}'.format(i), logs='')
+                                  for i in range(20)])
+        Task.objects.bulk_create([Task(settings=settings_capped, user=self.admin, uuid='capped_{}'.format(i),
+                                       logs='', priority=1) for i in range(5)])
+        Task.objects.bulk_create([Task(settings=settings_a, user=self.user, uuid='user_{}'.format(i), logs='')
+                                  for i in range(3)])
+        CountingBatchV1Api.jobs = []
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        with mock.patch.object(executor, 'TASK_DISPATCH_BATCH_SIZE', 8):
+            task._job_dispatch()
+        names = [job.metadata.name for job in CountingBatchV1Api.jobs]
+        self.assertEqual(len(names), 8)
+        # higher priority first, but never more than the cap of its settings
+        self.assertEqual(len([name for name in names if name.startswith('task-exec-capped_')]), 2)
+        # the user with fewer tasks in flight is not starved by the bulk submitter
+        self.assertEqual(len([name for name in names if name.startswith('task-exec-user_')]), 3)
+        self.assertEqual(len(task.dispatch_queue), 20)
+        # tasks cancelled while queued are never submitted
+        Task.objects.filter(uuid__startswith='admin_').update(status=TASK.DELETING)
+        CountingBatchV1Api.jobs = []
+        task._job_dispatch()
+        self.assertEqual(CountingBatchV1Api.jobs, [])
+        self.assertEqual(Task.objects.filter(uuid__startswith='capped_', status=TASK.SCHEDULED).count(), 3)
+
+    def test_capacity_admission(self):
+        settings = TaskSettings.objects.create(name='a', uuid='uuid_a', description='',
+                                               container_config=json.dumps(get_container_config()),
+                                               replica=1, max_sharing_users=1, time_limit=10)
+        Task.objects.bulk_create([Task(settings=settings, user=self.admin, uuid='running_{}'.format(i), logs='',
+                                       status=TASK.RUNNING) for i in range(2)])
+        Task.objects.bulk_create([Task(settings=settings, user=self.admin, uuid='t_{}'.format(i), logs='')
+                                  for i in range(10)])
+        nodes = ReturnItemsList([make_node('1000M'), make_node('1000M', unschedulable=True),
+                                 make_node('1000M', ready='False')])
+        CountingBatchV1Api.jobs = []
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        with mock.patch.object(MockCoreV1ApiForTTL, 'list_node', create=True, new=lambda _self: nodes):
+            task._job_dispatch()
+            # 80% of 1000M minus the two running tasks leaves room for four tasks of 128M
+            self.assertEqual(len(CountingBatchV1Api.jobs), 4)
+            task._job_dispatch()
+            self.assertEqual(len(CountingBatchV1Api.jobs), 4)
+            Task.objects.filter(status=TASK.RUNNING).update(status=TASK.SUCCEEDED)
+            task._job_dispatch()
+            self.assertEqual(len(CountingBatchV1Api.jobs), 6)
+        self.assertEqual(task.cluster_capacity.memory, 10 ** 9)
+        self.assertEqual(len(task.dispatch_queue), 4)
+
+
+class TestCapacity(TestCaseWithBasicUser):
+    def test_parse_quantity(self):
+        self.assertEqual(parse_quantity('128M'), 128 * 10 ** 6)
+        self.assertEqual(parse_quantity('1.5Gi'), 3 * 2 ** 29)
+        self.assertEqual(parse_quantity('2048'), 2048)
+        self.assertEqual(parse_quantity('1e3k'), 10 ** 6)
+        self.assertEqual(parse_quantity(' 64Ki '), 64 * 1024)
+        self.assertRaises(ValueError, parse_quantity, '128MB')
+        self.assertRaises(ValueError, parse_quantity, '')
+
+    def test_invalid_memory_limit(self):
+        config = get_container_config()
+        config['memory_limit'] = 'a lot'
+        item = TaskSettings(id=1, uuid='invalid_memory', container_config=json.dumps(config), time_limit=0)
+        self.assertRaises(ValueError, settings_config.get_settings_config, item)
+        settings_config.invalidate_settings_config(item.uuid)
+
+    def test_refresh(self):
+        api = mock.Mock()
+        api.list_node.return_value = ReturnItemsList([make_node('1Gi'), make_node('512Mi')])
+        capacity = ClusterCapacity(refresh_interval=60)
+        self.assertEqual(capacity.refresh(api), 3 * 2 ** 29)
+        # served from memory within the refresh interval
+        self.assertEqual(capacity.refresh(api), 3 * 2 ** 29)
+        self.assertEqual(api.list_node.call_count, 1)
+        # the last known capacity survives API errors
+        capacity.refresh_interval = 0
+        api.list_node.side_effect = ApiException(status=403)
+        self.assertEqual(capacity.refresh(api), 3 * 2 ** 29)
+        self.assertIsNone(ClusterCapacity().refresh(api))
+
+
+class TestDispatchQueue(TestCaseWithBasicUser):
+    def test_order(self):
+        queue = DispatchQueue()
+        for i in range(1, 6):
+            queue.push(i, 'heavy', 's')
+        queue.push(6, 'light', 's')
+        queue.push(7, 'heavy', 's', priority=2)
+        queue.push(7, 'heavy', 's', priority=2)
+        self.assertEqual(len(queue), 7)
+        self.assertEqual(queue.last_id, 7)
+        # priority first, then the user with the smallest share, then submission order
+        self.assertEqual(queue.pop(4, share={'heavy': 0, 'light': 3}), [7, 1, 2, 3])
+        self.assertEqual(queue.pop(2), [4, 6])
+        self.assertNotIn(4, queue)
+        self.assertIn(5, queue)
+
+    def test_budget(self):
+        queue = DispatchQueue()
+        queue.push(1, 'u', 'large', priority=1)
+        queue.push(2, 'u', 'small')
+        queue.push(3, 'u', 'small')
+        # the large task does not fit, smaller ones behind it are admitted
+        self.assertEqual(queue.pop(10, budget=5, cost={'large': 10, 'small': 2}), [2, 3])
+        self.assertEqual(queue.pop(10, budget=10, cost={'large': 10}), [1])
+
+    def test_slots(self):
+        queue = DispatchQueue()
+        queue.push(1, 'u', 'capped')
+        queue.push(2, 'u', 'capped')
+        queue.push(3, 'u', 'free')
+        self.assertEqual(queue.pop(10, slots={'capped': 1}), [1, 3])
+        self.assertEqual(queue.pop(10, slots={'capped': 0}), [])
+        self.assertEqual(queue.pop(10), [2])
+        self.assertEqual(len(queue), 0)
+
+
+class TestPoolAutoscaler(TestCaseWithBasicUser):
+    def test_target(self):
+        autoscaler = PoolAutoscaler(window=300, headroom=1, lead_time=30, max_pods=12)
+        self.assertEqual(autoscaler.target('s', 0, 4, 1, 30, now=0), 1)
+        # 20 logins a minute are expected to continue
+        self.assertEqual(autoscaler.target('s', 20, 4, 1, 30, now=60), 10)
+        self.assertEqual(autoscaler.target('s', 40, 4, 1, 30, now=120), 12)
+        # everybody leaves, the pool is kept until the peak leaves the window
+        self.assertEqual(autoscaler.target('s', 0, 4, 1, 30, now=180), 12)
+        self.assertEqual(autoscaler.target('s', 0, 4, 1, 30, now=500), 1)
+        self.assertEqual(autoscaler.target('s', 0, 4, 3, 30, now=510), 3)
+        autoscaler.forget('s')
+        self.assertEqual(autoscaler.target('s', 5, 4, 1, 30, now=520), 2)
+
+
+class TestPlacement(TestCaseWithBasicUser):
+    @staticmethod
+    def make_pods(*pods):
+        return [client.V1Pod(metadata=client.V1ObjectMeta(name=name, labels={'occupied': str(occupied)}),
+                             spec=client.V1PodSpec(containers=[], node_name=node))
+                for name, occupied, node in pods]
+
+    def test_strategies(self):
+        pool = self.make_pods(('a', 1, 'n1'), ('b', 2, 'n1'), ('c', 0, 'n2'), ('d', 3, 'n2'), ('e', 4, 'n2'))
+        candidates = pool[:4]
+
+        def names(strategy):
+            return [pod.metadata.name for pod in get_placement_strategy(strategy)(candidates, pool)]
+
+        self.assertEqual(names('pack'), ['d', 'b', 'a', 'c'])
+        self.assertEqual(names('spread'), ['c', 'a', 'b', 'd'])
+        # n2 hosts 7 users, n1 only 3
+        self.assertEqual(names('node_pack'), ['d', 'c', 'b', 'a'])
+        self.assertEqual(names(lambda pods, _: list(reversed(pods))), ['d', 'c', 'b', 'a'])
+        with self.assertRaises(ValueError):
+            get_placement_strategy('random')
+
+
+class TestTtlScheduler(TestCaseWithBasicUser):
+    def test_coalesce(self):
+        submitted = []
+        runs = []
+        scheduler = TtlScheduler(lambda fn, *args: submitted.append((fn, args)), jitter=0.5)
+        with mock.patch('task_manager.ttl_scheduler.time.time', return_value=1000):
+            scheduler.add('jittered', 10, lambda: None)
+            # first runs are spread over the second half of the interval
+            self.assertTrue(1005 <= scheduler.next_due() <= 1010)
+        scheduler = TtlScheduler(lambda fn, *args: submitted.append((fn, args)), jitter=0)
+        with mock.patch('task_manager.ttl_scheduler.time.time', return_value=1000):
+            scheduler.add('a', 10, lambda: runs.append('a'))
+            scheduler.add('b', 10, lambda: runs.append('b'))
+        with mock.patch('task_manager.ttl_scheduler.time.time', return_value=1010):
+            scheduler.run_pending()
+        self.assertEqual(len(submitted), 2)
+        # the API server is slow, `a` comes due many times while its run is still queued
+        fn, args = submitted.pop(0)
+        for now in (1020, 1030, 1040):
+            with mock.patch('task_manager.ttl_scheduler.time.time', return_value=now):
+                scheduler.run_pending()
+        self.assertEqual(len(submitted), 1)
+        self.assertEqual(scheduler.stats()['running'], 2)
+        self.assertEqual(scheduler.stats()['coalesced'], 2)
+        with mock.patch('task_manager.ttl_scheduler.time.time', return_value=1045):
+            fn(*args)
+            self.assertEqual(scheduler.stats()['lag']['a'], 35)
+            # one run right after the late one instead of all the missed ones
+            scheduler.run_pending()
+        self.assertEqual(runs, ['a'])
+        self.assertEqual(len(submitted), 2)
+        scheduler.remove('b')
+        with mock.patch('task_manager.ttl_scheduler.time.time', return_value=1100):
+            scheduler.run_pending()
+        self.assertEqual(len(submitted), 2)
+        self.assertIsNone(scheduler.interval('b'))
+        self.assertEqual(scheduler.interval('a'), 10)
+
+    def test_add_again(self):
+        submitted = []
+        runs = []
+        scheduler = TtlScheduler(lambda fn, *args: submitted.append((fn, args)), jitter=0)
+        with mock.patch('task_manager.ttl_scheduler.time.time', return_value=1000):
+            scheduler.add('a', 10, lambda: runs.append(1))
+        with mock.patch('task_manager.ttl_scheduler.time.time', return_value=1010):
+            scheduler.run_pending()
+            # settings saved while the check is running
+            scheduler.add('a', 10, lambda: runs.append(2))
+            self.assertEqual(scheduler.next_due(), 1020)
+            scheduler.add('a', 5, lambda: runs.append(3))
+            self.assertEqual(scheduler.next_due(), 1015)
+        self.assertEqual(scheduler.stats()['running'], 1)
+        with mock.patch('task_manager.ttl_scheduler.time.time', return_value=1015):
+            scheduler.run_pending()
+        # still a single run in flight, the missed one follows it
+        self.assertEqual(len(submitted), 1)
+        self.assertEqual(scheduler.stats()['overdue'], 1)
+        fn, args = submitted.pop(0)
+        with mock.patch('task_manager.ttl_scheduler.time.time', return_value=1016):
+            fn(*args)
+            scheduler.run_pending()
+            fn, args = submitted.pop(0)
+            fn(*args)
+        # queued runs call the function added last
+        self.assertEqual(runs, [3, 3])
+        self.assertEqual(scheduler.stats()['runs'], 2)
+        self.assertEqual(scheduler.stats()['overdue'], 0)
+
+
+class TestExpiryQueue(TestCaseWithBasicUser):
+    def test_pop_due(self):
+        queue = ExpiryQueue()
+        queue.push(30, 'c')
+        queue.push(10, 'a')
+        queue.push(20, 'b')
+        # a later expiration does not postpone the key, an earlier one supersedes it
+        queue.push(40, 'a')
+        queue.push(5, 'c')
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.next_expire(), 5)
+        self.assertEqual(queue.pop_due(10), ['c', 'a'])
+        self.assertNotIn('c', queue)
+        self.assertEqual(queue.next_expire(), 20)
+        self.assertEqual(queue.pop_due(30), ['b'])
+        self.assertIsNone(queue.next_expire())
+
+    @mock.patch.object(executor, 'Thread', MockThread)
+    @mock.patch.object(executor, 'CoreV1Api', MockCoreV1ApiForTTL)
+    @mock.patch.object(executor, 'ThreadedServer', MockThreadedServer)
+    def test_storage_pod_monitor(self):
+        settings = TaskSettings.objects.create(name='task', uuid='my_uuid', description='',
+                                               container_config=json.dumps(get_container_config()),
+                                               replica=1, max_sharing_users=1, time_limit=0)
+        users = [UserModel.objects.create(uuid='u_{}'.format(i), username='u_{}'.format(i), password='',
+                                          email='u@example.com', user_type=UserType.USER, salt='')
+                 for i in range(3)]
+        expired = TaskStorage.objects.create(settings=settings, user=users[0], pod_name='gone',
+                                             expire_time=round(time.time()) - 100)
+        extended = TaskStorage.objects.create(settings=settings, user=users[1], pod_name='gone',
+                                              expire_time=round(time.time()) - 100)
+        TaskStorage.objects.create(settings=settings, user=users[2], pod_name='gone',
+                                   expire_time=round(time.time()) + 1000)
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        task.membership.renew()
+        # extended by a webshell after being queued
+        task.expiry_queue.push(expired.expire_time, (executor.USER_SPACE_POD, extended.id))
+        TaskStorage.objects.filter(id=extended.id).update(expire_time=round(time.time()) + 500)
+        task._expiry_synced = time.time()
+        task._expiry_generation = task.membership.generation
+        task.expiry_queue.push(expired.expire_time, (executor.USER_SPACE_POD, expired.id))
+        task._storage_pod_monitor()
+        self.assertEqual(TaskStorage.objects.get(id=expired.id).expire_time, 0)
+        self.assertEqual(TaskStorage.objects.get(id=extended.id).pod_name, 'gone')
+        self.assertEqual(task.expiry_queue.next_expire(), round(time.time()) + 500)
+        # nothing is due, so the database is not queried
+        with CaptureQueriesContext(connection) as queries:
+            task._storage_pod_monitor()
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(TaskStorage.objects.filter(expire_time__gt=0).count(), 2)
+
+
+class TestExecutorMembership(TestCaseWithBasicUser):
+    def test_failover(self):
+        first = ExecutorMembership(shards=4, duration=15, identity='first')
+        second = ExecutorMembership(shards=4, duration=15, identity='second')
+        first.renew()
+        self.assertTrue(first.is_leader())
+        self.assertEqual(first.shards, {0, 1, 2, 3})
+        second.renew()
+        self.assertFalse(second.is_leader())
+        self.assertEqual(second.shards, set())
+        # shards are handed over to the new replica
+        first.renew()
+        second.renew()
+        self.assertEqual(first.shards, {0, 1})
+        self.assertEqual(second.shards, {2, 3})
+        keys = ['task_{}'.format(i) for i in range(20)]
+        for key in keys:
+            self.assertNotEqual(first.owns(key), second.owns(key))
+            self.assertEqual(second.owns(key), shard_of(key, 4) in (2, 3))
+        # the first replica dies
+        with mock.patch('task_manager.lease.time.time', return_value=time.time() + 20):
+            second.renew()
+            self.assertTrue(second.is_leader())
+            self.assertEqual(second.shards, {0, 1, 2, 3})
+            self.assertFalse(first.is_leader())
+            self.assertFalse(first.owns('task_0'))
+
+    def test_release(self):
+        first = ExecutorMembership(shards=2, duration=15, identity='first')
+        second = ExecutorMembership(shards=2, duration=15, identity='second')
+        first.renew()
+        generation = first.generation
+        first.release()
+        self.assertGreater(first.generation, generation)
+        second.renew()
+        self.assertTrue(second.is_leader())
+        self.assertEqual(second.shards, {0, 1})
+
+    @mock.patch.object(executor, 'Thread', MockThread)
+    @mock.patch.object(executor, 'CoreV1Api', MockCoreV1ApiForTTL)
+    @mock.patch.object(executor, 'BatchV1Api', CountingBatchV1Api)
+    @mock.patch.object(executor, 'ThreadedServer', MockThreadedServer)
+    def test_only_leader_dispatches(self):
+        settings = TaskSettings.objects.create(name='a', uuid='uuid_a', description='',
+                                               container_config=json.dumps(get_container_config()),
+                                               replica=1, max_sharing_users=1, time_limit=10)
+        Task.objects.create(settings=settings, user=self.admin, uuid='t_0', logs='')
+        ExecutorMembership(identity='other').renew()
+        CountingBatchV1Api.jobs = []
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        with mock.patch.object(executor.time, 'sleep'):
+            task._job_dispatch()
+        self.assertEqual(CountingBatchV1Api.jobs, [])
+        self.assertEqual(Task.objects.get(uuid='t_0').status, TASK.SCHEDULED)
+
+
+@mock.patch.object(executor, 'Thread', MockThread)
+@mock.patch.object(executor, 'ThreadedServer', MockThreadedServer)
+class TestWakeUp(TestCaseWithBasicUser):
+    def test_wake_up(self):
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        waiter = Thread(target=task._wait, args=(executor.JOB_DISPATCH, 30))
+        start = time.time()
+        waiter.start()
+        executor.notify_executor(executor.JOB_DISPATCH)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertLess(time.time() - start, 5)
+        # the flag is consumed by the wait
+        self.assertFalse(task._wakeups[executor.JOB_DISPATCH].is_set())
+
+    def test_pod_event_wakes_monitor(self):
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        task.job_informer.apply('ADDED', make_pod('p', {'task-exec': 't'}))
+        self.assertTrue(task._wakeups[executor.JOB_MONITOR].is_set())
+        self.assertFalse(task._wakeups[executor.JOB_DISPATCH].is_set())
+
+    def test_rpc_wake_up(self):
+        TaskExecutor._instance = None
+        task = TaskExecutor.instance(new=True, test=True)
+        RpcService().exposed_wake_up(executor.JOB_MONITOR, executor.STORAGE_MONITOR)
+        self.assertTrue(task._wakeups[executor.JOB_MONITOR].is_set())
+        self.assertTrue(task._wakeups[executor.STORAGE_MONITOR].is_set())
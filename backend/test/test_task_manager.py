@@ -2,14 +2,40 @@
 Unit Test for TaskManager
 """
 from uuid import uuid1
+import os
+import time
 import json
+import importlib
 import mock
+from urllib3.exceptions import ReadTimeoutError
 from django.test import RequestFactory
+from django.apps import apps
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from task_manager.models import TaskSettings, Task, TASK
 import task_manager.views as views
 from user_model.models import UserModel, UserType
 from api.common import RESPONSE
-from .common import login_test_user, TestCaseWithBasicUser, MockCoreV1Api, MockTaskExecutor
+from config import TASK_LOG_TAIL_SECONDS
+from task_manager.task_log import split_chunks, build_chunks, save_chunks, read_stored_log, LogTailHub
+from .common import login_test_user, TestCaseWithBasicUser, MockCoreV1Api, MockTaskExecutor, MockPodLogResponse, \
+    MockFollowLogApi
+
+
+class MockCoreV1ApiFollow(MockCoreV1Api):
+    written = b' and more'
+
+    @staticmethod
+    def read_namespaced_pod_log(name, namespace, _preload_content=True, **kwargs):
+        if not kwargs.pop('follow', False):
+            return MockCoreV1Api.read_namespaced_pod_log(name, namespace, _preload_content, **kwargs)
+        log = MockCoreV1Api.read_namespaced_pod_log(name, namespace).encode() + MockCoreV1ApiFollow.written
+        return MockPodLogResponse(log, **kwargs)
+
+
+class MockTimeoutResponse(MockPodLogResponse):
+    def stream(self, amt):
+        raise ReadTimeoutError(None, None, 'Read timed out.')
 
 
 class TestTask(TestCaseWithBasicUser):
@@ -38,6 +64,130 @@ class TestTask(TestCaseWithBasicUser):
         self.assertEqual(response['status'], 200)
         self.assertTrue(response['payload']['log'].startswith('Hello world log from pod'))
 
+    def test_get_task_log_range(self):
+        settings = TaskSettings.objects.create(uuid='unique_id', name="task_name", description="test",
+                                               container_config=json.dumps({}), ttl_interval=3, replica=3,
+                                               time_limit=5, max_sharing_users=1)
+        output = 'héllo wörld, 你好\n' * 10
+        task = Task.objects.create(user=UserModel.objects.get(username='admin'), settings=settings, uuid='t_log',
+                                   status=TASK.TLE, logs='\nTime limit exceeded when executing job.', logs_get=True)
+        save_chunks(build_chunks(task, split_chunks([output.encode()], size=16)))
+        task.save()
+        token = login_test_user('admin')
+        log = ''
+        offset = 0
+        while True:
+            response = self.client.get('/task/t_log/', {'offset': offset, 'limit': 7}, HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+            payload = json.loads(response.content)['payload']
+            self.assertEqual(payload['log_offset'], offset)
+            self.assertLessEqual(payload['log_next_offset'] - offset, 7)
+            log += payload['log']
+            offset = payload['log_next_offset']
+            if payload['log_complete']:
+                break
+        # characters are never split between ranges
+        self.assertEqual(log, output + task.logs)
+        self.assertEqual(offset, payload['log_size'])
+        for query in ({'offset': -1}, {'limit': 0}, {'offset': 'a'}):
+            response = self.client.get('/task/t_log/', query, HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+            self.assertEqual(json.loads(response.content)['status'], RESPONSE.INVALID_REQUEST['status'])
+
+    def test_compressed_log(self):
+        settings = TaskSettings.objects.create(uuid='unique_id', name="task_name", description="test",
+                                               container_config=json.dumps({}), ttl_interval=3, replica=3,
+                                               time_limit=5, max_sharing_users=1)
+        task = Task.objects.create(user=self.admin, settings=settings, uuid='t_log', logs_get=True)
+        noise = os.urandom(1000)
+        text = b'a' * 10000
+        save_chunks(build_chunks(task, [noise, text]))
+        task.save()
+        # incompressible chunks are stored as is
+        self.assertEqual(list(task.log_chunks.order_by('offset').values_list('codec', flat=True)), ['', 'zlib'])
+        self.assertLess(len(task.log_chunks.get(offset=1000).data), 1000)
+        self.assertEqual(read_stored_log(task, 990, 20), noise[990:] + text[:10])
+        # logs of earlier versions are moved into chunks
+        legacy = Task.objects.create(user=self.admin, settings=settings, uuid='t_legacy', logs='é' * 40000,
+                                     logs_get=True)
+        migration = importlib.import_module('task_manager.migrations.0007_tasklogchunk_codec')
+        migration.compress_logs(apps, None)
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.logs, '')
+        self.assertEqual(legacy.log_chunks.count(), 2)
+        self.assertEqual(read_stored_log(legacy, 0, legacy.log_size).decode(), 'é' * 40000)
+        self.assertEqual(Task.objects.get(uuid='t_log').log_chunks.count(), 2)
+
+    @mock.patch.object(views, 'CoreV1Api', MockCoreV1ApiFollow)
+    def test_follow_task_log(self):
+        settings = TaskSettings.objects.create(uuid='unique_id', name="task_name", description="test",
+                                               container_config=json.dumps({}), ttl_interval=3, replica=3,
+                                               time_limit=5, max_sharing_users=1)
+        Task.objects.create(user=UserModel.objects.get(username='admin'), settings=settings, uuid='t_log',
+                            status=TASK.RUNNING)
+        token = login_test_user('admin')
+        response = self.client.get('/task/t_log/', {'limit': 11}, HTTP_X_ACCESS_TOKEN=token,
+                                   HTTP_X_ACCESS_USERNAME='admin')
+        payload = json.loads(response.content)['payload']
+        self.assertEqual(payload['log'], 'Hello world')
+        self.assertIsNone(payload['log_size'])
+        self.assertFalse(payload['log_complete'])
+        offset = len(MockCoreV1Api.read_namespaced_pod_log('task-exec=t_log', views.KUBERNETES_NAMESPACE))
+        response = self.client.get('/task/t_log/', {'offset': offset}, HTTP_X_ACCESS_TOKEN=token,
+                                   HTTP_X_ACCESS_USERNAME='admin')
+        self.assertEqual(json.loads(response.content)['payload']['log'], '')
+        # waits for output written after the end of the log
+        response = self.client.get('/task/t_log/', {'offset': offset, 'follow': 1}, HTTP_X_ACCESS_TOKEN=token,
+                                   HTTP_X_ACCESS_USERNAME='admin')
+        payload = json.loads(response.content)['payload']
+        self.assertEqual(payload['log'], ' and more')
+        self.assertEqual(payload['log_next_offset'], offset + len(' and more'))
+        with mock.patch('test.test_task_manager.MockPodLogResponse', MockTimeoutResponse):
+            response = self.client.get('/task/t_log/', {'offset': offset, 'follow': 1}, HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+        payload = json.loads(response.content)['payload']
+        self.assertEqual(payload['log'], '')
+        self.assertEqual(payload['log_next_offset'], offset)
+        # ranges of a running task end at TASK_LOG_LIVE_READ_SIZE
+        with mock.patch('task_manager.task_log.TASK_LOG_LIVE_READ_SIZE', 5):
+            response = self.client.get('/task/t_log/', {'limit': 11}, HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+            self.assertEqual(json.loads(response.content)['payload']['log'], 'Hello')
+            response = self.client.get('/task/t_log/', {'offset': 5}, HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+            self.assertEqual(json.loads(response.content)['status'], RESPONSE.INVALID_REQUEST['status'])
+
+    def test_get_task_list(self):
+        settings = [TaskSettings.objects.create(uuid='uuid_{}'.format(i), name="task_{}".format(i), description="",
+                                                container_config=json.dumps({}), ttl_interval=3, replica=1,
+                                                time_limit=5, max_sharing_users=1) for i in range(3)]
+        token = login_test_user('admin')
+
+        def get_list(query):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/task/', query, HTTP_X_ACCESS_TOKEN=token, HTTP_X_ACCESS_USERNAME='admin')
+            return len(queries), json.loads(response.content)['payload']
+
+        Task.objects.create(user=self.admin, settings=settings[0], uuid='t_first')
+        few, _ = get_list({})
+        Task.objects.bulk_create([Task(user=[self.admin, self.user][i % 2], settings=settings[i % 3],
+                                       uuid='t_{}'.format(i), status=i % 4) for i in range(40)])
+        # settings and users of the tasks are joined
+        many, payload = get_list({})
+        self.assertEqual(few, many)
+        self.assertEqual(payload['count'], 41)
+        self.assertEqual(payload['page_count'], 2)
+        entries = payload['entry']
+        while payload['next_cursor']:
+            _, payload = get_list({'cursor': payload['next_cursor']})
+            self.assertNotIn('count', payload)
+            entries += payload['entry']
+        expected = Task.objects.select_related('settings', 'user').order_by('-create_time', 'status', '-id')
+        self.assertEqual([(entry['uuid'], entry['settings']['name'], entry['user']) for entry in entries],
+                         [(item.uuid, item.settings.name, item.user.username) for item in expected])
+        _, payload = get_list({'page': 2})
+        self.assertEqual([entry['uuid'] for entry in payload['entry']], [item.uuid for item in expected[25:]])
+
     def test_get_task_invalid_req(self):
         token = login_test_user('admin')
         response = self.client.get('/task/?page=invalid', HTTP_X_ACCESS_TOKEN=token, HTTP_X_ACCESS_USERNAME='admin')
@@ -62,6 +212,22 @@ class TestTask(TestCaseWithBasicUser):
         response = json.loads(response.content)
         self.assertEqual(response['status'], RESPONSE.OPERATION_FAILED['status'])
 
+    def test_create_task_priority(self):
+        TaskSettings.objects.create(uuid='my_uuid', name="task_name", description="test",
+                                    container_config=json.dumps({}), ttl_interval=3, replica=1, time_limit=5,
+                                    max_sharing_users=1)
+        for username, priority, status in (('user', 5, RESPONSE.PERMISSION_DENIED['status']),
+                                           ('user', 'high', RESPONSE.INVALID_REQUEST['status']),
+                                           ('admin', 5, 200)):
+            token = login_test_user(username)
+            response = self.client.post('/task/', data=json.dumps({'settings_uuid': 'my_uuid', 'priority': priority}),
+                                        content_type='application/json', HTTP_X_REQUEST_WITH='XMLHttpRequest',
+                                        HTTP_X_ACCESS_TOKEN=token, HTTP_X_ACCESS_USERNAME=username)
+            response = json.loads(response.content)
+            self.assertEqual(response['status'], status)
+        self.assertEqual(response['payload']['priority'], 5)
+        self.assertEqual(Task.objects.get(uuid=response['payload']['uuid']).priority, 5)
+
     def test_get_task_item_failures(self):
         token = login_test_user('admin')
         response = self.client.get('/task/{}/'.format('invalid_uuid'),
@@ -86,6 +252,12 @@ class TestTask(TestCaseWithBasicUser):
         token = login_test_user('admin')
         task_list = []
         # add 30 tasks
+        with mock.patch.object(views, 'notify_executor') as notify:
+            self.client.post('/task/', data=json.dumps({'settings_uuid': 'my_uuid'}),
+                             content_type='application/json', HTTP_X_REQUEST_WITH='XMLHttpRequest',
+                             HTTP_X_ACCESS_TOKEN=token, HTTP_X_ACCESS_USERNAME='admin')
+            notify.assert_called_once_with(views.JOB_DISPATCH)
+        Task.objects.all().delete()
         for _ in range(0, 30):
             response = self.client.post('/task/', data=json.dumps({
                 'settings_uuid': 'my_uuid'
@@ -118,12 +290,57 @@ class TestTask(TestCaseWithBasicUser):
             self.assertEqual(response['status'], 200)
             self.assertEqual(response['payload']['uuid'], uuid)
         # delete all tasks
-        for uuid in task_list:
-            response = self.client.delete('/task/{}/'.format(uuid),
-                                          HTTP_X_ACCESS_TOKEN=token, HTTP_X_ACCESS_USERNAME='admin')
-            self.assertEqual(response.status_code, 200)
-            response = json.loads(response.content)
-            self.assertEqual(response['status'], 200)
+        with mock.patch.object(views, 'notify_executor') as notify:
+            for uuid in task_list:
+                response = self.client.delete('/task/{}/'.format(uuid),
+                                              HTTP_X_ACCESS_TOKEN=token, HTTP_X_ACCESS_USERNAME='admin')
+                self.assertEqual(response.status_code, 200)
+                response = json.loads(response.content)
+                self.assertEqual(response['status'], 200)
+            notify.assert_called_with(views.JOB_MONITOR)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("Condition not met in time")
+        time.sleep(0.01)
+
+
+class TestLogTail(TestCaseWithBasicUser):
+    def test_shared_tail(self):
+        hub = LogTailHub()
+        api = hub._api = MockFollowLogApi()
+        first = []
+        second = []
+        hub.subscribe('t_log', 'p_log', first.append)
+        api.pieces.put(b'hello ')
+        wait_for(lambda: first == ['hello '])
+        # joining viewers get the recent output at once from the same stream
+        hub.subscribe('t_log', 'p_log', second.append)
+        self.assertEqual(second, ['hello '])
+        data = 'wörld\n'.encode()
+        api.pieces.put(data[:2])
+        api.pieces.put(data[2:])
+        wait_for(lambda: ''.join(second) == 'hello wörld\n')
+        self.assertEqual(''.join(first), 'hello wörld\n')
+        self.assertEqual(len(api.calls), 1)
+        self.assertTrue(api.calls[0][2]['follow'])
+        self.assertEqual(api.calls[0][2]['since_seconds'], TASK_LOG_TAIL_SECONDS)
+        self.assertEqual(hub.viewers('t_log'), 2)
+        hub.unsubscribe('t_log', second.append)
+        # the log ends when the task finishes
+        api.pieces.put(None)
+        wait_for(lambda: first[-1] is None)
+        self.assertNotIn(None, second)
+        self.assertEqual(hub.viewers('t_log'), 0)
+        # the stream is closed when the last viewer leaves
+        hub.subscribe('t_log', 'p_log', first.append)
+        wait_for(lambda: len(api.calls) == 2)
+        hub.unsubscribe('t_log', first.append)
+        wait_for(lambda: api.pieces.empty())
+        self.assertEqual(hub.viewers('t_log'), 0)
 
 
 @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
@@ -166,6 +383,29 @@ class TestTaskSettings(TestCaseWithBasicUser):
         self.assertEqual(response['payload']['page_count'], 2)
         self.assertEqual(response['payload']['entry'][0]['name'], 'task_9')
 
+    def test_get_list_queries(self):
+        token = login_test_user('user')
+
+        def get_list(query):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/task_settings/', query, HTTP_X_ACCESS_TOKEN=token,
+                                           HTTP_X_ACCESS_USERNAME='user')
+            return len(queries), json.loads(response.content)['payload']
+
+        count, payload = get_list({'order_by': '-create_time'})
+        names = [entry['name'] for entry in payload['entry']]
+        self.assertNotIn('container_config', payload['entry'][0])
+        _, payload = get_list({'order_by': '-create_time', 'cursor': payload['next_cursor']})
+        names += [entry['name'] for entry in payload['entry']]
+        self.assertIsNone(payload['next_cursor'])
+        self.assertEqual(names, ['task_{}'.format(i) for i in range(29, -1, -1)])
+        TaskSettings.objects.bulk_create([TaskSettings(uuid=str(uuid1()), name="more_{}".format(i), description="",
+                                                       container_config='{}') for i in range(30)])
+        self.assertEqual(get_list({'order_by': '-create_time'})[0], count)
+        response = self.client.get('/task_settings/', {'order_by': 'description'}, HTTP_X_ACCESS_TOKEN=token,
+                                   HTTP_X_ACCESS_USERNAME='user')
+        self.assertEqual(json.loads(response.content)['status'], RESPONSE.INVALID_REQUEST['status'])
+
     def test_get_list_2(self):
         token = login_test_user('admin')
         response = self.client.get('/task_settings/?page=2', HTTP_X_ACCESS_TOKEN=token,
@@ -354,13 +594,32 @@ class TestTaskSettings(TestCaseWithBasicUser):
                                        'time_limit': 3,
                                        'replica': 2,
                                        'ttl_interval': 100,
-                                       'max_sharing_users': 10
+                                       'max_sharing_users': 10,
+                                       'max_running_tasks': 4
                                    }), content_type='application/json', HTTP_X_REQUEST_WITH='XMLHttpRequest',
                                    HTTP_X_ACCESS_TOKEN=token,
                                    HTTP_X_ACCESS_USERNAME='admin')
         self.assertEqual(response.status_code, 200)
         response = json.loads(response.content)
         self.assertEqual(response['status'], 200)
+        response = self.client.get('/task_settings/{}/'.format(self.item_list[0].uuid), HTTP_X_ACCESS_TOKEN=token,
+                                   HTTP_X_ACCESS_USERNAME='admin')
+        self.assertEqual(json.loads(response.content)['payload']['max_running_tasks'], 4)
+
+    def test_update_and_delete_invalidate_config(self):
+        token = login_test_user('admin')
+        uuid = self.item_list[0].uuid
+        with mock.patch.object(views, 'invalidate_settings_config') as invalidate:
+            response = self.client.put('/task_settings/{}/'.format(uuid),
+                                       data=json.dumps({'container_config': {'image': 'new'}}),
+                                       content_type='application/json', HTTP_X_REQUEST_WITH='XMLHttpRequest',
+                                       HTTP_X_ACCESS_TOKEN=token, HTTP_X_ACCESS_USERNAME='admin')
+            self.assertEqual(json.loads(response.content)['status'], 200)
+            invalidate.assert_called_once_with(uuid)
+            response = self.client.delete('/task_settings/{}/'.format(uuid), HTTP_X_ACCESS_TOKEN=token,
+                                          HTTP_X_ACCESS_USERNAME='admin')
+            self.assertEqual(json.loads(response.content)['status'], 200)
+            self.assertEqual(invalidate.call_count, 2)
 
     # Test for server error
     def test_server_error(self):
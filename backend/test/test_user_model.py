@@ -3,7 +3,9 @@ import uuid
 import time
 import mock
 import bcrypt
+from django.db import connection
 from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from api.common import RESPONSE
 import user_model.views as view
 from user_model.models import UserModel, UserType
@@ -222,6 +224,35 @@ class TestSuperAdminApis(TestCaseWithBasicUser):
         self.assertEqual(response['payload']['page_count'], 1)
         self.assertEqual(response['payload']['entry'][0]['uuid'], self.admin.uuid)
 
+    def test_get_list_admin_queries(self):
+        token = login_test_user('su_admin')
+
+        def get_list(query):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/user/admin/', query, HTTP_X_ACCESS_TOKEN=token,
+                                           HTTP_X_ACCESS_USERNAME='su_admin')
+            return len(queries), json.loads(response.content)['payload']
+
+        few, _ = get_list({})
+        UserModel.objects.bulk_create([UserModel(uuid=str(get_uuid()), username='admin_{}'.format(i), password='',
+                                                 email='example@example.com', user_type=UserType.ADMIN, salt='')
+                                       for i in range(40)])
+        many, payload = get_list({})
+        self.assertEqual(few, many)
+        self.assertEqual(payload['count'], 41)
+        uuids = [entry['uuid'] for entry in payload['entry']]
+        # cursors skip counting the rows
+        count, payload = get_list({'cursor': payload['next_cursor']})
+        self.assertEqual(count, many - 1)
+        self.assertNotIn('count', payload)
+        self.assertIsNone(payload['next_cursor'])
+        uuids += [entry['uuid'] for entry in payload['entry']]
+        self.assertEqual(uuids, list(UserModel.objects.filter(user_type=UserType.ADMIN).order_by('id')
+                                     .values_list('uuid', flat=True)))
+        response = self.client.get('/user/admin/', {'cursor': 'invalid'}, HTTP_X_ACCESS_TOKEN=token,
+                                   HTTP_X_ACCESS_USERNAME='su_admin')
+        self.assertEqual(json.loads(response.content), RESPONSE.INVALID_REQUEST)
+
     @mock.patch.object(view, 'send_mail', mock_send_mail)
     def test_create_admin_user_invalid_req(self):
         token = login_test_user('su_admin')
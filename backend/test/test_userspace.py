@@ -1,34 +1,148 @@
+import re
 import json
+import time
+from types import SimpleNamespace
 import mock
-from kubernetes.stream import ws_client
+from websocket import WebSocketTimeoutException
+from kubernetes.stream.ws_client import ABNF
+from django.test import TestCase
 from api.common import RESPONSE
 import user_space.views as views
+import user_space.session as session
+import user_space.transfer as transfer
+from user_space.session import ExecSession, ExecSessionPool, ExecSessionError
+from user_space.cache import FileCache, make_etag, parse_etags
 from task_manager.models import TaskSettings
-from .common import login_test_user, TestCaseWithBasicUser, MockCoreV1Api, MockTaskExecutor, MockWSClient, \
+from .common import login_test_user, TestCaseWithBasicUser, MockCoreV1Api, MockTaskExecutor, MockShellClient, \
     MockTaskExecutorNotReady, MockTaskExecutorWithInternalError
 
 
-class MockWsClientUserSpace(MockWSClient):
-    def read_stdout(self, **_):
-        return 'app\ntest\nmain.cpp'
+class MockWsClientUserSpace(MockShellClient):
+    output = 'app\ntest\nmain.cpp'
+    version = '18 2020-05-01 12:00:00.000000000 +0800 1024'
 
+    def answer(self, script):
+        if script.startswith('version=$(stat'):
+            # files are read along with their version
+            return '{}\n{}'.format(self.version, self.output), self.status
+        return super().answer(script)
 
-class MockWsClientWithErrors(MockWSClient):
-    def read_channel(self, channel, **_):
-        if channel == ws_client.ERROR_CHANNEL:
-            return json.dumps({'status': 'Failure'})
-        else:
-            return ''
+
+class MockWsClientWithErrors(MockShellClient):
+    status = 1
+
+
+class MockSilentShell(MockShellClient):
+    def write_stdin(self, data, **_):
+        pass
+
+
+class MockBatchShell(MockShellClient):
+    """
+    Shell answering the operations of a batch with the output and status of their commands in `results`
+    """
+    results = {
+        'ls -F ~/src': ('main.cpp\ninclude/\n', 0),
+        'cat ~/src/main.cpp': ('int main() {}', 0),
+    }
+
+    def __init__(self, **_):
+        super().__init__()
+        self.commands = []
+
+    def answer(self, script):
+        output = ''
+        for command, separator in re.findall(r"\(\n(.*?)\n\)\nprintf '\\n%s %d\\n' (\w+) \$\?", script, re.DOTALL):
+            self.commands.append(command)
+            result, status = self.results.get(command, ('', 0 if command.startswith('mkdir') else 1))
+            output += '{}\n{} {}\n'.format(result, separator, status)
+        return output, 0
+
+
+class MockTransferSocket:
+    """
+    Websocket of an exec stream receiving `frames`, then the status of the command, a None frame times out
+    """
+
+    def __init__(self, frames, status='Success'):
+        self.frames = list(frames) + [b'\x03' + json.dumps({'status': status}).encode()]
+        self.sent = []
+        self.connected = True
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def recv_data_frame(self, _control_frame):
+        if not self.frames:
+            return ABNF.OPCODE_CLOSE, None
+        data = self.frames.pop(0)
+        if data is None:
+            raise WebSocketTimeoutException("timed out")
+        return ABNF.OPCODE_BINARY, SimpleNamespace(data=data)
+
+    def send(self, payload, opcode):
+        self.sent.append((payload, opcode))
+
+    def close(self):
+        self.connected = False
+
+
+class MockTransferClient(MockWsClientUserSpace):
+    """
+    Shell session telling that files have 1000 bytes, and exec streams of transfers
+    """
+    output = '1000\n'
+    status = 0
+
+    def __init__(self, command, stdin=False, frames=(), **_):
+        super().__init__()
+        self.command = command
+        self.stdin = stdin
+        if command[-1] != 'sh':
+            # not a shell session
+            self.sock = MockTransferSocket(frames)
+
+    def close(self, **_):
+        super().close()
+        self.sock.close()
+
+
+CLIENTS = []
 
 
 def mock_stream(_p0, _p1, _p2, **_):
-    return MockWsClientUserSpace()
+    CLIENTS.append(MockWsClientUserSpace())
+    return CLIENTS[-1]
 
 
 def mock_bad_stream(_p0, _p1, _p2, **_):
     return MockWsClientWithErrors()
 
 
+def mock_silent_stream(_p0, _p1, _p2, **_):
+    return MockSilentShell()
+
+
+class MockTreeShell(MockShellClient):
+    output = 'd 4096 1589000000.5 755 src\0f 13 1589000001.25 644 src/main.cpp\0l 7 1589000002.0 777 src/a b\0'
+
+
+def mock_tree_stream(_p0, _p1, _p2, **_):
+    CLIENTS.append(MockTreeShell())
+    return CLIENTS[-1]
+
+
+def mock_transfer_stream(_p0, _p1, _p2, command, stdin, **_):
+    CLIENTS.append(MockTransferClient(command, stdin, [b'\x01\x00\xff\xfe', b'\x01\x80abc']))
+    return CLIENTS[-1]
+
+
+def mock_batch_stream(_p0, _p1, _p2, **_):
+    CLIENTS.append(MockBatchShell())
+    return CLIENTS[-1]
+
+
 class MockNullPodExecutor(MockTaskExecutor):
     @classmethod
     def instance(cls, **_):
@@ -40,10 +154,13 @@ class MockNullPodExecutor(MockTaskExecutor):
 
 
 @mock.patch.object(views, 'CoreV1Api', MockCoreV1Api)
-@mock.patch.object(views, 'stream', mock_stream)
+@mock.patch.object(session, 'stream', mock_stream)
 class TestUserSpace(TestCaseWithBasicUser):
     def setUp(self):
         super().setUp()
+        views.EXEC_SESSIONS.close_all()
+        views.FILE_CACHE.clear()
+        CLIENTS.clear()
         self.task_settings = TaskSettings.objects.create(uuid='my_uuid', name="task_0",
                                                          description="test",
                                                          container_config=json.dumps(
@@ -222,17 +339,222 @@ class TestUserSpace(TestCaseWithBasicUser):
         response = json.loads(response.content)
         self.assertTrue(response['status'], RESPONSE.SUCCESS['status'])
 
-    @mock.patch.object(views, 'stream', mock_bad_stream)
     @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
-    def test_command_failure(self):
+    def test_session_reused(self):
         token = login_test_user('admin')
-        response = self.client.get('/user_space/my_uuid/?path=~/a.cpp',
+        for path in ['~/a', '~/b']:
+            response = self.client.get('/user_space/my_uuid/?path={}'.format(path),
+                                       HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+            response = json.loads(response.content)
+            self.assertEqual(response['status'], RESPONSE.SUCCESS['status'])
+        self.assertEqual(len(CLIENTS), 1)
+        self.assertEqual(CLIENTS[0].scripts, ['ls -F ~/a', 'ls -F ~/b'])
+
+        # the shell ended, e.g. with its pod
+        CLIENTS[0].close()
+        response = self.client.get('/user_space/my_uuid/?file=~/a.cpp',
                                    HTTP_X_ACCESS_TOKEN=token,
                                    HTTP_X_ACCESS_USERNAME='admin')
+        response = json.loads(response.content)
+        self.assertEqual(response['payload'], 'app\ntest\nmain.cpp')
+        self.assertEqual(len(CLIENTS), 2)
+        self.assertEqual(len(views.EXEC_SESSIONS), 1)
+
+    @mock.patch.object(session, 'USER_SPACE_EXEC_TIMEOUT', 0.1)
+    @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
+    def test_session_timeout(self):
+        token = login_test_user('admin')
+        with mock.patch.object(session, 'stream', mock_silent_stream):
+            response = self.client.get('/user_space/my_uuid/?path=~/a.cpp',
+                                       HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+        response = json.loads(response.content)
+        self.assertEqual(response['status'], RESPONSE.OPERATION_FAILED['status'])
+
+    @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
+    def test_path_tree(self):
+        token = login_test_user('admin')
+        with mock.patch.object(session, 'stream', mock_tree_stream):
+            response = self.client.get('/user_space/my_uuid/?path=~&tree=true&depth=2&pattern=*.cpp',
+                                       HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+            response = json.loads(response.content)
+            self.assertEqual(response['status'], RESPONSE.SUCCESS['status'])
+            self.assertEqual(response['payload'], [['src', 'd', 4096, 1589000000, '755'],
+                                                   ['src/main.cpp', 'f', 13, 1589000001, '644'],
+                                                   ['src/a b', 'l', 7, 1589000002, '777']])
+            self.assertEqual(CLIENTS[0].scripts, ["find ~ -mindepth 1 -maxdepth 2 \\( -type d -o -name '*.cpp' \\) "
+                                                  "-printf '%y %s %T@ %m %P\\0'"])
+
+            for depth in ['0', 'a']:
+                response = self.client.get('/user_space/my_uuid/?path=~&tree=true&depth={}'.format(depth),
+                                           HTTP_X_ACCESS_TOKEN=token,
+                                           HTTP_X_ACCESS_USERNAME='admin')
+                response = json.loads(response.content)
+                self.assertEqual(response['status'], RESPONSE.INVALID_REQUEST['status'])
+            self.assertEqual(len(CLIENTS[0].scripts), 1)
+
+    @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
+    def test_download(self):
+        token = login_test_user('admin')
+        with mock.patch.object(session, 'stream', mock_transfer_stream), \
+                mock.patch.object(transfer, 'stream', mock_transfer_stream):
+            response = self.client.get('/user_space/my_uuid/?file=~/data/a.bin&raw=true',
+                                       HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Length'], '1000')
+            self.assertEqual(response['Content-Disposition'], "attachment; filename*=UTF-8''a.bin")
+            self.assertEqual(b''.join(response.streaming_content), b'\x00\xff\xfe\x80abc')
+            self.assertEqual(CLIENTS[0].scripts, ['[ -f ~/data/a.bin ] && stat -L -c %s ~/data/a.bin'])
+            self.assertEqual(CLIENTS[1].command, ['su', 'admin_1', '-c', 'cat ~/data/a.bin'])
+            self.assertFalse(CLIENTS[1].is_open())
+
+            response = self.client.get('/user_space/my_uuid/?file=~/data/a.bin&raw=true', HTTP_RANGE='bytes=100-',
+                                       HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Length'], '900')
+            self.assertEqual(response['Content-Range'], 'bytes 100-999/1000')
+            self.assertEqual(CLIENTS[2].command[-1], 'tail -c +101 ~/data/a.bin | head -c 900')
+            response.close()
+            # the session is reused
+            self.assertEqual(len(CLIENTS), 3)
+
+            response = self.client.get('/user_space/my_uuid/?file=~/data/a.bin&raw=true', HTTP_RANGE='bytes=1000-',
+                                       HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response['Content-Range'], 'bytes */1000')
+
+        with mock.patch.object(session, 'stream', mock_bad_stream):
+            views.EXEC_SESSIONS.close_all()
+            response = self.client.get('/user_space/my_uuid/?file=~/data/a.bin&raw=true',
+                                       HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
+            response = json.loads(response.content)
+            self.assertEqual(response['status'], RESPONSE.OPERATION_FAILED['status'])
+
+    @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
+    @mock.patch.object(transfer, 'USER_SPACE_UPLOAD_CHUNK_SIZE', 4)
+    def test_upload(self):
+        token = login_test_user('admin')
+        with mock.patch.object(transfer, 'stream', mock_transfer_stream):
+            response = self.client.post('/user_space/my_uuid/?file=~/a.bin', data=b'\x00\xff\xfe\x80abc',
+                                        content_type='application/octet-stream',
+                                        HTTP_X_ACCESS_TOKEN=token,
+                                        HTTP_X_ACCESS_USERNAME='admin')
+        response = json.loads(response.content)
+        self.assertEqual(response['status'], RESPONSE.SUCCESS['status'])
+        self.assertTrue(CLIENTS[0].stdin)
+        self.assertRegex(CLIENTS[0].command[-1], r'^part=~/a.bin.\w+.part; head -c 7 > "\$part" ')
+        self.assertEqual(CLIENTS[0].sock.sent, [(b'\x00\x00\xff\xfe\x80', ABNF.OPCODE_BINARY),
+                                                (b'\x00abc', ABNF.OPCODE_BINARY)])
+        self.assertFalse(CLIENTS[0].is_open())
+
+        response = self.client.post('/user_space/my_uuid/', data=b'abc', content_type='application/octet-stream',
+                                    HTTP_X_ACCESS_TOKEN=token,
+                                    HTTP_X_ACCESS_USERNAME='admin')
+        response = json.loads(response.content)
+        self.assertEqual(response['status'], RESPONSE.INVALID_REQUEST['status'])
+
+    @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
+    def test_file_cache(self):
+        token = login_test_user('admin')
+
+        def get(**headers):
+            return self.client.get('/user_space/my_uuid/?file=~/a.cpp', HTTP_X_ACCESS_TOKEN=token,
+                                   HTTP_X_ACCESS_USERNAME='admin', **headers)
+
+        response = get()
+        etag = response['ETag']
+        self.assertEqual(json.loads(response.content)['payload'], 'app\ntest\nmain.cpp')
+        self.assertEqual(parse_etags(etag, False), [MockWsClientUserSpace.version])
+        self.assertEqual(CLIENTS[0].scripts, ["version=$(stat -L -c '%s %y %i' ~/a.cpp) && echo \"$version\" && "
+                                              "cat ~/a.cpp"])
+        # served from the cache
+        response = get()
+        self.assertEqual(json.loads(response.content)['payload'], 'app\ntest\nmain.cpp')
+        self.assertEqual(response['ETag'], etag)
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(CLIENTS[0].scripts), 1)
+
+        # checked against the file once stale, and not read again
+        with mock.patch.object(views.FILE_CACHE, 'ttl', 0):
+            response = get()
+        self.assertEqual(json.loads(response.content)['payload'], 'app\ntest\nmain.cpp')
+        self.assertIn("case \"$version\" in '{}') ;; *) cat ~/a.cpp;; esac".format(MockWsClientUserSpace.version),
+                      CLIENTS[0].scripts[1])
+
+        # writes drop cached contents
+        response = self.client.post('/user_space/my_uuid/', data=json.dumps({'file': '~/a.cpp'}),
+                                    content_type='application/json', HTTP_X_REQUEST_WITH='XMLHttpRequest',
+                                    HTTP_X_ACCESS_TOKEN=token,
+                                    HTTP_X_ACCESS_USERNAME='admin')
+        self.assertEqual(json.loads(response.content)['status'], RESPONSE.SUCCESS['status'])
+        self.assertEqual(len(views.FILE_CACHE), 0)
+
+        # an ETag of the client is checked without the content cached
+        response = get(HTTP_IF_NONE_MATCH='"xyz", {}'.format(etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(CLIENTS[0].scripts), 4)
+        response = get(HTTP_IF_NONE_MATCH=make_etag('0 2020-05-01 11:00:00.000000000 +0800 1024', False))
+        self.assertEqual(json.loads(response.content)['payload'], 'app\ntest\nmain.cpp')
+
+    @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
+    def test_batch(self):
+        token = login_test_user('admin')
+        operations = [
+            {'op': 'get', 'path': '~/src'},
+            {'op': 'get', 'file': '~/src/main.cpp'},
+            {'op': 'put', 'file': '~/src/a.bin', 'content': 'AAEC', 'base64': True},
+            {'op': 'mkdir', 'path': '~/src/b'},
+            {'op': 'mv', 'old_path': '~/src/b', 'path': '~/src/c'},
+            {'op': 'rm', 'file': '~/src/a.bin'},
+        ]
+        with mock.patch.object(session, 'stream', mock_batch_stream):
+            response = self.client.post('/user_space/my_uuid/', data=json.dumps({'operations': operations}),
+                                        content_type='application/json', HTTP_X_REQUEST_WITH='XMLHttpRequest',
+                                        HTTP_X_ACCESS_TOKEN=token,
+                                        HTTP_X_ACCESS_USERNAME='admin')
+        response = json.loads(response.content)
+        self.assertEqual(response['status'], RESPONSE.SUCCESS['status'])
+        self.assertEqual([result['status'] for result in response['payload']], [200, 200, 402, 200, 402, 402])
+        self.assertEqual(response['payload'][0]['payload'], ['main.cpp', 'include/'])
+        self.assertEqual(response['payload'][1]['payload'], 'int main() {}')
+        # a single exec round trip
+        self.assertEqual(len(CLIENTS), 1)
+        self.assertEqual(len(CLIENTS[0].scripts), 1)
+        self.assertTrue(CLIENTS[0].commands[2].startswith('base64 -d > ~/src/a.bin'))
+        self.assertEqual(CLIENTS[0].commands[2].split('\n')[1], 'AAEC')
+        self.assertEqual(CLIENTS[0].commands[4:], ['mv ~/src/b ~/src/c', 'rm -f ~/src/a.bin'])
+
+    @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
+    def test_batch_invalid_request(self):
+        token = login_test_user('admin')
+        for operations in [[], {'op': 'get'}, [{'op': 'get', 'file': 'a', 'path': 'b'}], [{'op': 'chmod'}],
+                           [{'op': 'mv', 'path': 'b'}], [{'op': 'rm', 'file': 'a'}] * 101]:
+            response = self.client.post('/user_space/my_uuid/', data=json.dumps({'operations': operations}),
+                                        content_type='application/json', HTTP_X_REQUEST_WITH='XMLHttpRequest',
+                                        HTTP_X_ACCESS_TOKEN=token,
+                                        HTTP_X_ACCESS_USERNAME='admin')
+            response = json.loads(response.content)
+            self.assertEqual(response['status'], RESPONSE.INVALID_REQUEST['status'])
+        self.assertEqual(CLIENTS, [])
+
+    @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
+    def test_command_failure(self):
+        token = login_test_user('admin')
+        with mock.patch.object(session, 'stream', mock_bad_stream):
+            response = self.client.get('/user_space/my_uuid/?path=~/a.cpp',
+                                       HTTP_X_ACCESS_TOKEN=token,
+                                       HTTP_X_ACCESS_USERNAME='admin')
         self.assertEqual(response.status_code, 200)
         response = json.loads(response.content)
-        self.assertTrue(response['status'], RESPONSE.OPERATION_FAILED['status'])
-        self.assertTrue(response['payload'], 'app\ntest\nmain.cpp'.split())
+        self.assertEqual(response['status'], RESPONSE.OPERATION_FAILED['status'])
 
     @mock.patch.object(views, 'TaskExecutor', MockTaskExecutor)
     def test_user_vnc_handler(self):
@@ -273,3 +595,87 @@ class TestUserSpace(TestCaseWithBasicUser):
         self.assertEqual(response.status_code, 200)
         response = json.loads(response.content)
         self.assertEqual(response['status'], RESPONSE.SERVER_ERROR['status'])
+
+
+@mock.patch.object(session, 'stream', mock_stream)
+class TestExecSession(TestCase):
+    def setUp(self):
+        CLIENTS.clear()
+
+    def test_run(self):
+        shell = ExecSession(MockCoreV1Api(None), 'pod', 'user_1')
+        self.assertEqual(shell.run('cat a'), (0, 'app\ntest\nmain.cpp'))
+        self.assertEqual(shell.run('  '), (0, ''))
+        self.assertEqual(CLIENTS[0].scripts, ['cat a'])
+
+    def test_split_frames(self):
+        shell = ExecSession(MockCoreV1Api(None), 'pod', 'user_1')
+        # characters and the end marker are cut between frames
+        with mock.patch.object(MockWsClientUserSpace, 'output', 'héllo'), \
+                mock.patch('test.common.MockShellSocket.frame_size', 1):
+            self.assertEqual(shell.run('cat a'), (0, 'héllo'))
+            self.assertEqual(shell.run('cat b'), (0, 'héllo'))
+        self.assertEqual(len(CLIENTS), 1)
+
+    def test_timeout(self):
+        shell = ExecSession(MockCoreV1Api(None), 'pod', 'user_1')
+        with mock.patch.object(session, 'stream', mock_silent_stream), self.assertRaises(ExecSessionError):
+            shell.run('cat a', timeout=0.1)
+        self.assertFalse(shell.is_open())
+
+    def test_close_idle(self):
+        pool = ExecSessionPool(idle_timeout=0.05)
+        pool.run(MockCoreV1Api(None), 'pod', 'user_1', 'cat a')
+        pool.run(MockCoreV1Api(None), 'pod', 'user_2', 'cat a')
+        self.assertEqual(len(pool), 2)
+        time.sleep(0.1)
+        pool.run(MockCoreV1Api(None), 'pod', 'user_2', 'cat a')
+        self.assertEqual(len(pool), 1)
+        self.assertFalse(CLIENTS[0].is_open())
+        self.assertTrue(CLIENTS[2].is_open())
+        pool.close_all()
+        self.assertEqual(len(pool), 0)
+
+
+class TestTransfer(TestCase):
+    def test_parse_range(self):
+        self.assertIsNone(transfer.parse_range(None, 10))
+        self.assertIsNone(transfer.parse_range('bytes=0-1,3-4', 10))
+        self.assertIsNone(transfer.parse_range('bytes=-', 10))
+        self.assertEqual(transfer.parse_range('bytes=2-5', 10), (2, 5))
+        self.assertEqual(transfer.parse_range('bytes=2-50', 10), (2, 9))
+        self.assertEqual(transfer.parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(transfer.parse_range('bytes=-30', 10), (0, 9))
+        with self.assertRaises(ValueError):
+            transfer.parse_range('bytes=10-', 10)
+
+    def test_read_frames_timeout(self):
+        client = MockTransferClient(['cat'], frames=[b'\x01abc', None])
+        frames = transfer.read_frames(client, 5)
+        self.assertEqual(next(frames), (1, b'abc'))
+        self.assertEqual(client.sock.timeout, 5)
+        with self.assertRaises(ExecSessionError):
+            next(frames)
+
+
+class TestFileCache(TestCase):
+    def test_eviction(self):
+        cache = FileCache(max_size=10, file_size=6, ttl=60)
+        cache.put(('user_1', 'pod', 'a', False), 'v1', 'aaaa')
+        cache.put(('user_1', 'pod', 'b', False), 'v1', 'bbbb')
+        cache.put(('user_2', 'pod', 'c', False), 'v1', 'c' * 7)
+        self.assertIsNone(cache.get(('user_2', 'pod', 'c', False)))
+        self.assertTrue(cache.fresh(cache.get(('user_1', 'pod', 'a', False))))
+        # the least recently read goes first
+        cache.put(('user_2', 'pod', 'c', False), 'v1', 'cccc')
+        self.assertIsNone(cache.get(('user_1', 'pod', 'b', False)))
+        self.assertEqual(len(cache), 2)
+        cache.invalidate('user_1')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(('user_2', 'pod', 'c', False)).content, 'cccc')
+
+    def test_etags(self):
+        version = '18 2020-05-01 12:00:00.000000000 +0800 1024'
+        self.assertEqual(parse_etags('W/{}, "t!!"'.format(make_etag(version, False)), False), [version])
+        self.assertEqual(parse_etags(make_etag(version, False), True), [])
+        self.assertEqual(parse_etags(None, False), [])
@@ -8,10 +8,11 @@ import pytest
 from channels.testing import WebsocketCommunicator
 import mock
 import wsocket
-from wsocket.views import WebSSH, UserWebSSH
+from wsocket.views import WebSSH, UserWebSSH, TaskLogTail
 from user_model.models import UserModel, UserType
-from task_manager.models import TaskSettings
-from .common import MockWSClient
+from task_manager.models import TaskSettings, Task, TASK
+from task_manager.task_log import LogTailHub
+from .common import MockWSClient, MockFollowLogApi
 
 
 def mock_stream(_p0, _p1, _p2, **_):
@@ -129,3 +130,48 @@ async def test_user_ssh_executor_normal(*_):
         assert response == 'Hello from WebSocket!\n'
         _ = await communicator.send_to('hello')
         await communicator.disconnect()
+
+
+def log_identity(uuid, token='my_only_token'):
+    identity = json.dumps({'uuid': uuid, 'token': token, 'username': 'admin'})
+    return base64.b64encode(identity.encode('utf-8')).decode('utf-8')
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_task_log_tail():
+    user = UserModel.objects.create(username='admin', user_type=UserType.ADMIN, uuid='uuid', password='pass',
+                                    salt='salt', email='email@email.com', token='my_only_token',
+                                    token_expire_time=round(time.time()) + 100)
+    settings = TaskSettings.objects.create(name='test', uuid='my_uuid', description='', container_config='{}',
+                                           time_limit=1, replica=1, ttl_interval=1, max_sharing_users=1)
+    Task.objects.create(user=user, settings=settings, uuid='t_run', status=TASK.RUNNING)
+    Task.objects.create(user=user, settings=settings, uuid='t_done', status=TASK.SUCCEEDED)
+    hub = LogTailHub()
+    api = hub._api = MockFollowLogApi()
+    with mock.patch.object(wsocket.views, 'LOG_TAILS', hub):
+        viewers = [WebsocketCommunicator(TaskLogTail, "/task_logs/?identity={}".format(log_identity('t_run')))
+                   for _ in range(2)]
+        for communicator in viewers:
+            connected, _ = await communicator.connect()
+            assert connected
+        api.pieces.put(b'line 1\n')
+        for communicator in viewers:
+            assert await communicator.receive_from() == 'line 1\n'
+        # one stream from the pod of the task for all viewers
+        assert len(api.calls) == 1
+        assert api.calls[0][0] == 'task-exec=t_run'
+        await viewers[1].disconnect()
+        api.pieces.put(None)
+        assert (await viewers[0].receive_output())['type'] == 'websocket.close'
+        assert hub.viewers('t_run') == 0
+
+        for uuid, token, message in (('t_done', 'my_only_token', "\nTask is not running."),
+                                     ('t_run', 'bad_token', "\nAuthentication failed."),
+                                     ('t_none', 'my_only_token', "\nFailed to process.")):
+            communicator = WebsocketCommunicator(TaskLogTail,
+                                                 "/task_logs/?identity={}".format(log_identity(uuid, token)))
+            connected, _ = await communicator.connect()
+            assert connected
+            assert await communicator.receive_from() == message
+            await communicator.disconnect()
@@ -27,6 +27,7 @@ from oauth2_provider.models import Application, AccessToken
 from oauth2_provider.views import ProtectedResourceView
 from user_model.models import UserModel, UserType
 from api.common import RESPONSE, OAUTH_LOGIN_URL, random_password, get_uuid
+from api.pagination import get_page
 from config import USER_TOKEN_EXPIRE_TIME, CLOUD_SCHEDULER_API_SERVER_BASE_URL, DEFAULT_FROM_EMAIL
 
 LOGGER = logging.getLogger(__name__)
@@ -566,9 +567,12 @@ class SuperUserListHandler(View):
         @apiPermission super_admin
 
         @apiParam {Number} [page] Specifies the page number (starting from 1, per page 25 elements)
+        @apiParam {String} [cursor] Returns the 25 elements after the previous page, given its `next_cursor`.
+        Faster than `page` on large lists, `count` and `page_count` are not returned
         @apiSuccess {Object} payload Response object
         @apiSuccess {Number} payload.page_count Page count
         @apiSuccess {Number} payload.count Total element count
+        @apiSuccess {String} payload.next_cursor Cursor of the next page, null on the last page
         @apiSuccess {Object[]} payload.entry List of AdminUser Object
         @apiSuccess {String} payload.entry.uuid UUID of AdminUser
         @apiSuccess {String} payload.entry.username Username of AdminUser
@@ -584,17 +588,11 @@ class SuperUserListHandler(View):
         """
         response = RESPONSE.SUCCESS
         try:
-            params = request.GET
-            page = params.get('page', '1')
-            page = int(page)
-            if page < 1:
-                raise ValueError()
-            all_pages = Paginator(UserModel.objects.filter(user_type=UserType.ADMIN).order_by('id', 'username'), 25)
-            curr_page = all_pages.page(page)
-            response['payload']['count'] = all_pages.count
-            response['payload']['page_count'] = all_pages.num_pages if all_pages.count > 0 else 0
+            queryset = UserModel.objects.filter(user_type=UserType.ADMIN).only('uuid', 'username', 'email',
+                                                                              'create_time')
+            rows, response['payload'] = get_page(queryset, request.GET, ('id',))
             response['payload']['entry'] = []
-            for item in curr_page.object_list:
+            for item in rows:
                 response['payload']['entry'].append({'uuid': item.uuid, 'username': item.username,
                                                      'email': item.email, 'create_time': item.create_time})
         except ValueError:
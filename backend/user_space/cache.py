@@ -0,0 +1,130 @@
+"""
+Cache of file contents read from user spaces, validated by the version of the files
+"""
+import time
+import base64
+import binascii
+from collections import OrderedDict
+from threading import Lock
+from config import USER_SPACE_CACHE_SIZE, USER_SPACE_CACHE_FILE_SIZE, USER_SPACE_CACHE_TTL
+
+# size, modification time with nanoseconds and inode of a file, which changes when the file is written or replaced
+VERSION_FORMAT = "'%s %y %i'"
+
+
+def make_etag(version, encoded):
+    """
+    ETag of the content of a file at `version`, base64 `encoded` or not. The version is kept in it, so that it can
+    be checked against the file without having the content cached.
+    """
+    return '"{}{}"'.format('b' if encoded else 't', base64.urlsafe_b64encode(version.encode()).decode())
+
+
+def parse_etags(header, encoded):
+    """
+    Versions of the ETags made by `make_etag` in an `If-None-Match` header
+    """
+    versions = []
+    for etag in (header or '').split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if len(etag) < 3 or etag[0] != '"' or etag[-1] != '"' or etag[1] != ('b' if encoded else 't'):
+            continue
+        try:
+            versions.append(base64.b64decode(etag[2:-1].encode(), altchars=b'-_', validate=True).decode())
+        except (ValueError, binascii.Error):
+            continue
+    return versions
+
+
+class _Entry:
+    def __init__(self, username, version, content):
+        self.username = username
+        self.version = version
+        self.content = content
+        self.checked = time.time()
+
+
+class FileCache:
+    """
+    Contents of files by user, pod, file name and encoding, at most `max_size` characters of them, the least
+    recently read dropped first. An entry is used without checking the file for `ttl` seconds after it was read or
+    checked. Writes through the API drop the entries of the user, other changes are seen once `ttl` is over.
+    """
+
+    def __init__(self, max_size=USER_SPACE_CACHE_SIZE, file_size=USER_SPACE_CACHE_FILE_SIZE,
+                 ttl=USER_SPACE_CACHE_TTL):
+        self.max_size = max_size
+        self.file_size = file_size
+        self.ttl = ttl
+        self.lock = Lock()
+        self._entries = OrderedDict()
+        self._users = {}  # keys of the entries of every user
+        self._size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= len(entry.content)
+        keys = self._users[entry.username]
+        keys.discard(key)
+        if not keys:
+            del self._users[entry.username]
+
+    def get(self, key):
+        """
+        Entry of `key`, None if it is not cached
+        """
+        with self.lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def fresh(self, entry):
+        return entry is not None and time.time() - entry.checked < self.ttl
+
+    def put(self, key, version, content):
+        """
+        Cache `content` of `version` as `key`, which starts with the username, unless it is too large
+        """
+        with self.lock:
+            if key in self._entries:
+                self._remove(key)
+            if len(content) > min(self.file_size, self.max_size):
+                return
+            self._entries[key] = _Entry(key[0], version, content)
+            self._users.setdefault(key[0], set()).add(key)
+            self._size += len(content)
+            while self._size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    @staticmethod
+    def refresh(entry):
+        """
+        Record that the file of `entry` was checked to be still at its version
+        """
+        entry.checked = time.time()
+
+    def discard(self, key):
+        with self.lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate(self, username):
+        """
+        Drop the entries of `username`, whose files may have been changed
+        """
+        with self.lock:
+            for key in list(self._users.get(username, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self._users.clear()
+            self._size = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self._entries)
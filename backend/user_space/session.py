@@ -0,0 +1,180 @@
+"""
+Long-lived shell sessions of users in their user space pods
+"""
+import re
+import time
+import codecs
+import secrets
+import logging
+from threading import Lock
+from websocket import WebSocketTimeoutException
+from kubernetes.stream import stream
+from kubernetes.stream.ws_client import ABNF, STDOUT_CHANNEL
+from config import KUBERNETES_NAMESPACE, USER_SPACE_EXEC_TIMEOUT, USER_SPACE_SESSION_IDLE_TIMEOUT
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ExecSessionError(Exception):
+    pass
+
+
+def recv_frame(client, timeout):
+    """
+    Channel and bytes of the next frame received by exec stream `client`, None once it closes.
+    Frames are read from its websocket as they are: `WSClient.update` decodes every frame as UTF-8, and waits for
+    them with select on the socket, which stays unreadable while frames are already decrypted in the buffers of an
+    SSL connection.
+    :raise ExecSessionError: if nothing is received for `timeout` seconds
+    """
+    client.sock.settimeout(timeout)
+    while True:
+        try:
+            op_code, frame = client.sock.recv_data_frame(True)
+        except WebSocketTimeoutException as ex:
+            raise ExecSessionError("Exec stream timed out") from ex
+        if op_code == ABNF.OPCODE_CLOSE:
+            return None
+        if op_code in (ABNF.OPCODE_BINARY, ABNF.OPCODE_TEXT) and len(frame.data) > 1:
+            data = frame.data if isinstance(frame.data, bytes) else frame.data.encode()
+            return data[0], data[1:]
+
+
+class ExecSession:
+    """
+    Shell of a user in a pod, kept running behind one exec stream, which runs command lists one at a time.
+
+    A command list is written to the stdin of the shell, run in a subshell so that it cannot change the state of the
+    session, and followed by a line printing a marker unique to it with its exit status. Its output is the stdout of
+    the shell up to the marker. This saves the websocket handshake and the `su` of a new exec per command list.
+    """
+
+    def __init__(self, api, pod_name, username):
+        self.api = api
+        self.pod_name = pod_name
+        self.username = username
+        self.lock = Lock()  # held while running a command list
+        self.last_used = time.time()
+        self._client = None
+
+    def _open(self):
+        LOGGER.debug("Opening shell session of %s in pod %s", self.username, self.pod_name)
+        self._client = stream(self.api.connect_get_namespaced_pod_exec, self.pod_name, KUBERNETES_NAMESPACE,
+                              command=['su', self.username, '-c', 'sh'], stderr=False, stdin=True, stdout=True,
+                              tty=False, _preload_content=False)
+
+    def close(self):
+        client = self._client
+        self._client = None
+        if client is not None:
+            try:
+                client.close()
+            except Exception as ex:
+                LOGGER.debug(ex)
+
+    def is_open(self):
+        return self._client is not None and self._client.is_open()
+
+    def _run(self, script, timeout):
+        client = self._client
+        marker = 'end_{}'.format(secrets.token_hex(8))
+        done = re.compile(r'{} (\d+)\n'.format(marker))
+        client.write_stdin("(\n{}\n) </dev/null\nprintf '%s %d\\n' {} $?\n".format(script, marker))
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        output = ''
+        deadline = time.time() + timeout
+        while True:
+            match = done.search(output)
+            if match is not None:
+                return int(match.group(1)), output[:match.start()]
+            remaining = deadline - time.time()
+            if remaining <= 0 or not client.is_open():
+                raise ExecSessionError("Shell session of {} in pod {} {}".format(
+                    self.username, self.pod_name, "timed out" if remaining <= 0 else "closed"))
+            try:
+                received = recv_frame(client, remaining)
+            except ExecSessionError:
+                continue
+            if received is None:
+                client.close()
+            elif received[0] == STDOUT_CHANNEL:
+                output += decoder.decode(received[1])
+
+    def run(self, script, timeout=None):
+        """
+        Run the shell command list `script` as the user
+        :return: exit status of its last command and its output
+        :raise ExecSessionError: if it did not finish in `timeout` seconds, USER_SPACE_EXEC_TIMEOUT by default,
+        or the session ended
+        """
+        if not script.strip():
+            return 0, ''
+        if timeout is None:
+            timeout = USER_SPACE_EXEC_TIMEOUT
+        with self.lock:
+            self.last_used = time.time()
+            try:
+                if not self.is_open():
+                    # not opened yet, or ended e.g. with its pod
+                    self.close()
+                    self._open()
+                return self._run(script, timeout)
+            except Exception:
+                # the state of the shell is unknown, the next command list gets a new one
+                self.close()
+                raise
+            finally:
+                self.last_used = time.time()
+
+
+class ExecSessionPool:
+    """
+    Shell sessions by user and pod, opened by their first command list and closed after being unused for
+    USER_SPACE_SESSION_IDLE_TIMEOUT seconds. Command lists of the same user in the same pod run one after another.
+    """
+
+    def __init__(self, idle_timeout=USER_SPACE_SESSION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        self._sessions = {}
+
+    def _close_idle(self):
+        now = time.time()
+        idle = []
+        with self.lock:
+            for key, session in list(self._sessions.items()):
+                if now - session.last_used > self.idle_timeout and session.lock.acquire(blocking=False):
+                    del self._sessions[key]
+                    idle.append(session)
+        for session in idle:
+            session.close()
+            session.lock.release()
+
+    def get(self, api, pod_name, username):
+        self._close_idle()
+        with self.lock:
+            session = self._sessions.get((username, pod_name), None)
+            if session is None:
+                session = ExecSession(api, pod_name, username)
+                self._sessions[(username, pod_name)] = session
+            # not closed as idle before running
+            session.last_used = time.time()
+            return session
+
+    def run(self, api, pod_name, username, script):
+        """
+        Run `script` in the session of `username` in pod `pod_name`, see `ExecSession.run`
+        """
+        return self.get(api, pod_name, username).run(script)
+
+    def close_all(self):
+        with self.lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            with session.lock:
+                session.close()
+
+    def __len__(self):
+        with self.lock:
+            return len(self._sessions)
@@ -0,0 +1,110 @@
+"""
+Binary-safe file transfers with user space pods, streamed over exec without loading whole files
+"""
+import re
+import json
+import logging
+from kubernetes.stream import stream
+from kubernetes.stream.ws_client import ABNF, STDIN_CHANNEL, STDOUT_CHANNEL, ERROR_CHANNEL
+from config import KUBERNETES_NAMESPACE, USER_SPACE_EXEC_TIMEOUT, USER_SPACE_UPLOAD_CHUNK_SIZE
+from .session import recv_frame
+
+LOGGER = logging.getLogger(__name__)
+
+
+def open_exec(api, pod_name, username, script, stdin=False):
+    """
+    Exec stream running `script` as `username`, with stdout unless it reads `stdin`
+    """
+    return stream(api.connect_get_namespaced_pod_exec, pod_name, KUBERNETES_NAMESPACE,
+                  command=['su', username, '-c', script], stderr=False, stdin=stdin, stdout=not stdin, tty=False,
+                  _preload_content=False)
+
+
+def read_frames(client, timeout=None):
+    """
+    Channel and bytes of the frames received by exec stream `client` until it closes, see `recv_frame`
+    :raise ExecSessionError: if nothing is received for `timeout` seconds, USER_SPACE_EXEC_TIMEOUT by default
+    """
+    if timeout is None:
+        timeout = USER_SPACE_EXEC_TIMEOUT
+    while client.is_open() and client.sock.connected:
+        received = recv_frame(client, timeout)
+        if received is None:
+            break
+        yield received
+
+
+def exec_succeeded(status):
+    """
+    Whether the content of the error channel of an exec `status` tells that its command exited with 0
+    """
+    try:
+        return json.loads(status.decode()).get('status', None) == 'Success'
+    except ValueError:
+        return False
+
+
+def download(client):
+    """
+    Stdout of exec stream `client` in pieces as they are received, the stream is closed once they are consumed
+    or dropped. A failure of the command is only logged, as the response has already been started.
+    """
+    status = b''
+    try:
+        for channel, data in read_frames(client):
+            if channel == STDOUT_CHANNEL:
+                yield data
+            elif channel == ERROR_CHANNEL:
+                status += data
+        if not exec_succeeded(status):
+            LOGGER.warning("Download failed: %s", status)
+    finally:
+        client.close()
+
+
+def upload(client, body, size):
+    """
+    Write `size` bytes read from the file-like `body` to the stdin of exec stream `client`, in binary frames of at
+    most USER_SPACE_UPLOAD_CHUNK_SIZE bytes
+    :return: whether the command exited with 0
+    """
+    status = b''
+    try:
+        remaining = size
+        while remaining > 0:
+            data = body.read(min(USER_SPACE_UPLOAD_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            client.sock.send(bytes([STDIN_CHANNEL]) + data, opcode=ABNF.OPCODE_BINARY)
+            remaining -= len(data)
+        if remaining:
+            # the body ended early, closing stdin makes the command fail
+            return False
+        for channel, data in read_frames(client):
+            if channel == ERROR_CHANNEL:
+                status += data
+        return exec_succeeded(status)
+    finally:
+        client.close()
+
+
+def parse_range(header, size):
+    """
+    First and last byte of a single range of the `Range` header of a request, of a file of `size` bytes
+    :return: None if the whole file is wanted, or the header is not a single byte range, which is then ignored
+    :raise ValueError: if the range is not satisfiable
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip()) if header else None
+    if match is None or not (match.group(1) or match.group(2)):
+        return None
+    if match.group(1):
+        first = int(match.group(1))
+        last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    else:
+        # the last bytes
+        first = max(size - int(match.group(2)), 0)
+        last = size - 1
+    if first > last:
+        raise ValueError("Range not satisfiable")
+    return first, last
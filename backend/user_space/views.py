@@ -2,27 +2,105 @@
 View handler for user_space
 """
 
+import os
+import re
+import shlex
 import logging
 import json
 import random
 import string
-from django.http import JsonResponse
+from urllib.parse import quote
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.views import View
 from kubernetes.client import CoreV1Api
-from kubernetes.stream import stream
-from kubernetes.stream.ws_client import ERROR_CHANNEL
 from api.common import RESPONSE
 from task_manager.executor import TaskExecutor, get_kubernetes_api_client
 from task_manager.models import TaskSettings
-from config import KUBERNETES_NAMESPACE
+from config import USER_SPACE_BATCH_SIZE
+from .session import ExecSessionPool, ExecSessionError
+from .transfer import open_exec, download, upload, parse_range
+from .cache import FileCache, VERSION_FORMAT, make_etag, parse_etags
 
 LOGGER = logging.getLogger(__name__)
 
+EXEC_SESSIONS = ExecSessionPool()
+FILE_CACHE = FileCache()
+
 
 def random_string():
     return ''.join(random.sample(string.ascii_letters + string.digits, 16))
 
 
+def write_command(file, content, base64=False):
+    delimiter = random_string()
+    return "{write} > {file} <<'{closing}'\n{content}\n{closing}".format(
+        write='base64 -d' if base64 else 'head -c -1', file=file, content=content, closing=delimiter)
+
+
+def tree_command(path, depth=None, pattern=None):
+    """
+    Command listing `path` recursively, at most `depth` levels deep, with the files not matching the glob `pattern`
+    left out. Every entry is printed with its metadata and ended by a NUL byte, which names cannot contain.
+    :raise ValueError: if `depth` is not a positive number
+    """
+    command = 'find {} -mindepth 1'.format(path)
+    if depth is not None:
+        depth = int(depth)
+        if depth < 1:
+            raise ValueError("Invalid depth")
+        command += ' -maxdepth {}'.format(depth)
+    if pattern:
+        # directories are kept, so that the matching files can be reached
+        command += ' \\( -type d -o -name {} \\)'.format(shlex.quote(pattern))
+    return command + " -printf '%y %s %T@ %m %P\\0'"
+
+
+def parse_tree(output):
+    """
+    Entries printed by the command of `tree_command`
+    :return: list of [path relative to the listed one, type as of `find -printf %y`, size in bytes,
+    modification time in seconds since epoch, permission bits in octal]
+    """
+    entries = []
+    for entry in output.split('\0'):
+        if entry:
+            kind, size, mtime, mode, name = entry.split(' ', 4)
+            entries.append([name, kind, int(size), int(float(mtime)), mode])
+    return entries
+
+
+def list_payload(output, tree):
+    return parse_tree(output) if tree else output.split()
+
+
+def batch_command(operation):
+    """
+    Shell command of an operation of a batch
+    :raise ValueError: if the operation is invalid
+    """
+    if not isinstance(operation, dict):
+        raise ValueError("Invalid operation")
+    op_code = operation.get('op', None)
+    file = operation.get('file', None)
+    path = operation.get('path', None)
+    base64 = operation.get('base64', False) is True
+    if op_code == 'get' and bool(file) ^ bool(path):
+        if file:
+            return ('base64 {}' if base64 else 'cat {}').format(file)
+        if operation.get('tree', False) is True:
+            return tree_command(path, operation.get('depth', None), operation.get('pattern', None))
+        return 'ls -F {}'.format(path)
+    if op_code == 'put' and file and not path:
+        return write_command(file, operation.get('content', ''), base64)
+    if op_code == 'mkdir' and path and not file:
+        return 'mkdir -p {}'.format(path)
+    if op_code == 'mv' and operation.get('old_path', None) and path and not file:
+        return 'mv {} {}'.format(operation['old_path'], path)
+    if op_code == 'rm' and bool(file) ^ bool(path):
+        return 'rm -f {}'.format(file) if file else 'rm -rf {}'.format(path)
+    raise ValueError("Invalid operation")
+
+
 class UserSpaceResetHandler(View):
     http_method_names = ['get']
 
@@ -59,6 +137,7 @@ class UserSpaceResetHandler(View):
                 raise TaskSettings.DoesNotExist
             else:
                 pod = executor.get_user_space_pod(settings.uuid, user, True, isinstance(purge, bool) and purge is True)
+                FILE_CACHE.invalidate('{}_{}'.format(user.username, settings.id))
                 if pod is None:
                     raise TaskSettings.DoesNotExist
             return JsonResponse(RESPONSE.SUCCESS)
@@ -95,8 +174,157 @@ class UserSpaceHandler(View):
             pod = executor.get_user_space_pod(settings_uuid, user)
             return pod, username
 
+    @staticmethod
+    def _run_batch(api, pod, username, operations):
+        """
+        Run `operations` one after another in a single command list, whatever their results
+        :return: result of each operation, with `status` and `payload` as in the response of a single operation
+        """
+        if not isinstance(operations, list) or not operations or len(operations) > USER_SPACE_BATCH_SIZE:
+            raise ValueError("Invalid operations")
+        commands = [batch_command(operation) for operation in operations]
+        separator = random_string()
+        # every operation runs in a subshell followed by a line with its exit status
+        _, res = EXEC_SESSIONS.run(api, pod.metadata.name, username, '\n'.join(
+            "(\n{}\n)\nprintf '\\n%s %d\\n' {} $?".format(command, separator) for command in commands))
+        parts = re.split(r'\n{} (\d+)\n'.format(separator), res)
+        results = []
+        for index, operation in enumerate(operations):
+            output, status = parts[2 * index], int(parts[2 * index + 1])
+            result = {'status': RESPONSE.SUCCESS['status'] if status == 0 else RESPONSE.OPERATION_FAILED['status'],
+                      'payload': {}}
+            if status == 0 and operation['op'] == 'get':
+                result['payload'] = list_payload(output, operation.get('tree', False) is True) \
+                    if operation.get('path', None) else output
+            results.append(result)
+        return results
+
+    def _download(self, request, **kwargs):
+        api = CoreV1Api(get_kubernetes_api_client())
+        try:
+            pod, username = self._get_pod(**kwargs)
+            file = request.GET.get('file', None)
+            if not file:
+                raise ValueError("File is required")
+            if pod is None:
+                response = RESPONSE.OPERATION_FAILED
+                response['message'] += " Failed to allocate pod."
+                return JsonResponse(response)
+            status, res = EXEC_SESSIONS.run(api, pod.metadata.name, username,
+                                            '[ -f {0} ] && stat -L -c %s {0}'.format(file))
+            if status != 0:
+                return JsonResponse(RESPONSE.OPERATION_FAILED)
+            size = int(res)
+            try:
+                byte_range = parse_range(request.META.get('HTTP_RANGE', None), size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */{}'.format(size)
+                return response
+            if byte_range is None:
+                first, last = 0, size - 1
+                script = 'cat {}'.format(file)
+            else:
+                first, last = byte_range
+                script = 'tail -c +{} {} | head -c {}'.format(first + 1, file, last - first + 1)
+            response = StreamingHttpResponse(download(open_exec(api, pod.metadata.name, username, script)),
+                                             status=200 if byte_range is None else 206,
+                                             content_type='application/octet-stream')
+            response['Content-Length'] = last - first + 1
+            response['Accept-Ranges'] = 'bytes'
+            if byte_range is not None:
+                response['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+            response['Content-Disposition'] = "attachment; filename*=UTF-8''{}".format(quote(os.path.basename(file)))
+            return response
+        except TaskSettings.DoesNotExist:
+            return JsonResponse(RESPONSE.OPERATION_FAILED)
+        except ExecSessionError as ex:
+            LOGGER.warning(ex)
+            return JsonResponse(RESPONSE.OPERATION_FAILED)
+        except ValueError:
+            return JsonResponse(RESPONSE.INVALID_REQUEST)
+        except Exception as ex:
+            LOGGER.error(ex)
+            return JsonResponse(RESPONSE.SERVER_ERROR)
+
+    def _upload(self, request, **kwargs):
+        api = CoreV1Api(get_kubernetes_api_client())
+        try:
+            pod, username = self._get_pod(**kwargs)
+            file = request.GET.get('file', None)
+            size = int(request.META.get('CONTENT_LENGTH', None) or -1)
+            if not file or size < 0:
+                raise ValueError("File and its length are required")
+            if pod is None:
+                response = RESPONSE.OPERATION_FAILED
+                response['message'] += " Failed to allocate pod."
+                return JsonResponse(response)
+            # written aside and moved over the file once complete, so that a broken upload leaves it as it was
+            script = 'part={file}.{suffix}.part; head -c {size} > "$part" && [ "$(stat -c %s "$part")" -eq {size} ] ' \
+                     '&& mv -f "$part" {file} || {{ rm -f "$part"; exit 1; }}'.format(file=file, size=size,
+                                                                                     suffix=random_string())
+            try:
+                uploaded = upload(open_exec(api, pod.metadata.name, username, script, stdin=True), request, size)
+            finally:
+                FILE_CACHE.invalidate(username)
+            return JsonResponse(RESPONSE.SUCCESS if uploaded else RESPONSE.OPERATION_FAILED)
+        except TaskSettings.DoesNotExist:
+            return JsonResponse(RESPONSE.OPERATION_FAILED)
+        except ExecSessionError as ex:
+            LOGGER.warning(ex)
+            return JsonResponse(RESPONSE.OPERATION_FAILED)
+        except ValueError:
+            return JsonResponse(RESPONSE.INVALID_REQUEST)
+        except Exception as ex:
+            LOGGER.error(ex)
+            return JsonResponse(RESPONSE.SERVER_ERROR)
+
+    @staticmethod
+    def _read_file(api, pod, username, file, encoded, if_none_match):
+        """
+        Content of `file`, from FILE_CACHE while the entry is fresh. Otherwise the version of the file is checked in
+        the same command as the read, which is skipped if the version is still the one of the entry or of an ETag
+        of `if_none_match`.
+        :return: response, ETag of the content and whether the client has the current content
+        """
+        key = (username, pod.metadata.name, file, encoded)
+        entry = FILE_CACHE.get(key)
+        known = parse_etags(if_none_match, encoded)
+        if not FILE_CACHE.fresh(entry):
+            versions = ([entry.version] if entry is not None else []) + known
+            read = '{} {}'.format('base64' if encoded else 'cat', file)
+            if versions:
+                read = 'case "$version" in {}) ;; *) {};; esac'.format(
+                    '|'.join(shlex.quote(version) for version in versions), read)
+            status, res = EXEC_SESSIONS.run(api, pod.metadata.name, username,
+                                            'version=$(stat -L -c {} {}) && echo "$version" && {}'.format(
+                                                VERSION_FORMAT, file, read))
+            if status != 0:
+                FILE_CACHE.discard(key)
+                return RESPONSE.OPERATION_FAILED, None, False
+            version, _, content = res.partition('\n')
+            if entry is not None and version == entry.version:
+                FILE_CACHE.refresh(entry)
+            elif version in known:
+                return None, make_etag(version, encoded), True
+            else:
+                FILE_CACHE.put(key, version, content)
+                response = RESPONSE.SUCCESS
+                response['payload'] = content
+                return response, make_etag(version, encoded), False
+        if entry.version in known:
+            return None, make_etag(entry.version, encoded), True
+        response = RESPONSE.SUCCESS
+        response['payload'] = entry.content
+        return response, make_etag(entry.version, encoded), False
+
     def _safe_wrapper(self, request, op_code, **kwargs):
         response = None
+        username = None
+        etag = None
+        not_modified = False
+        # whether files may be changed, so that cached contents must be dropped
+        writing = op_code != 'get'
         api = CoreV1Api(get_kubernetes_api_client())
         try:
             pod, username = self._get_pod(**kwargs)
@@ -105,21 +333,33 @@ class UserSpaceHandler(View):
                 response['message'] += " Failed to allocate pod."
             else:
                 params = request.GET
-                command = ['su', username, '-c']
                 cmdlist = []
                 file = params.get('file', None)
                 path = params.get('path', None)
                 base64 = params.get('base64', 'false')
                 base64 = base64.lower() == 'true'
+                tree = params.get('tree', 'false').lower() == 'true'
+                operations = None
                 if op_code != 'get':
                     query = json.loads(request.body)
                     file = query.get('file', None)
                     path = query.get('path', None)
                     content = query.get('content', '')
+                    if op_code == 'post':
+                        operations = query.get('operations', None)
                 if op_code == 'put':
                     old_file = query.get('old_file', None)
                     old_path = query.get('old_path', None)
-                if not bool(file) ^ bool(path):
+                if op_code == 'post' and operations is not None:
+                    writing = not isinstance(operations, list) or \
+                        any(not isinstance(operation, dict) or operation.get('op', None) != 'get'
+                            for operation in operations)
+                    response = RESPONSE.SUCCESS
+                    response['payload'] = self._run_batch(api, pod, username, operations)
+                elif op_code == 'get' and file and not path:
+                    response, etag, not_modified = self._read_file(api, pod, username, file, base64,
+                                                                   request.META.get('HTTP_IF_NONE_MATCH', None))
+                elif not bool(file) ^ bool(path):
                     response = RESPONSE.INVALID_REQUEST
                 else:
                     if op_code == 'put' and not ((old_file and file and not path) or (old_path and path and not file
@@ -130,15 +370,14 @@ class UserSpaceHandler(View):
                             if op_code == 'get':
                                 cmdlist.append(('cat {}' if not base64 else 'base64 {}').format(file))
                             elif op_code == 'post':
-                                delimiter = random_string()
-                                cmdlist.append(
-                                    "head -c -1 > {file} <<'{closing}'\n{content}\n{closing}".format(file=file,
-                                                                                                     content=content,
-                                                                                                     closing=delimiter))
+                                cmdlist.append(write_command(file, content))
                             elif op_code == 'delete':
                                 cmdlist.append('rm -f {}'.format(file))
                         elif path is not None:
-                            if op_code == 'get':
+                            if op_code == 'get' and tree:
+                                cmdlist.append(tree_command(path, params.get('depth', None),
+                                                            params.get('pattern', None)))
+                            elif op_code == 'get':
                                 cmdlist.append('ls -F {}'.format(path))
                             elif op_code == 'post':
                                 cmdlist.append('mkdir -p {}'.format(path))
@@ -150,41 +389,38 @@ class UserSpaceHandler(View):
                             elif old_path and old_path != path:
                                 cmdlist.append('mv {} {}'.format(old_path, path))
                             if file and content:
-                                delimiter = random_string()
-                                cmdlist.append(
-                                    "head -c -1 > {file} <<'{closing}'\n{content}\n{closing}".format(file=file,
-                                                                                                     content=content,
-                                                                                                     closing=delimiter))
-                        command.append(';'.join(cmdlist))
-                        LOGGER.debug(command)
-                        client = stream(api.connect_get_namespaced_pod_exec,
-                                        pod.metadata.name, KUBERNETES_NAMESPACE, command=command, stderr=True,
-                                        stdin=False,
-                                        stdout=True, tty=False, _preload_content=False)
-                        client.run_forever(timeout=20)
-                        try:
-                            err = json.loads(client.read_channel(ERROR_CHANNEL))
-                        except ValueError:
-                            err = {}
-                        res = client.read_stdout()
+                                cmdlist.append(write_command(file, content))
+                        LOGGER.debug(cmdlist)
+                        status, res = EXEC_SESSIONS.run(api, pod.metadata.name, username, ';'.join(cmdlist))
                         LOGGER.debug(res)
-                        LOGGER.debug(err)
-                        if err['status'] == 'Success':
+                        LOGGER.debug(status)
+                        if status == 0:
                             response = RESPONSE.SUCCESS
                             if op_code == 'get':
-                                response['payload'] = res.split() if path is not None else res
+                                response['payload'] = list_payload(res, tree) if path is not None else res
                         else:
                             response = RESPONSE.OPERATION_FAILED
                 return response
         except TaskSettings.DoesNotExist:
             response = RESPONSE.OPERATION_FAILED
+        except ExecSessionError as ex:
+            LOGGER.warning(ex)
+            response = RESPONSE.OPERATION_FAILED
         except ValueError:
             response = RESPONSE.INVALID_REQUEST
         except Exception as ex:
             response = RESPONSE.SERVER_ERROR
             LOGGER.error(ex)
         finally:
-            return JsonResponse(response)
+            if writing and username is not None:
+                FILE_CACHE.invalidate(username)
+            if not_modified:
+                response = HttpResponseNotModified()
+            else:
+                response = JsonResponse(response)
+            if etag is not None:
+                response['ETag'] = etag
+            return response
 
     def get(self, request, **kwargs):
         """
@@ -192,6 +428,10 @@ class UserSpaceHandler(View):
         @apiDescription Get the content of a file, or list a dir in user space. `file` and `path` parameter may not
         be used together. If the user enters user space for the first time, the content in `initial` folder of the
         task will be copied.
+        The content of a file comes with an `ETag` header. When the request has an `If-None-Match` header with the
+        ETag of the current content, the response is `304 Not Modified` without content. Contents read recently
+        are served without reaching the pod for `USER_SPACE_CACHE_TTL` seconds, changes made by other means than
+        this API may be seen that late.
         @apiName GetItemUserSpace
         @apiGroup UserSpace
         @apiVersion 0.1.0
@@ -200,8 +440,19 @@ class UserSpaceHandler(View):
         @apiParam {String} [file] Filename
         @apiParam {String} [path] Path
         @apiParam {Boolean} [base64] Return base64 encoded binary contents
+        @apiParam {Boolean} [raw] Download the file as is instead, streamed as `application/octet-stream`. A single
+        byte range may be requested with the `Range` header, e.g. `Range: bytes=1024-2047`, answered with status 206
+        and `Content-Range`, or 416 if it is out of the file.
+        @apiParam {Boolean} [tree] List `path` recursively with the metadata of every entry
+        @apiParam {Number} [depth] Max depth of the recursive listing, 1 for the entries of `path` only. No limit
+        by default.
+        @apiParam {String} [pattern] Glob pattern the names of listed files must match, e.g. `*.py`. Directories
+        are always listed.
         @apiSuccess {Object} payload Response payload. Can either be string of file content (when `file` is present)
         or list of file and path names (when `path` is present). The path name is followed by a trailing slash.
+        With `tree`, it is a list of entries `[path, type, size, mtime, mode]`: path relative to `path`, type
+        (`f` file, `d` directory, `l` symbolic link...), size in bytes, modification time in seconds since epoch
+        and permission bits in octal.
         @apiSuccessExample {json} Success-Response:
         HTTP/1.1 200 OK
         {
@@ -209,18 +460,35 @@ class UserSpaceHandler(View):
             "message": "",
             "payload": ["Dockerfile", "path_a/", "path_b/"]
         }
+        @apiSuccessExample {json} Tree-Response:
+        HTTP/1.1 200 OK
+        {
+            "status": 200,
+            "message": "",
+            "payload": [
+                ["Dockerfile", "f", 120, 1589000000, "644"],
+                ["path_a", "d", 4096, 1589000000, "755"],
+                ["path_a/main.py", "f", 2048, 1589000000, "644"]
+            ]
+        }
         @apiUse APIHeader
         @apiUse InvalidRequest
         @apiUse OperationFailed
         @apiUse Unauthorized
         @apiUse ServerError
         """
+        if request.GET.get('raw', 'false').lower() == 'true':
+            return self._download(request, **kwargs)
         return self._safe_wrapper(request, 'get', **kwargs)
 
     def post(self, request, **kwargs):
         """
         @api {post} /user_space/<str:uuid>/ Create file/directory in user space
         @apiDescription Create a text file or directory in user space. Existing file will be overridden.
+        With `operations`, run a batch of operations in one go instead, each of them whatever the results of the
+        previous ones. The payload is then the list of their results.
+        A request of type `application/octet-stream` uploads its body as is into the file of the `file` query
+        parameter instead, which is streamed to the pod and replaces the file only once complete.
         @apiName CreateItemUserSpace
         @apiGroup UserSpace
         @apiVersion 0.1.0
@@ -229,6 +497,30 @@ class UserSpaceHandler(View):
         @apiParam {String} [file] Filename
         @apiParam {String} [path] Path
         @apiParam {String} [content] File content (text only)
+        @apiParam {Object[]} [operations] Batch of at most `USER_SPACE_BATCH_SIZE` operations
+        @apiParam {String="get","put","mkdir","mv","rm"} operations.op Operation: `get` a file or list a path,
+        `put` the `content` into a file, `mkdir` a path, `mv` `old_path` to `path`, `rm` a file or path
+        @apiParam {String} [operations.file] Filename
+        @apiParam {String} [operations.path] Path
+        @apiParam {String} [operations.old_path] Path to move
+        @apiParam {String} [operations.content] File content
+        @apiParam {Boolean} [operations.base64] Whether file content is base64 encoded binary, for `get` and `put`
+        @apiParam {Boolean} [operations.tree] List the path recursively, with `depth` and `pattern` as for a `get`
+        @apiParam {Number} [operations.depth] Max depth of the recursive listing
+        @apiParam {String} [operations.pattern] Glob pattern of the names of listed files
+        @apiSuccess {Object[]} [payload] Results of the batch operations in order
+        @apiSuccess {Number} payload.status Status of the operation, 200 or 402 like the status of a single one
+        @apiSuccess {Object} payload.payload File content or list of file and path names for `get`
+        @apiSuccessExample {json} Batch-Response:
+        HTTP/1.1 200 OK
+        {
+            "status": 200,
+            "message": "",
+            "payload": [
+                {"status": 200, "payload": ["Dockerfile", "path_a/"]},
+                {"status": 402, "payload": {}}
+            ]
+        }
         @apiUse APIHeader
         @apiUse Success
         @apiUse InvalidRequest
@@ -236,6 +528,8 @@ class UserSpaceHandler(View):
         @apiUse Unauthorized
         @apiUse ServerError
         """
+        if request.content_type == 'application/octet-stream':
+            return self._upload(request, **kwargs)
         return self._safe_wrapper(request, 'post', **kwargs)
 
     def put(self, request, **kwargs):
@@ -10,15 +10,15 @@ from threading import Thread
 from rpyc import connect
 from channels.generic.websocket import WebsocketConsumer
 from django.http.request import QueryDict
-from kubernetes.client import Configuration, ApiClient
 from kubernetes.client.apis import core_v1_api
 from kubernetes.client.rest import ApiException
 from kubernetes.stream import stream, ws_client
 from user_model.models import UserModel, UserType
 from user_model.views import TokenManager
-from task_manager.models import TaskSettings, TaskStorage
-from config import KUBERNETES_CLUSTER_TOKEN, KUBERNETES_API_SERVER_URL, KUBERNETES_NAMESPACE, USER_SPACE_POD_TIMEOUT, \
-    IPC_PORT
+from task_manager.models import TaskSettings, TaskStorage, Task, TASK
+from task_manager.task_log import LogTailHub
+from api.common import get_kubernetes_api_client
+from config import KUBERNETES_NAMESPACE, USER_SPACE_POD_TIMEOUT, IPC_PORT
 
 SHELL_LIST = [
     '/bin/sh',
@@ -30,6 +30,13 @@ SHELL_LIST = [
 ]
 LOGGER = logging.getLogger(__name__)
 
+# follow streams of task logs shared by all viewers connected to this process
+LOG_TAILS = LogTailHub()
+
+# seconds between expire time extensions of an active webshell, which only ever postpone the expiry so that the
+# executor finds them when the previous expire time is due
+EXPIRE_TIME_UPDATE_INTERVAL = 10
+
 
 class SSH:
     def __init__(self, websocket, **kwargs):
@@ -38,11 +45,7 @@ class SSH:
         self.rows = int(kwargs.get('rows', 24))
         self.need_auth = bool(kwargs.get('need_auth', True))
         self.auth_ok = not self.need_auth
-        conf = Configuration()
-        conf.host = KUBERNETES_API_SERVER_URL
-        conf.verify_ssl = False
-        conf.api_key = {"authorization": "Bearer " + KUBERNETES_CLUSTER_TOKEN}
-        self.api_client = core_v1_api.CoreV1Api(ApiClient(conf))
+        self.api_client = core_v1_api.CoreV1Api(get_kubernetes_api_client())
         self.api_response = None
 
     def connect(self, pod, shell, namespace='default', args=None):
@@ -192,9 +195,11 @@ class UserWebSSH(WebSSH):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.user = None
+        self._expire_time_updated = 0
 
     def update_expire_time(self):
-        if self.user:
+        if self.user and time.time() - self._expire_time_updated >= EXPIRE_TIME_UPDATE_INTERVAL:
+            self._expire_time_updated = time.time()
             try:
                 TaskStorage.objects.filter(user=self.user).update(expire_time=
                                                                   round(time.time()) + USER_SPACE_POD_TIMEOUT)
@@ -246,3 +251,85 @@ class UserWebSSH(WebSSH):
             LOGGER.error(ex)
             self.send('Internal server error occurred.\n')
             self.close(code=4000)
+
+
+class TaskLogTail(WebsocketConsumer):
+    """
+    @api {websocket} /task_logs/ Live log of a running task
+    @apiDescription Output of the task is sent as text messages as soon as it is written, starting with its recent
+    output. All viewers of a task share a single log stream from Kubernetes. The connection is closed once the task
+    finished, its full log can then be read with the task API.
+    @apiName TaskLogTail
+    @apiGroup WebSocket
+    @apiVersion 0.1.0
+    @apiPermission user
+
+    @apiParam {String} identity Base64 encoded JSON string. The JSON object must contain `username`, `token` for auth,
+    and `uuid` of the task
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.uuid = None
+
+    def _output(self, text):
+        if text is None:
+            self.uuid = None
+            self.close()
+        else:
+            self.send(text)
+
+    def connect(self):
+        self.accept()
+        query_string = self.scope.get('query_string')
+        args = QueryDict(query_string=query_string, encoding='utf-8')
+        encoded = args.get('identity', None)
+        try:
+            if not encoded:
+                raise TypeError
+            decoded = json.loads(base64.b64decode(encoded))
+            username = decoded.get('username', None)
+            uuid = decoded.get('uuid', None)
+            token = decoded.get('token', None)
+            if username is None or uuid is None or token is None:
+                raise TypeError
+            user = UserModel.objects.get(username=username)
+            if not token or token != TokenManager.get_token(user):
+                self.send("\nAuthentication failed.")
+                self.close(code=4000)
+                return
+            if user.user_type == UserType.ADMIN or user.user_type == UserType.SUPER_ADMIN:
+                task = Task.objects.only('uuid', 'status').get(uuid=uuid)
+            else:
+                task = Task.objects.only('uuid', 'status').get(uuid=uuid, user=user)
+        except (UserModel.DoesNotExist, Task.DoesNotExist):
+            self.send("\nFailed to process.")
+            self.close(code=4000)
+            return
+        except (TypeError, ValueError):
+            self.send("\nInvalid request.")
+            LOGGER.warning("Invalid request")
+            self.close(code=4000)
+            return
+        TokenManager.update_token(user)
+        if task.status != TASK.RUNNING:
+            self.send("\nTask is not running.")
+            self.close(code=4000)
+            return
+        try:
+            pods = LOG_TAILS.api.list_namespaced_pod(namespace=KUBERNETES_NAMESPACE,
+                                                     label_selector="task-exec={}".format(uuid))
+            if not pods.items:
+                self.send("\nTask is not running.")
+                self.close(code=4000)
+                return
+            self.uuid = uuid
+            LOG_TAILS.subscribe(uuid, pods.items[0].metadata.name, self._output)
+        except Exception as ex:
+            LOGGER.error(ex)
+            self.send('Internal server error occurred.\n')
+            self.close(code=4000)
+
+    def disconnect(self, code):
+        if self.uuid is not None:
+            LOG_TAILS.unsubscribe(self.uuid, self._output)